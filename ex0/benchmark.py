@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from gnss_parser import log_to_measurment, format_satelite_ID, handle_numeric_cols, calculate_datetime_cols, select_usable_rows, \
+    calculate_satellite_positions, calculate_epoch_satellite_positions, solve_epochs, process_log, manager, epoch_cache, \
+    parse_constellations, ephemeris_data_directory, DEFAULT_CONSTELLATIONS, LIGHTSPEED
+from gnssutils import EphemerisManager
+from synthetic_log import generate_log
+
+
+def prepare_measurements(input_filepath, constellations=DEFAULT_CONSTELLATIONS):
+    # clause2 up to the satellite positions, without writing anything
+    measurements, android_fixes = log_to_measurment(input_filepath)
+    format_satelite_ID(measurements)
+    measurements = measurements.loc[measurements['Constellation'].isin(parse_constellations(constellations))]
+    measurements = calculate_datetime_cols(handle_numeric_cols(measurements))
+    measurements['Pseudorange_Measurement'] = LIGHTSPEED * measurements['pseudorange_seconds']
+    return measurements
+
+
+def stage_parse(context):
+    return log_to_measurment(context['log'])[0]
+
+def stage_prepare(context):
+    return prepare_measurements(context['log'])
+
+def stage_ephemeris_load(context):
+    # A fresh manager loads the day from the parsed sidecar cache, the RINEX file is only parsed the first time
+    systems = set(context['usable']['satPRN'].to_numpy().astype(str).astype('U1'))
+    return EphemerisManager(ephemeris_data_directory).get_shard(context['usable']['UnixTime'].iloc[0], systems)
+
+def stage_ephemeris_lookup(context):
+    return manager.get_ephemeris_batch(context['usable']['UnixTime'].to_numpy(), context['usable']['satPRN'].to_numpy())
+
+def stage_satellite_positions(context):
+    usable = context['usable']
+    return calculate_satellite_positions(usable['Epoch'].to_numpy(), usable['satPRN'].to_numpy(),
+                                         usable['transmit_time_seconds'].to_numpy(), context['ephemeris'])
+
+def stage_epoch_satellite_positions(context):
+    return calculate_epoch_satellite_positions(context['measurements'], min_satellites=5, cache=None)
+
+def stage_least_squares(context):
+    return solve_epochs(context['sv_positions'])
+
+def stage_pipeline(context):
+    # The whole process_log run, epoch cache emptied first so every repeat does the orbit work again
+    epoch_cache.clear()
+    with tempfile.TemporaryDirectory() as directory:
+        process_log(context['log'], directory)
+
+
+# Stage name, function and the context entry its result is kept under for the next stages
+STAGES = [('parse', stage_parse, None), ('prepare', stage_prepare, 'measurements'), ('ephemeris load', stage_ephemeris_load, None),
+          ('ephemeris lookup', stage_ephemeris_lookup, 'ephemeris'), ('satellite positions', stage_satellite_positions, None),
+          ('epoch satellite positions', stage_epoch_satellite_positions, 'sv_positions'), ('least squares', stage_least_squares, None),
+          ('pipeline', stage_pipeline, None)]
+
+
+def measure(function, context, repeat):
+    # Best and mean wall time of repeat calls, then the tracemalloc peak of one more call (tracing slows the timed calls down)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(context)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function(context)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, {'best': min(timings), 'mean': float(np.mean(timings)), 'peak_mb': peak / 2**20}
+
+
+def run_benchmarks(log_filepath, repeat=3, stages=None):
+    """Time every stage of the pipeline on one log, returns one dict per stage with its best and mean
+    seconds over repeat runs and its peak traced memory in MiB."""
+    context = {'log': log_filepath}
+    results = []
+    for name, function, key in STAGES:
+        if stages is None or name in stages:
+            result, timing = measure(function, context, repeat)
+            results.append(dict(stage=name, **timing))
+        elif key is not None:
+            # Stages that are not reported still run once when a later stage needs their result
+            result = function(context)
+        else:
+            continue
+        if key is not None:
+            context[key] = result
+        if key == 'measurements':
+            context['usable'] = select_usable_rows(result)
+    return results
+
+
+def format_results(results, rows, epochs):
+    lines = ['%-26s %10s %10s %10s %12s' % ('stage', 'best s', 'mean s', 'peak MiB', 'rows/s')]
+    for result in results:
+        lines.append('%-26s %10.4f %10.4f %10.1f %12.0f' % (result['stage'], result['best'], result['mean'], result['peak_mb'],
+                                                            rows / result['best'] if result['best'] else float('nan')))
+    lines.append(str(rows) + ' Raw records in ' + str(epochs) + ' epochs')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time every stage of the pipeline on a synthetic (or given) GnssLogger log')
+    parser.add_argument('--log', help='benchmark this log instead of generating one')
+    parser.add_argument('--duration', type=float, default=600, help='seconds of the generated log')
+    parser.add_argument('--rate', type=float, default=1, help='epochs per second of the generated log')
+    parser.add_argument('--satellites', type=int, default=10, help='most satellites in one epoch of the generated log')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of every stage')
+    parser.add_argument('--stages', type=lambda value: value.split(','), default=None,
+                        help='comma separated stages to report (default: all), any of ' + ','.join(name for name, _, _ in STAGES))
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        log_filepath = args.log
+        if log_filepath is None:
+            log_filepath = os.path.join(directory, 'synthetic_log.txt')
+            start = time.perf_counter()
+            rows = generate_log(log_filepath, args.duration, args.rate, args.satellites)
+            print('generated %d Raw records in %.2f s' % (rows, time.perf_counter() - start))
+        results = run_benchmarks(log_filepath, args.repeat, args.stages)
+        measurements = prepare_measurements(log_filepath)
+    print(format_results(results, len(measurements), measurements['Epoch'].nunique()))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'log': args.log, 'duration': args.duration, 'rate': args.rate, 'satellites': args.satellites,
+                       'repeat': args.repeat, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
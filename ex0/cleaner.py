@@ -1,7 +1,9 @@
 import os
 
 def clean_files():
-    files_to_delete = ['satellites_positions_with_estimated_location.csv', 'satellites_positions.csv', 'coordinates.kml']
+    files_to_delete = ['coordinates.kml', 'coordinates.geojson', 'coordinates.gpx', 'profile.json']
+    for extension in ['.csv', '.parquet', '.arrow']:
+        files_to_delete += ['satellites_positions_with_estimated_location' + extension, 'satellites_positions' + extension]
     for file_name in files_to_delete:
         try:
             os.remove(file_name)
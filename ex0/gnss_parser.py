@@ -1,113 +1,262 @@
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
-import sys, os, csv
+import sys, os, csv, io, glob, argparse, time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
 import navpy
 
-from gnssutils import EphemerisManager
-import simplekml
+from gnssutils import EphemerisManager, EpochCache
+from gnssutils.ephemeris_sources import open_source, EphemerisNotFound
+from gnssutils.corrections import correction_geometry, total_delay, CORRECTION_MODELS
+from gnssutils.glonass import glonass_satellite_states, GLONASS_UTC_OFFSET
+from gnssutils.log_stream import open_line_source
+from gnssutils.profiler import Profiler
+from gnssutils.track_writer import open_track_writer, TRACK_MODES, TRACK_WRITERS
+
+# Epochs kept by the satellite state cache shared by clause2 and the solvers of calculate_fixes (two hours of 1 Hz data)
+EPOCH_CACHE_SIZE = 7200
 
 parent_directory = os.path.split(os.getcwd())[0]
 ephemeris_data_directory = os.path.join(parent_directory, 'data')
 manager = EphemerisManager(ephemeris_data_directory)
+epoch_cache = EpochCache(EPOCH_CACHE_SIZE)
+# Disabled unless --profile is given, the stages below then cost nothing but a flag check
+profiler = Profiler()
 
 sys.path.insert(0, parent_directory)
 WEEKSEC = 604800
 LIGHTSPEED = 2.99792458e8
+# Rows buffered per batch by the streaming log reader
+LOG_BATCH_ROWS = 100000
+# Bytes read from the end of a log to find its last epoch, enough for a full epoch of every constellation
+LOG_TAIL_BYTES = 256 * 1024
+# Log columns that hold text, every other column is parsed as a number
+LOG_TEXT_COLUMNS = {'CodeType', 'Provider'}
+# Declared dtypes of the GnssLogger Raw record: int64 nanosecond counters, float32 where the logged
+# precision allows it and small ints/categories for satellite ids. An integer column that holds blanks
+# falls back to the nullable pandas type of the same width (Int64, Int16, ...)
+RAW_SCHEMA = {
+    'utcTimeMillis': 'int64', 'TimeNanos': 'int64', 'LeapSecond': 'int8', 'TimeUncertaintyNanos': 'float32',
+    'FullBiasNanos': 'int64', 'BiasNanos': 'float64', 'BiasUncertaintyNanos': 'float32',
+    'DriftNanosPerSecond': 'float64', 'DriftUncertaintyNanosPerSecond': 'float32',
+    'HardwareClockDiscontinuityCount': 'int32', 'Svid': 'int16', 'TimeOffsetNanos': 'float64', 'State': 'int32',
+    'ReceivedSvTimeNanos': 'int64', 'ReceivedSvTimeUncertaintyNanos': 'float32', 'Cn0DbHz': 'float32',
+    'PseudorangeRateMetersPerSecond': 'float64', 'PseudorangeRateUncertaintyMetersPerSecond': 'float32',
+    'AccumulatedDeltaRangeState': 'int32', 'AccumulatedDeltaRangeMeters': 'float64',
+    'AccumulatedDeltaRangeUncertaintyMeters': 'float32', 'CarrierFrequencyHz': 'float64', 'CarrierCycles': 'float64',
+    'CarrierPhase': 'float64', 'CarrierPhaseUncertainty': 'float32', 'MultipathIndicator': 'int8', 'SnrInDb': 'float32',
+    'ConstellationType': 'int8', 'AgcDb': 'float32', 'BasebandCn0DbHz': 'float32',
+    'FullInterSignalBiasNanos': 'float32', 'FullInterSignalBiasUncertaintyNanos': 'float32',
+    'SatelliteInterSignalBiasNanos': 'float32', 'SatelliteInterSignalBiasUncertaintyNanos': 'float32',
+    'CodeType': 'category', 'ChipsetElapsedRealtimeNanos': 'int64'}
+LOG_SCHEMAS = {'Raw': RAW_SCHEMA}
+# GnssLogger ConstellationType to RINEX system letter, and the offset from the Android Svid to the RINEX PRN
+CONSTELLATION_LETTERS = {1: 'G', 2: 'S', 3: 'R', 4: 'J', 5: 'C', 6: 'E', 7: 'I'}
+SVID_OFFSETS = {2: 100, 4: 192}
+# Systems with a broadcast orbit model, Keplerian or the GLONASS state vectors
+SUPPORTED_CONSTELLATIONS = ('G', 'R', 'E', 'C', 'J')
+# Only the GPS navigation file ships with the repo, other systems need the combined multi-GNSS file
+DEFAULT_CONSTELLATIONS = ('G',)
+# Gravitational constant and earth rotation rate each system's ICD uses with its broadcast ephemeris
+SYSTEM_CONSTANTS = {'G': (3.986005e14, 7.2921151467e-5), 'J': (3.986005e14, 7.2921151467e-5),
+                    'E': (3.986004418e14, 7.2921151467e-5), 'C': (3.986004418e14, 7.292115e-5)}
+# Seconds to add to a system's time to get GPS time (BDT = GPST - 14 s), the others are aligned with GPS time
+SYSTEM_TIME_OFFSETS = {'C': 14.0}
+# BeiDou geostationary satellites use a different orbit to ECEF rotation
+BEIDOU_GEO_PRNS = set(range(1, 6)) | set(range(59, 64))
+# Longest plausible pseudorange (seconds), BeiDou GEO/IGSO satellites orbit at ~36000 km
+MAX_PSEUDORANGE_SECONDS = 0.1
+SYSTEM_MAX_PSEUDORANGE_SECONDS = {'C': 0.15}
+# GPS - UTC, used when neither the log nor the navigation file states the leap seconds
+GPS_UTC_LEAP_SECONDS = 18
+# GLONASS records are centered on their reference time, so look the record up a quarter hour ahead to
+# get the nearest one instead of the last one
+GLONASS_EPHEMERIS_LOOKAHEAD = np.timedelta64(15, 'm')
+KEPLER_MAX_ITERATIONS = 10
+# Gauss-Newton stops once the position update is below LS_TOLERANCE meters or after LS_MAX_ITERATIONS
+LS_MAX_ITERATIONS = 20
+LS_TOLERANCE = 1e-3
+# RAIM: false alarm rate of the chi-square residual test as a one sided normal quantile (3.09 is 1e-3) and the
+# most satellites excluded from one epoch
+RAIM_FALSE_ALARM_Z = 3.09
+RAIM_MAX_EXCLUSIONS = 2
+# Pseudorange noise models for the weighted solvers: a constant sigma (m), sigma^2 = a + b * 10^(-C/N0 / 10)
+# (m^2) and the floor applied to sigmas taken from ReceivedSvTimeUncertaintyNanos (m)
+PSEUDORANGE_SIGMA = 5.0
+CN0_VARIANCE_MODEL = (1.0, 1e6)
+MIN_PSEUDORANGE_SIGMA = 1.0
+# Epochs solved together by solve_epochs, each block is warm started from the last fix of the previous one
+LS_BLOCK_EPOCHS = 64
+# Output table formats and their file extensions
+OUTPUT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+SATELLITE_STATE_COLUMNS = ['GPS time', 'Sat.bias', 'Sat.X', 'Sat.Y', 'Sat.Z']
+SATELLITE_VELOCITY_COLUMNS = ['Sat.VX', 'Sat.VY', 'Sat.VZ', 'Sat.drift']
+# Time step (seconds) of the central differences that give satellite velocity and clock drift
+SATELLITE_VELOCITY_STEP = 1.0
+# Extended Kalman filter tuning: white acceleration (m/s^2 per sqrt(s)) driving the receiver velocity, random
+# walks of the receiver clock bias (m per sqrt(s)), clock drift (m/s per sqrt(s)) and inter-system biases,
+# and the measurement noise of pseudoranges (m) and pseudorange rates (m/s)
+EKF_ACCELERATION_NOISE = 1.0
+EKF_CLOCK_BIAS_NOISE = 10.0
+EKF_CLOCK_DRIFT_NOISE = 1.0
+EKF_ISB_NOISE = 0.1
+EKF_PSEUDORANGE_SIGMA = 5.0
+EKF_RANGE_RATE_SIGMA = 0.5
+# Measurements whose innovation is beyond this many sigmas are left out of the update
+EKF_INNOVATION_GATE = 5.0
+SOLVERS = ('ls', 'ekf')
+# A new epoch starts where consecutive Raw rows are more than this apart
+EPOCH_GAP = timedelta(milliseconds=200)
+# In follow mode an epoch also closes once no line arrived for this many seconds
+STREAM_EPOCH_TIMEOUT = 0.5
+FOLLOW_COLUMNS = ['Epoch', 'UnixTime', 'Lat', 'Lon', 'Alt', 'Pos.X', 'Pos.Y', 'Pos.Z', 'Clock bias', 'Residual']
 
 
 ################################
 # Help functions
 ################################
 
-def calculate_locations_data_frame(ecef_list_with_times):
-    locations_df = []
-    # Iterate over each tuple in ecef_list_with_times
-    for (coord, time) in ecef_list_with_times:
-        # Convert ECEF coordinates to LLA coordinates
-        lla_coords = navpy.ecef2lla(coord)
-        
-        # Extract individual components
-        lla_lat = lla_coords[0]
-        lla_lon = lla_coords[1]
-        lla_alt = lla_coords[2]
-        ecef_x = coord[0]
-        ecef_y = coord[1]
-        ecef_z = coord[2]
-        
-        # Create a tuple with the required components
-        row = (time, ecef_x, ecef_y, ecef_z, lla_lat, lla_lon, lla_alt)
-        # Append the tuple to the locations_df list
-        locations_df.append(row)
-    return pd.DataFrame(locations_df, columns=["GPS time", "Pos.X", "Pos.Y", "Pos.Z", "Lat", "Lon", "Alt"],index=None)
+def ecef_to_lla(ecef_positions):
+    # One navpy call over the whole (N, 3) array, returns an (N, 3) array of latitude, longitude (degrees) and altitude
+    ecef_positions = np.asarray(ecef_positions, dtype=float).reshape(-1, 3)
+    if len(ecef_positions) == 0:
+        return np.empty((0, 3))
+    lat, lon, alt = navpy.ecef2lla(ecef_positions)
+    return np.column_stack((np.atleast_1d(lat), np.atleast_1d(lon), np.atleast_1d(alt)))
 
-def calculate_satellite_position(ephemeris, transmit_time, one_epoch):
-    earth_gravity = 3.986005e14
-    Earth_angular_velocity = 7.2921151467e-5 
-    relativistic_correction_factor  = -4.442807633e-10 # used to relativistic correction to the satellite's clock
-    sv_position = pd.DataFrame()
-    sv_position['satPRN'] = ephemeris.index
-    sv_position.set_index('satPRN', inplace=True)
-    sv_position['GPS time'] = transmit_time - ephemeris['t_oe']
-    A = ephemeris['sqrtA'].pow(2)
-    n_0 = np.sqrt(earth_gravity / A.pow(3))
-    n = n_0 + ephemeris['deltaN']
-    M_k = ephemeris['M_0'] + n * sv_position['GPS time']
-    E_k = M_k
-    err = pd.Series(data=[1]*len(sv_position.index))
-    i = 0
-    while err.abs().min() > 1e-8 and i < 10:
-        new_vals = M_k + ephemeris['e']*np.sin(E_k)
-        err = new_vals - E_k
-        E_k = new_vals
-        i += 1
-        
-    sinE_k = np.sin(E_k)
-    cosE_k = np.cos(E_k)
-    delT_r = relativistic_correction_factor  * ephemeris['e'].pow(ephemeris['sqrtA']) * sinE_k
-    delT_oc = transmit_time - ephemeris['t_oc']
-    sv_position['Sat.bias'] = ephemeris['SVclockBias'] + ephemeris['SVclockDrift'] * delT_oc + ephemeris['SVclockDriftRate'] * delT_oc.pow(2)
+def calculate_locations_data_frame(ecef_list_with_times, lla=None):
+    ecef = np.array([coord for (coord, time) in ecef_list_with_times], dtype=float).reshape(-1, 3)
+    times = [time for (coord, time) in ecef_list_with_times]
+    # Reuse the geodetic coordinates when the caller already converted the fixes
+    if lla is None:
+        lla = ecef_to_lla(ecef)
+    return pd.DataFrame({"GPS time": times, "Pos.X": ecef[:, 0], "Pos.Y": ecef[:, 1], "Pos.Z": ecef[:, 2],
+                         "Lat": lla[:, 0], "Lon": lla[:, 1], "Alt": lla[:, 2]})
+
+def calculate_satellite_positions(epochs, satellites, transmit_times, ephemeris):
+    """Compute satellite ECEF positions and clock bias for a whole log in one array pass.
 
-    v_k = np.arctan2(np.sqrt(1-ephemeris['e'].pow(2))*sinE_k,(cosE_k - ephemeris['e']))
+    epochs, satellites and transmit_times describe one measurement row each and ephemeris holds the
+    ephemeris row matched to every measurement row (same length and order). Returns a DataFrame with
+    one row per input row. GLONASS rows are propagated from their broadcast state vectors, every other
+    system uses the Keplerian model.
+    """
+    satellites = np.asarray(satellites, dtype=object)
+    # Casting to a one character string keeps just the system letter
+    systems = satellites.astype('U1')
+    transmit_times = np.asarray(transmit_times, dtype=float)
+    t_k = np.full(len(satellites), np.nan)
+    sat_bias = np.full(len(satellites), np.nan)
+    xyz = np.full((len(satellites), 3), np.nan)
+    glonass = systems == 'R'
+    kepler = ~glonass
+    if kepler.any() or not glonass.any():
+        rows = ephemeris if kepler.all() else ephemeris[kepler]
+        t_k[kepler], sat_bias[kepler], xyz[kepler] = calculate_kepler_states(satellites[kepler], systems[kepler], transmit_times[kepler], rows)
+    if glonass.any():
+        rows = ephemeris[glonass]
+        leap_seconds = rows['Leap Seconds'].fillna(GPS_UTC_LEAP_SECONDS) if 'Leap Seconds' in rows.columns else GPS_UTC_LEAP_SECONDS
+        t_k[glonass], sat_bias[glonass], xyz[glonass] = glonass_satellite_states(transmit_times[glonass], rows, leap_seconds)
 
-    Phi_k = v_k + ephemeris['omega']
+    sv_positions = pd.DataFrame({
+        'satPRN': satellites,
+        'GPS time': t_k,
+        'Sat.bias': sat_bias,
+        'Sat.X': xyz[:, 0],
+        'Sat.Y': xyz[:, 1],
+        'Sat.Z': xyz[:, 2],
+    })
+    if epochs is not None:
+        sv_positions.insert(0, 'Epoch', np.asarray(epochs))
+    return sv_positions
+
+def calculate_kepler_states(satellites, systems, transmit_times, ephemeris):
+    # Broadcast Keplerian orbits (GPS, Galileo, BeiDou, QZSS), returns time from toe, clock bias and (N, 3) positions
+    earth_gravity = np.full(len(systems), SYSTEM_CONSTANTS['G'][0])
+    Earth_angular_velocity = np.full(len(systems), SYSTEM_CONSTANTS['G'][1])
+    for system, (gravity, angular_velocity) in SYSTEM_CONSTANTS.items():
+        earth_gravity[systems == system] = gravity
+        Earth_angular_velocity[systems == system] = angular_velocity
+    t_oe = np.asarray(ephemeris['t_oe'], dtype=float)
+    e = np.asarray(ephemeris['e'], dtype=float)
+    t_k = transmit_times - t_oe
+    A = np.square(np.asarray(ephemeris['sqrtA'], dtype=float))
+    n_0 = np.sqrt(earth_gravity / A**3)
+    n = n_0 + np.asarray(ephemeris['deltaN'], dtype=float)
+    M_k = np.asarray(ephemeris['M_0'], dtype=float) + n * t_k
+
+    # Solve Kepler's equation for every row at once, rows stop updating once they converge
+    E_k = M_k.copy()
+    active = np.ones(E_k.shape, dtype=bool)
+    for _ in range(KEPLER_MAX_ITERATIONS):
+        new_vals = M_k[active] + e[active] * np.sin(E_k[active])
+        err = new_vals - E_k[active]
+        E_k[active] = new_vals
+        active[active] = np.abs(err) > 1e-8
+        if not active.any():
+            break
+
+    sinE_k = np.sin(E_k)
+    cosE_k = np.cos(E_k)
+    delT_oc = transmit_times - np.asarray(ephemeris['t_oc'], dtype=float)
+    sat_bias = np.asarray(ephemeris['SVclockBias'], dtype=float) + np.asarray(ephemeris['SVclockDrift'], dtype=float) * delT_oc \
+        + np.asarray(ephemeris['SVclockDriftRate'], dtype=float) * delT_oc**2
 
+    v_k = np.arctan2(np.sqrt(1 - e**2) * sinE_k, cosE_k - e)
+    Phi_k = v_k + np.asarray(ephemeris['omega'], dtype=float)
     sin2Phi_k = np.sin(2*Phi_k)
     cos2Phi_k = np.cos(2*Phi_k)
 
-    du_k = ephemeris['C_us']*sin2Phi_k + ephemeris['C_uc']*cos2Phi_k
-    dr_k = ephemeris['C_rs']*sin2Phi_k + ephemeris['C_rc']*cos2Phi_k
-    di_k = ephemeris['C_is']*sin2Phi_k + ephemeris['C_ic']*cos2Phi_k
+    du_k = np.asarray(ephemeris['C_us'], dtype=float)*sin2Phi_k + np.asarray(ephemeris['C_uc'], dtype=float)*cos2Phi_k
+    dr_k = np.asarray(ephemeris['C_rs'], dtype=float)*sin2Phi_k + np.asarray(ephemeris['C_rc'], dtype=float)*cos2Phi_k
+    di_k = np.asarray(ephemeris['C_is'], dtype=float)*sin2Phi_k + np.asarray(ephemeris['C_ic'], dtype=float)*cos2Phi_k
 
     u_k = Phi_k + du_k
-
-    r_k = A*(1 - ephemeris['e']*np.cos(E_k)) + dr_k
-
-    i_k = ephemeris['i_0'] + di_k + ephemeris['IDOT']*sv_position['GPS time']
+    r_k = A*(1 - e*cosE_k) + dr_k
+    i_k = np.asarray(ephemeris['i_0'], dtype=float) + di_k + np.asarray(ephemeris['IDOT'], dtype=float)*t_k
 
     x_k_prime = r_k*np.cos(u_k)
     y_k_prime = r_k*np.sin(u_k)
+    geo = systems == 'C'
+    geo[geo] = [int(satellite[1:]) in BEIDOU_GEO_PRNS for satellite in satellites[geo]]
+    Omega_dot = np.asarray(ephemeris['OmegaDot'], dtype=float)
+    # A BeiDou GEO orbit is computed in an inertial frame and rotated to ECEF afterwards
+    Omega_k = np.asarray(ephemeris['Omega_0'], dtype=float) \
+        + (Omega_dot - np.where(geo, 0, Earth_angular_velocity))*t_k - Earth_angular_velocity*t_oe
 
-    Omega_k = ephemeris['Omega_0'] + (ephemeris['OmegaDot'] - Earth_angular_velocity)*sv_position['GPS time'] - Earth_angular_velocity*ephemeris['t_oe']
+    x = x_k_prime*np.cos(Omega_k) - y_k_prime*np.cos(i_k)*np.sin(Omega_k)
+    y = x_k_prime*np.sin(Omega_k) + y_k_prime*np.cos(i_k)*np.cos(Omega_k)
+    z = y_k_prime*np.sin(i_k)
+    if geo.any():
+        tilt = np.radians(-5)
+        y_tilted = np.cos(tilt)*y[geo] + np.sin(tilt)*z[geo]
+        z_tilted = -np.sin(tilt)*y[geo] + np.cos(tilt)*z[geo]
+        rotation = Earth_angular_velocity[geo]*t_k[geo]
+        x[geo], y[geo] = np.cos(rotation)*x[geo] + np.sin(rotation)*y_tilted, -np.sin(rotation)*x[geo] + np.cos(rotation)*y_tilted
+        z[geo] = z_tilted
+    return t_k, sat_bias, np.column_stack((x, y, z))
 
-    sv_position['Sat.X'] = x_k_prime*np.cos(Omega_k) - y_k_prime*np.cos(i_k)*np.sin(Omega_k)
-    sv_position['Sat.Y'] = x_k_prime*np.sin(Omega_k) + y_k_prime*np.cos(i_k)*np.cos(Omega_k)
-    sv_position['Sat.Z'] = y_k_prime*np.sin(i_k)
+def calculate_satellite_position(ephemeris, transmit_time, one_epoch):
+    if np.isscalar(transmit_time):
+        transmit_time = pd.Series(transmit_time, index=ephemeris.index)
+    transmit_time = transmit_time.reindex(ephemeris.index)
+    sv_position = calculate_satellite_positions(None, ephemeris.index, transmit_time, ephemeris)
+    sv_position.set_index('satPRN', inplace=True)
     sv_position["pseudorange"] = one_epoch["Pseudorange_Measurement"] + LIGHTSPEED * sv_position['Sat.bias']
     sv_position["cn0"] = one_epoch["Cn0DbHz"]
     
     return sv_position
 
-def least_squares(receiver_positions, measured_pseudorange, initial_receiver_position, initial_clock_bias):
+def least_squares(receiver_positions, measured_pseudorange, initial_receiver_position, initial_clock_bias, max_iterations=LS_MAX_ITERATIONS):
     position_change = 100 * np.ones(3)  # Change in position
     clock_bias = initial_clock_bias
     # Set up the G matrix with the right dimensions. We will later replace the first 3 columns
     # Note that clock_bias here is the clock bias in meters equivalent, so the actual clock bias is clock_bias / LIGHTSPEED
     G = np.ones((measured_pseudorange.size, 4))
     iterations = 0
-    while np.linalg.norm(position_change) > 1e-3:
+    while np.linalg.norm(position_change) > LS_TOLERANCE and iterations < max_iterations:
         # Eq. (2):
         distances = np.linalg.norm(receiver_positions - initial_receiver_position, axis=1)
         # Eq. (1):
@@ -116,47 +265,417 @@ def least_squares(receiver_positions, measured_pseudorange, initial_receiver_pos
         delta_pseudorange = measured_pseudorange - estimated_pseudorange
         G[:, 0:3] = -(receiver_positions - initial_receiver_position) / distances[:, None]
         # Eq. (4):
-        solution = np.linalg.inv(np.transpose(G) @ G) @ np.transpose(G) @ delta_pseudorange
+        solution = np.linalg.solve(np.transpose(G) @ G, np.transpose(G) @ delta_pseudorange)
         # Eq. (5):
         position_change = solution[0:3]
         clock_bias_change = solution[3]
         initial_receiver_position = initial_receiver_position + position_change
         initial_clock_bias = initial_clock_bias + clock_bias_change
+        iterations += 1
     norm_delta_pseudorange = np.linalg.norm(delta_pseudorange)
     return initial_receiver_position, initial_clock_bias, norm_delta_pseudorange
 
-def create_kml_file(coords):
-    output_file = "coordinates.kml"
-    kml = simplekml.Kml()
-    for coord in coords:
-        lat, lon, alt = coord
-        kml.newpoint(name="", coords=[(lon, lat, alt)])
-    kml.save(output_file)
+def batch_least_squares(satellite_positions, measured_pseudoranges, initial_positions, initial_clock_biases, max_iterations=LS_MAX_ITERATIONS,
+                        systems=None, weights=None, raim=False):
+    """Run Gauss-Newton on a stack of E epochs that all have N satellites.
 
-def log_to_measurment(input_filepath):
-    with open(input_filepath) as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            if row[0][0] == '#':
-                if 'Fix' in row[0]:
-                    android_fixes = [row[1:]]
-                elif 'Raw' in row[0]:
-                    measurements = [row[1:]]
+    satellite_positions is (E, N, 3), measured_pseudoranges (E, N), initial_positions (E, 3) and
+    initial_clock_biases (E,). Every epoch iterates until its own position update is below LS_TOLERANCE
+    or max_iterations is reached; epochs with degenerate geometry are dropped from the iteration instead
+    of raising for the whole stack. Returns positions, clock biases, residual norms and a converged mask.
+
+    For several constellations pass systems, an (E, N) array of system indices 0..S-1, and (E, S) initial
+    clock biases: column 0 is the receiver clock and column k the inter-system bias of system k against
+    system 0. The clock biases are then returned as (E, S); the bias of a system absent from an epoch
+    keeps its initial value.
+
+    weights (E, N) are the inverse pseudorange variances (1/m^2, see WEIGHTING_MODELS), a weight of 0 leaves
+    a satellite out. With raim every converged epoch is checked with a chi-square test of its weighted
+    residuals; an epoch that fails gets the weight of its worst satellite zeroed and goes back into the same
+    iteration loop, up to RAIM_MAX_EXCLUSIONS times. An (E, N) mask of the excluded satellites is then
+    returned as a fifth value.
+    """
+    satellite_positions = np.asarray(satellite_positions, dtype=float)
+    measured_pseudoranges = np.asarray(measured_pseudoranges, dtype=float)
+    positions = np.array(initial_positions, dtype=float)
+    clock_biases = np.array(initial_clock_biases, dtype=float)
+    num_epochs = len(positions)
+    single_system = clock_biases.ndim == 1
+    clock_biases = clock_biases.reshape(num_epochs, -1)
+    num_systems = clock_biases.shape[1]
+    if systems is None:
+        systems = np.zeros(measured_pseudoranges.shape, dtype=int)
+    weights = np.ones(measured_pseudoranges.shape) if weights is None else np.array(weights, dtype=float)
+    initially_used = weights > 0
+    # Clock columns of the design matrix: the receiver clock for every satellite plus one indicator per extra system
+    membership = np.asarray(systems)[..., None] == np.arange(num_systems)
+    clock_design = np.concatenate((np.ones(membership.shape[:2] + (1,)), membership[..., 1:]), axis=2)
+    exclusions = np.zeros(num_epochs, dtype=int)
+    converged = np.zeros(num_epochs, dtype=bool)
+    active = np.ones(num_epochs, dtype=bool)
+    for _ in range(max_iterations * (1 + (RAIM_MAX_EXCLUSIONS if raim else 0))):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        epoch_weights = weights[idx]
+        present = (membership[idx] & (epoch_weights > 0)[..., None]).any(axis=1)
+        present[:, 0] = True
+        # A system without satellites in an epoch leaves an empty column, a unit diagonal term pins its update to 0
+        absent_diagonal = np.zeros((idx.size, 3 + num_systems, 3 + num_systems))
+        absent_diagonal[:, np.arange(3, 3 + num_systems), np.arange(3, 3 + num_systems)] = ~present
+        offsets = satellite_positions[idx] - positions[idx, None, :]
+        distances = np.linalg.norm(offsets, axis=2)
+        delta_pseudorange = measured_pseudoranges[idx] - (distances + (clock_design[idx] @ clock_biases[idx, :, None])[..., 0])
+        G = np.concatenate((-offsets / distances[..., None], clock_design[idx]), axis=2)
+        GTW = np.swapaxes(G, 1, 2) * epoch_weights[:, None, :]
+        normal = GTW @ G + absent_diagonal
+        solvable = (np.linalg.matrix_rank(G * np.sqrt(epoch_weights)[..., None]) == 3 + present.sum(axis=1)) \
+            & np.isfinite(normal).all(axis=(1, 2))
+        active[idx[~solvable]] = False
+        idx = idx[solvable]
+        solution = np.linalg.solve(normal[solvable], (GTW[solvable] @ delta_pseudorange[solvable, :, None]))[..., 0]
+        positions[idx] += solution[:, 0:3]
+        clock_biases[idx] += solution[:, 3:]
+        done = idx[np.linalg.norm(solution[:, 0:3], axis=1) <= LS_TOLERANCE]
+        converged[done] = True
+        active[done] = False
+        if raim and done.size:
+            # Fault detection on the epochs that just converged, exclusion of the largest normalized residual
+            distances = np.linalg.norm(satellite_positions[done] - positions[done, None, :], axis=2)
+            residuals = measured_pseudoranges[done] - (distances + (clock_design[done] @ clock_biases[done, :, None])[..., 0])
+            test = weights[done] * residuals**2
+            used = weights[done] > 0
+            unknowns = 3 + (membership[done] & used[..., None]).any(axis=1)[:, 1:].sum(axis=1) + 1
+            dof = used.sum(axis=1) - unknowns
+            failed = (dof >= 2) & (test.sum(axis=1) > chi_square_threshold(np.maximum(dof, 1))) & (exclusions[done] < RAIM_MAX_EXCLUSIONS)
+            failed_epochs = done[failed]
+            weights[failed_epochs, np.argmax(test[failed], axis=1)] = 0
+            exclusions[failed_epochs] += 1
+            converged[failed_epochs] = False
+            active[failed_epochs] = True
+    used = weights > 0
+    distances = np.linalg.norm(satellite_positions - positions[:, None, :], axis=2)
+    residuals = measured_pseudoranges - (distances + (clock_design @ clock_biases[..., None])[..., 0])
+    residual_norms = np.sqrt(np.where(used, residuals**2, 0).sum(axis=1))
+    results = (positions, clock_biases[:, 0] if single_system else clock_biases, residual_norms, converged)
+    return results + (initially_used & ~used,) if raim else results
+
+def chi_square_threshold(dof):
+    # Wilson-Hilferty approximation of the chi-square quantile for the RAIM false alarm rate, no scipy needed
+    dof = np.asarray(dof, dtype=float)
+    return dof * (1 - 2 / (9 * dof) + RAIM_FALSE_ALARM_Z * np.sqrt(2 / (9 * dof)))**3
+
+def satellite_system_indices(satellites):
+    # Systems present in satellites (GPS first, it is the clock reference) and the index of every satellite's system
+    satellite_systems = np.asarray(satellites, dtype=object).astype('U1')
+    names, inverse = np.unique(satellite_systems, return_inverse=True)
+    system_names = sorted(names, key=lambda system: (system != 'G', system))
+    return system_names, np.array([system_names.index(name) for name in names], dtype=int)[inverse]
+
+def solve_epochs(sv_positions, initial_position=(0, 0, 0), initial_clock_bias=0, max_iterations=LS_MAX_ITERATIONS, block_epochs=LS_BLOCK_EPOCHS,
+                 weights=None, raim=False):
+    """Solve the receiver position of every epoch in sv_positions (rows grouped by Epoch).
+
+    Epochs are processed in chronological blocks of block_epochs. Inside a block the epochs with the same
+    satellite count are stacked and solved with batch_least_squares, all starting from the last converged
+    fix of the previous block. Returns one row per epoch with the fix and a Converged flag. When the
+    satellites come from several systems the clock is referenced to GPS (or the first system present) and
+    every other system gets an 'ISB.<system>' column, NaN for the epochs it is absent from.
+
+    weights (one per row, see pseudorange_weights) turn every solve into weighted least squares and raim
+    enables the residual test of batch_least_squares, which adds an 'Excluded' column with the number of
+    satellites dropped from each epoch.
+    """
+    epochs = sv_positions['Epoch'].to_numpy()
+    satellites_xyz = sv_positions[['Sat.X', 'Sat.Y', 'Sat.Z']].to_numpy(dtype=float)
+    pseudoranges = sv_positions['pseudorange'].to_numpy(dtype=float)
+    system_names, systems = satellite_system_indices(sv_positions['satPRN'])
+    starts = np.flatnonzero(np.concatenate(([True], epochs[1:] != epochs[:-1]))) if len(epochs) else np.array([], dtype=int)
+    counts = np.diff(np.concatenate((starts, [len(epochs)])))
+    num_systems = max(len(system_names), 1)
+
+    positions = np.full((len(starts), 3), np.nan)
+    clock_biases = np.full((len(starts), num_systems), np.nan)
+    residual_norms = np.full(len(starts), np.nan)
+    converged = np.zeros(len(starts), dtype=bool)
+    excluded = np.zeros(len(epochs), dtype=bool)
+    weights = None if weights is None else np.asarray(weights, dtype=float)
+    current_position = np.asarray(initial_position, dtype=float)
+    current_bias = np.zeros(num_systems)
+    current_bias[0] = float(initial_clock_bias)
+    for block_start in range(0, len(starts), block_epochs):
+        block = np.arange(block_start, min(block_start + block_epochs, len(starts)))
+        for count in np.unique(counts[block]):
+            group = block[counts[block] == count]
+            rows = starts[group, None] + np.arange(count)
+            results = batch_least_squares(satellites_xyz[rows], pseudoranges[rows],
+                                          np.tile(current_position, (len(group), 1)), np.tile(current_bias, (len(group), 1)),
+                                          max_iterations, systems[rows], None if weights is None else weights[rows], raim)
+            positions[group], clock_biases[group], residual_norms[group], converged[group] = results[:4]
+            if raim:
+                excluded[rows] = results[4]
+        solved = block[converged[block]]
+        if solved.size:
+            current_position = positions[solved[-1]]
+            current_bias = clock_biases[solved[-1]]
+
+    fixes = pd.DataFrame({'Epoch': epochs[starts], 'Pos.X': positions[:, 0], 'Pos.Y': positions[:, 1], 'Pos.Z': positions[:, 2],
+                          'Clock bias': clock_biases[:, 0], 'Residual': residual_norms, 'Converged': converged})
+    if raim:
+        fixes['Excluded'] = np.add.reduceat(excluded, starts) if len(starts) else np.array([], dtype=int)
+    if num_systems > 1:
+        epoch_index = np.repeat(np.arange(len(starts)), counts)
+        for system in range(1, num_systems):
+            present = np.zeros(len(starts), dtype=bool)
+            present[epoch_index[systems == system]] = True
+            fixes['ISB.' + system_names[system]] = np.where(present, clock_biases[:, system], np.nan)
+    return fixes
+
+def filter_epochs(sv_positions, epoch_times, weights=None):
+    """Track the receiver through the epochs of sv_positions with an extended Kalman filter.
+
+    The state holds position, velocity, receiver clock bias and drift (meters, m/s) plus an inter-system bias
+    per extra constellation. Every epoch is one constant velocity prediction over the time since the previous
+    epoch (epoch_times, indexed by Epoch) and one update with all its pseudoranges and pseudorange rates,
+    sv_positions needs the columns of calculate_epoch_satellite_positions(velocities=True). The filter starts
+    from a least squares fix of the first epoch that has one. Returns the solve_epochs columns plus velocity
+    and clock drift. weights (see pseudorange_weights) replace EKF_PSEUDORANGE_SIGMA as the pseudorange noise.
+    """
+    epochs = sv_positions['Epoch'].to_numpy()
+    satellites_xyz = sv_positions[['Sat.X', 'Sat.Y', 'Sat.Z']].to_numpy(dtype=float)
+    satellites_velocity = sv_positions[['Sat.VX', 'Sat.VY', 'Sat.VZ']].to_numpy(dtype=float)
+    pseudoranges = sv_positions['pseudorange'].to_numpy(dtype=float)
+    rates = sv_positions['pseudorange_rate'].to_numpy(dtype=float)
+    variances = np.full(len(epochs), EKF_PSEUDORANGE_SIGMA**2) if weights is None else 1 / np.asarray(weights, dtype=float)
+    system_names, systems = satellite_system_indices(sv_positions['satPRN'])
+    num_systems = max(len(system_names), 1)
+    starts = np.flatnonzero(np.concatenate(([True], epochs[1:] != epochs[:-1]))) if len(epochs) else np.array([], dtype=int)
+    stops = np.concatenate((starts[1:], [len(epochs)]))
+    times = pd.to_datetime(pd.Series(epoch_times).reindex(epochs[starts]), utc=True)
+    times = (times - times.iloc[0]).dt.total_seconds().to_numpy() if len(starts) else np.array([])
+
+    # State layout: position 0-2, velocity 3-5, clock bias 6, clock drift 7, inter-system biases 8...
+    num_states = 8 + num_systems - 1
+    states = np.full((len(starts), num_states), np.nan)
+    residual_norms = np.full(len(starts), np.nan)
+    converged = np.zeros(len(starts), dtype=bool)
+    x = None
+    for epoch in range(len(starts)):
+        rows = np.arange(starts[epoch], stops[epoch])
+        if x is not None:
+            dt = times[epoch] - times[epoch - 1]
+            F = np.eye(num_states)
+            F[0:3, 3:6] = np.eye(3) * dt
+            F[6, 7] = dt
+            q = EKF_ACCELERATION_NOISE**2
+            Q = np.zeros((num_states, num_states))
+            Q[0:3, 0:3] = np.eye(3) * q * dt**3 / 3
+            Q[0:3, 3:6] = Q[3:6, 0:3] = np.eye(3) * q * dt**2 / 2
+            Q[3:6, 3:6] = np.eye(3) * q * dt
+            Q[6, 6] = EKF_CLOCK_BIAS_NOISE**2 * dt + EKF_CLOCK_DRIFT_NOISE**2 * dt**3 / 3
+            Q[6, 7] = Q[7, 6] = EKF_CLOCK_DRIFT_NOISE**2 * dt**2 / 2
+            Q[7, 7] = EKF_CLOCK_DRIFT_NOISE**2 * dt
+            Q[8:, 8:] = np.eye(num_systems - 1) * EKF_ISB_NOISE**2 * dt
+            predicted_x = F @ x
+            predicted_P = F @ P @ F.T + Q
+            update = kalman_update(predicted_x, predicted_P, satellites_xyz[rows], satellites_velocity[rows], pseudoranges[rows],
+                                   rates[rows], systems[rows], num_systems, variances[rows])
+            # Most pseudoranges failing the gate means the filter lost the receiver (or its clock jumped), start over
+            if update is None:
+                x = None
             else:
-                if row[0] == 'Fix':
-                    android_fixes.append(row[1:])
-                elif row[0] == 'Raw':
-                    measurements.append(row[1:])
+                x, P = update
+        if x is None:
+            initial = initial_filter_state(sv_positions.iloc[rows], satellites_velocity[rows], rates[rows], system_names)
+            if initial is None:
+                continue
+            x, P = initial
+            update = kalman_update(x, P, satellites_xyz[rows], satellites_velocity[rows], pseudoranges[rows],
+                                   rates[rows], systems[rows], num_systems, variances[rows])
+            if update is not None:
+                x, P = update
+
+        states[epoch] = x
+        ranges = np.linalg.norm(satellites_xyz[rows] - x[0:3], axis=1)
+        system_columns = (systems[rows, None] == np.arange(1, num_systems)).astype(float)
+        residual_norms[epoch] = np.linalg.norm(pseudoranges[rows] - (ranges + x[6] + system_columns @ x[8:]))
+        converged[epoch] = True
+
+    fixes = pd.DataFrame({'Epoch': epochs[starts], 'Pos.X': states[:, 0], 'Pos.Y': states[:, 1], 'Pos.Z': states[:, 2],
+                          'Vel.X': states[:, 3], 'Vel.Y': states[:, 4], 'Vel.Z': states[:, 5],
+                          'Clock bias': states[:, 6], 'Clock drift': states[:, 7], 'Residual': residual_norms, 'Converged': converged})
+    for system in range(1, num_systems):
+        fixes['ISB.' + system_names[system]] = states[:, 7 + system]
+    return fixes
+
+def initial_filter_state(sv_positions, satellites_velocity, rates, system_names):
+    # Filter state and covariance from a least squares fix of one epoch, velocity and drift from a linear fit of its rates
+    fix = solve_epochs(sv_positions)
+    if not fix['Converged'].iloc[0]:
+        return None
+    num_systems = max(len(system_names), 1)
+    x = np.zeros(8 + num_systems - 1)
+    x[0:3] = fix[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy()[0]
+    x[6] = fix['Clock bias'].iloc[0]
+    for system in range(1, num_systems):
+        column = 'ISB.' + system_names[system]
+        if column in fix.columns and np.isfinite(fix[column].iloc[0]):
+            x[7 + system] = fix[column].iloc[0]
+    lines_of_sight = sv_positions[['Sat.X', 'Sat.Y', 'Sat.Z']].to_numpy(dtype=float) - x[0:3]
+    lines_of_sight /= np.linalg.norm(lines_of_sight, axis=1)[:, None]
+    valid = np.isfinite(rates)
+    if valid.sum() >= 4:
+        design = np.column_stack((-lines_of_sight[valid], np.ones(valid.sum())))
+        observed = rates[valid] - np.einsum('ij,ij->i', satellites_velocity[valid], lines_of_sight[valid])
+        x[[3, 4, 5, 7]] = np.linalg.lstsq(design, observed, rcond=None)[0]
+    P = np.diag(np.r_[[EKF_PSEUDORANGE_SIGMA**2] * 3, [EKF_RANGE_RATE_SIGMA**2] * 3, EKF_PSEUDORANGE_SIGMA**2,
+                      EKF_RANGE_RATE_SIGMA**2, [EKF_PSEUDORANGE_SIGMA**2] * (num_systems - 1)]) * 100
+    return x, P
+
+def kalman_update(x, P, satellites_xyz, satellites_velocity, pseudoranges, rates, systems, num_systems, variances=None):
+    """One EKF update with the pseudoranges and the available pseudorange rates of an epoch, linearized once at x.
 
-    android_fixes = pd.DataFrame(android_fixes[1:], columns = android_fixes[0])
-    measurements = pd.DataFrame(measurements[1:], columns = measurements[0])
-    return measurements, android_fixes
+    variances are the pseudorange noise variances (m^2), EKF_PSEUDORANGE_SIGMA squared when None.
+    Measurements beyond EKF_INNOVATION_GATE sigmas are dropped first; returns the updated (x, P), or None when
+    more than half of the pseudoranges fail the gate.
+    """
+    offsets = satellites_xyz - x[0:3]
+    ranges = np.linalg.norm(offsets, axis=1)
+    lines_of_sight = offsets / ranges[:, None]
+    system_columns = (systems[:, None] == np.arange(1, num_systems)).astype(float)
+    valid = np.isfinite(rates)
+    count = len(pseudoranges)
+    H = np.zeros((count + valid.sum(), len(x)))
+    H[:count, 0:3] = -lines_of_sight
+    H[:count, 6] = 1
+    H[:count, 8:] = system_columns
+    H[count:, 3:6] = -lines_of_sight[valid]
+    H[count:, 7] = 1
+    predicted = np.r_[ranges + x[6] + system_columns @ x[8:],
+                      np.einsum('ij,ij->i', satellites_velocity[valid] - x[3:6], lines_of_sight[valid]) + x[7]]
+    innovation = np.r_[pseudoranges, rates[valid]] - predicted
+    if variances is None:
+        variances = np.full(count, EKF_PSEUDORANGE_SIGMA**2)
+    R = np.diag(np.r_[variances, [EKF_RANGE_RATE_SIGMA**2] * valid.sum()])
+    S = H @ P @ H.T + R
+    keep = np.abs(innovation) <= EKF_INNOVATION_GATE * np.sqrt(np.diag(S))
+    if keep[:count].sum() * 2 < count:
+        return None
+    H, innovation, R = H[keep], innovation[keep], R[np.ix_(keep, keep)]
+    S = H @ P @ H.T + R
+    K = np.linalg.solve(S, H @ P).T
+    # Joseph form keeps P symmetric and positive definite
+    I_KH = np.eye(len(x)) - K @ H
+    return x + K @ innovation, I_KH @ P @ I_KH.T + K @ R @ K.T
+
+def create_kml_file(coords, output_file="coordinates.kml", mode='points', times=None, decimate=1, min_distance=0):
+    create_track_file(coords, output_file, 'kml', mode, times, decimate, min_distance)
+
+def create_track_file(coords, output_file, track_format=None, mode='points', times=None, decimate=1, min_distance=0):
+    # coords are (lat, lon, alt) rows, they are streamed to output_file one fix at a time
+    if mode == 'track' and times is None:
+        # Checked before output_file is created, the writer would only notice at the first fix
+        raise ValueError("track mode needs the times of the fixes, use mode 'linestring' without times")
+    with open_track_writer(output_file, track_format, mode=mode, decimate=decimate, min_distance=min_distance) as writer:
+        writer.write_many(coords, times)
+
+def apply_log_schema(frame, schema):
+    """Cast the columns of frame that appear in schema (see RAW_SCHEMA), columns the schema doesn't know are left alone."""
+    for col, dtype in schema.items():
+        if col not in frame.columns or frame[col].dtype == dtype:
+            continue
+        if dtype == 'category':
+            frame[col] = frame[col].astype('category')
+            continue
+        values = frame[col]
+        if values.dtype == object:
+            values = pd.to_numeric(values, errors='coerce')
+        if np.dtype(dtype).kind == 'i':
+            if values.dtype.kind == 'f':
+                values = values.round()
+            # Blanks can't live in a numpy int column
+            if values.isna().any():
+                dtype = dtype.capitalize()
+        frame[col] = values.astype(dtype)
+    return frame
+
+def parse_log_batch(lines, columns, schema=None):
+    batch = pd.read_csv(io.StringIO(''.join(lines)), header=None, names=['RecordType'] + columns,
+                        usecols=columns, dtype={col: str for col in LOG_TEXT_COLUMNS if col in columns})
+    for col in batch.columns:
+        if col not in LOG_TEXT_COLUMNS and batch[col].dtype == object:
+            batch[col] = pd.to_numeric(batch[col], errors='coerce')
+    if schema is not None:
+        batch = apply_log_schema(batch, schema)
+    return batch
+
+def iter_log_batches(input_filepath, record_types=('Raw',), batch_rows=LOG_BATCH_ROWS, schema=None):
+    """Stream a GnssLogger file as (record type, DataFrame) batches with numeric columns already converted
+    (record types with an entry in LOG_SCHEMAS get its declared dtypes).
+
+    Each batch holds at most batch_rows rows of a single record type, except that a Raw batch is only
+    cut where TimeNanos changes so an epoch never spans two batches (batch_rows=1 yields one epoch per batch).
+    A schema dict passed in is filled with the header columns of record_types as they are read.
+    """
+    schema = {} if schema is None else schema
+    buffers = {record_type: [] for record_type in record_types}
+    with open(input_filepath) as logfile:
+        for line in logfile:
+            if line.startswith('#'):
+                fields = line[1:].strip().split(',')
+                if len(fields) > 1 and fields[0] in buffers:
+                    schema[fields[0]] = fields[1:]
+                continue
+            record_type = line[:line.find(',')]
+            buffer = buffers.get(record_type)
+            if buffer is None:
+                continue
+            if len(buffer) >= batch_rows:
+                if record_type == 'Raw':
+                    time_index = schema['Raw'].index('TimeNanos') + 1
+                    flush = line.split(',')[time_index] != buffer[-1].split(',')[time_index]
+                else:
+                    flush = True
+                if flush:
+                    yield record_type, parse_log_batch(buffer, schema[record_type], LOG_SCHEMAS.get(record_type))
+                    buffer.clear()
+            buffer.append(line)
+    for record_type, buffer in buffers.items():
+        if buffer:
+            yield record_type, parse_log_batch(buffer, schema[record_type], LOG_SCHEMAS.get(record_type))
+
+def log_to_measurment(input_filepath):
+    # Only the parsing is batched, the batches are joined into the one frame the rest of the pipeline works on
+    batches = {'Raw': [], 'Fix': []}
+    schema = {}
+    for record_type, batch in iter_log_batches(input_filepath, ('Raw', 'Fix'), schema=schema):
+        batches[record_type].append(batch)
+    android_fixes = pd.concat(batches['Fix'], ignore_index=True) if batches['Fix'] else pd.DataFrame(columns=schema.get('Fix'))
+    measurements = pd.concat(batches['Raw'], ignore_index=True) if batches['Raw'] else pd.DataFrame(columns=schema.get('Raw'))
+    # Categories differ from batch to batch, concat turns those columns back into objects
+    return apply_log_schema(measurements, RAW_SCHEMA), android_fixes
 
 def format_satelite_ID(measurements):
-    measurements.loc[measurements['Svid'].str.len() == 1, 'Svid'] = '0' + measurements['Svid']
-    measurements.loc[measurements['ConstellationType'] == '1', 'Constellation'] = 'G'
-    measurements.loc[measurements['ConstellationType'] == '3', 'Constellation'] = 'R'
-    measurements['satPRN'] = measurements['Constellation'] + measurements['Svid']
+    # Build the labels once per distinct (constellation, svid) pair instead of once per row
+    # Rows with a blank ConstellationType or Svid get no label, like an unknown constellation
+    constellation_type = pd.to_numeric(measurements['ConstellationType']).to_numpy(dtype=float, na_value=np.nan)
+    svid = pd.to_numeric(measurements['Svid']).to_numpy(dtype=float, na_value=np.nan)
+    identified = np.isfinite(constellation_type) & np.isfinite(svid)
+    pairs, identified_inverse = np.unique(np.stack([constellation_type[identified], svid[identified]]).astype(np.int64), axis=1,
+                                          return_inverse=True)
+    # The last slot stands for the unidentified rows
+    inverse = np.full(len(measurements), pairs.shape[1])
+    inverse[identified] = identified_inverse.reshape(-1)
+    letters = [CONSTELLATION_LETTERS.get(int(constellation)) for constellation in pairs[0]]
+    prns = [int(sv) - SVID_OFFSETS.get(int(constellation), 0) for constellation, sv in zip(pairs[0], pairs[1])]
+    labels = np.array([letter + str(prn).zfill(2) if letter else '' for letter, prn in zip(letters, prns)], dtype=object)
+    # Categories sorted as strings so sorting by satPRN matches sorting the labels themselves
+    known = np.flatnonzero(labels != '')
+    order = known[np.argsort(labels[known], kind='stable')]
+    codes = np.full(len(labels) + 1, -1)
+    codes[order] = np.arange(len(order))
+    measurements['Constellation'] = pd.Categorical(np.array(letters + [None], dtype=object)[inverse])
+    measurements['satPRN'] = pd.Categorical.from_codes(codes[inverse], labels[order])
     return measurements
 
 def handle_numeric_cols(measurements):
@@ -179,118 +698,583 @@ def handle_numeric_cols(measurements):
         measurements['TimeOffsetNanos'] = 0
     return measurements
 
-def calculate_datetime_cols(measurements):
+def calculate_datetime_cols(measurements, reference_bias=None):
+        # Blank counters turn a column into a nullable Int64 (see apply_log_schema), NaN lets those rows fall out like
+        # any other unusable measurement instead of breaking the time math
+        for col in ['TimeNanos', 'FullBiasNanos', 'ReceivedSvTimeNanos', 'BiasNanos', 'TimeOffsetNanos']:
+            if col in measurements.columns and pd.api.types.is_extension_array_dtype(measurements[col].dtype):
+                measurements[col] = measurements[col].astype('float64')
+        # reference_bias (FullBiasNanos + BiasNanos) defaults to the first complete row, a live session passes the one of its first epoch
+        if reference_bias is None:
+            biases = (measurements['FullBiasNanos'] + measurements['BiasNanos']).dropna()
+            reference_bias = biases.iloc[0] if len(biases) else np.nan
         # calculate gps Time in nanos 
         measurements['GpsTimeNanos'] = measurements['TimeNanos'] - (measurements['FullBiasNanos'] - measurements['BiasNanos'])
         gpsepoch = datetime(1980, 1, 6, 0, 0, 0)
         measurements['UnixTime'] = pd.to_datetime(measurements['GpsTimeNanos'], utc = True, origin=gpsepoch)
-        measurements['Epoch'] = 0
-        measurements.loc[measurements['UnixTime'] - measurements['UnixTime'].shift() > timedelta(milliseconds=200), 'Epoch'] = 1
-        measurements['Epoch'] = measurements['Epoch'].cumsum()
+        # Epoch gaps are found between the rows that have a time, a row without one (blank FullBiasNanos) joins the epoch of
+        # the row before it so it can neither merge two epochs nor start one
+        valid = measurements['UnixTime'].notna().to_numpy()
+        valid_epochs = np.concatenate(([0], np.cumsum(np.diff(measurements['UnixTime'].values[valid]) > np.timedelta64(EPOCH_GAP))))
+        measurements['Epoch'] = valid_epochs[np.maximum(np.cumsum(valid) - 1, 0)] if valid.any() else 0
         # This should account for rollovers since it uses a week number specific to each measurement
-        measurements['gnss_receive_time_nanoseconds'] = measurements['TimeNanos'] + measurements['TimeOffsetNanos'] - (measurements['FullBiasNanos'].iloc[0] + measurements['BiasNanos'].iloc[0])
+        measurements['gnss_receive_time_nanoseconds'] = measurements['TimeNanos'] + measurements['TimeOffsetNanos'] - reference_bias
         measurements['GpsWeekNumber'] = np.floor(1e-9 * measurements['gnss_receive_time_nanoseconds'] / WEEKSEC)
         measurements['time_since_reference'] = 1e-9*measurements['gnss_receive_time_nanoseconds'] - WEEKSEC * measurements['GpsWeekNumber']
+        # Transmit time stays in the satellite's own system time, that is the time scale of its ephemeris
         measurements['transmit_time_seconds'] = 1e-9*(measurements['ReceivedSvTimeNanos'] + measurements['TimeOffsetNanos'])
+        system_time_offset = 0
+        if 'Constellation' in measurements.columns:
+            system_time_offset = measurements['Constellation'].astype(object).map(SYSTEM_TIME_OFFSETS).fillna(0).astype(float)
+            glonass = (measurements['Constellation'] == 'R').to_numpy()
+            if glonass.any():
+                # GLONASS reports the time of day in UTC(SU), move it to GPS seconds of week next to the receive time
+                leap_seconds = pd.to_numeric(measurements['LeapSecond'], errors='coerce').fillna(GPS_UTC_LEAP_SECONDS) \
+                    if 'LeapSecond' in measurements.columns else GPS_UTC_LEAP_SECONDS
+                receive_time = measurements['time_since_reference'].to_numpy()
+                transmit_time = (measurements['transmit_time_seconds'] - GLONASS_UTC_OFFSET) % 86400 + leap_seconds
+                transmit_time = np.asarray(transmit_time, dtype=float) + 86400 * np.floor(receive_time / 86400)
+                transmit_time += 86400 * np.round((receive_time - transmit_time) / 86400)
+                measurements['transmit_time_seconds'] = np.where(glonass, transmit_time, measurements['transmit_time_seconds'])
         # Calculate pseudorange in seconds
-        measurements['pseudorange_seconds'] = measurements['time_since_reference'] - measurements['transmit_time_seconds']
+        measurements['pseudorange_seconds'] = measurements['time_since_reference'] - (measurements['transmit_time_seconds'] + system_time_offset)
         return measurements
 
-def clause2():
+def select_usable_rows(measurements, min_satellites=1):
+    """Keep the usable rows (a receive time, pseudorange under 0.1 s, 0.15 s for BeiDou, one row per satellite) of the epochs
+    holding at least min_satellites of them, sorted by Epoch. The whole frame is filtered once instead of once per epoch.
+    """
+    max_pseudorange = MAX_PSEUDORANGE_SECONDS
+    if 'Constellation' in measurements.columns:
+        max_pseudorange = measurements['Constellation'].astype(object).map(SYSTEM_MAX_PSEUDORANGE_SECONDS).fillna(MAX_PSEUDORANGE_SECONDS)
+    usable = measurements.loc[(measurements['pseudorange_seconds'] < max_pseudorange) & measurements['UnixTime'].notna()]
+    usable = usable.drop_duplicates(subset=['Epoch', 'satPRN']).sort_values('Epoch', kind='stable')
+    if min_satellites > 1:
+        usable = usable.loc[usable.groupby('Epoch')['Epoch'].transform('size') >= min_satellites]
+    return usable
+
+def calculate_epoch_satellite_positions(measurements, min_satellites=5, cache=epoch_cache, velocities=False, uncertainties=False):
+    """Match the usable measurements of every epoch with min_satellites or more satellites to their
+    ephemeris and compute all the satellite positions in one pass (one row per satellite per epoch).
+
+    Ephemeris rows and satellite states are memoized per epoch in cache, so a second call for the same
+    epochs (a Kalman filter solve after clause2) only does the orbit work for epochs that were evicted meanwhile.
+    With velocities the SATELLITE_VELOCITY_COLUMNS and the clock corrected 'pseudorange_rate' are added,
+    with uncertainties the 'pseudorange_sigma' (m) reported by the receiver.
+    """
+    usable = select_usable_rows(measurements, min_satellites).sort_values(['Epoch', 'satPRN'], kind='stable')
+    if usable.empty:
+        return pd.DataFrame(columns=['Epoch', 'satPRN'] + SATELLITE_STATE_COLUMNS + ['pseudorange', 'cn0'])
+
+    epochs = usable['Epoch'].to_numpy()
+    satellites = usable['satPRN'].to_numpy()
+    starts = np.flatnonzero(np.concatenate(([True], epochs[1:] != epochs[:-1])))
+    stops = np.concatenate((starts[1:], [len(epochs)]))
+    # Every satellite of an epoch uses the ephemeris valid at the epoch's first timestamp
+    timestamps = usable['UnixTime'].values[starts]
+    keys = [(timestamp, tuple(satellites[start:stop])) for timestamp, start, stop in zip(timestamps.view('int64').tolist(), starts, stops)]
+
+    states = np.full((len(usable), len(SATELLITE_STATE_COLUMNS)), np.nan)
+    epoch_ephemeris = [None] * len(keys)
+    missing = []
+    for i, key in enumerate(keys):
+        entry = cache.get(key) if cache is not None else None
+        if entry is None:
+            missing.append(i)
+        else:
+            epoch_ephemeris[i], states[starts[i]:stops[i]] = entry
+
+    if missing:
+        rows = np.concatenate([np.arange(starts[i], stops[i]) for i in missing])
+        epoch_timestamps = np.repeat(timestamps, stops - starts)[rows]
+        glonass = satellites[rows].astype('U1') == 'R'
+        epoch_timestamps[glonass] += GLONASS_EPHEMERIS_LOOKAHEAD
+        with profiler.stage('ephemeris lookup', len(rows)):
+            ephemeris = manager.get_ephemeris_batch(epoch_timestamps, satellites[rows])
+        found = ephemeris['time'].notna().to_numpy()
+        with profiler.stage('orbits', found.sum()):
+            computed = calculate_satellite_positions(epochs[rows[found]], satellites[rows[found]],
+                                                     usable['transmit_time_seconds'].to_numpy()[rows[found]], ephemeris.loc[found])
+        states[rows[found]] = computed[SATELLITE_STATE_COLUMNS].to_numpy()
+        offset = 0
+        for i in missing:
+            count = stops[i] - starts[i]
+            epoch_ephemeris[i] = ephemeris.iloc[offset:offset + count]
+            if cache is not None:
+                cache.put(keys[i], (epoch_ephemeris[i], states[starts[i]:stops[i]].copy()))
+            offset += count
+
+    found = ~np.isnan(states[:, 0])
+    sv_positions = pd.DataFrame(states[found], columns=SATELLITE_STATE_COLUMNS)
+    sv_positions.insert(0, 'satPRN', satellites[found])
+    sv_positions.insert(0, 'Epoch', epochs[found])
+    sv_positions['pseudorange'] = usable['Pseudorange_Measurement'].to_numpy()[found] + LIGHTSPEED * sv_positions['Sat.bias']
+    sv_positions['cn0'] = usable['Cn0DbHz'].to_numpy()[found]
+    if velocities:
+        ephemeris = pd.concat(epoch_ephemeris).iloc[np.flatnonzero(found)]
+        with profiler.stage('satellite velocities', found.sum()):
+            motion = calculate_satellite_velocities(satellites[found], usable['transmit_time_seconds'].to_numpy()[found], ephemeris)
+        sv_positions[SATELLITE_VELOCITY_COLUMNS] = motion
+        sv_positions['pseudorange_rate'] = usable['PseudorangeRateMetersPerSecond'].to_numpy(dtype=float)[found] \
+            + LIGHTSPEED * sv_positions['Sat.drift']
+    if uncertainties:
+        sv_positions['pseudorange_sigma'] = LIGHTSPEED * 1e-9 * usable['ReceivedSvTimeUncertaintyNanos'].to_numpy(dtype=float)[found]
+    return sv_positions
+
+def constant_weights(sv_positions):
+    return np.full(len(sv_positions), 1 / PSEUDORANGE_SIGMA**2)
+
+def cn0_weights(sv_positions):
+    # sigma^2 = a + b * 10^(-C/N0 / 10), the thermal noise of the code tracking loop grows as C/N0 drops
+    a, b = CN0_VARIANCE_MODEL
+    return 1 / (a + b * 10**(-sv_positions['cn0'].to_numpy(dtype=float) / 10))
+
+def uncertainty_weights(sv_positions):
+    # The receiver's own 1-sigma of the received satellite time, floored since some phones report 0
+    return 1 / np.maximum(sv_positions['pseudorange_sigma'].to_numpy(dtype=float), MIN_PSEUDORANGE_SIGMA)**2
+
+WEIGHTING_MODELS = {'none': constant_weights, 'cn0': cn0_weights, 'uncertainty': uncertainty_weights}
+
+def pseudorange_weights(sv_positions, weighting='none'):
+    # Inverse pseudorange variances (1/m^2) of every row of sv_positions under one of WEIGHTING_MODELS
+    if weighting not in WEIGHTING_MODELS:
+        raise ValueError('unknown weighting ' + str(weighting) + ', choose from ' + ', '.join(WEIGHTING_MODELS))
+    weights = WEIGHTING_MODELS[weighting](sv_positions)
+    # A row without C/N0 or uncertainty falls back to the constant model instead of leaving the solve
+    return np.where(np.isfinite(weights) & (weights > 0), weights, 1 / PSEUDORANGE_SIGMA**2)
+
+def calculate_satellite_velocities(satellites, transmit_times, ephemeris, step=SATELLITE_VELOCITY_STEP):
+    # Central differences of calculate_satellite_positions, (N, 4) of ECEF velocity (m/s) and clock drift (s/s)
+    transmit_times = np.asarray(transmit_times, dtype=float)
+    columns = ['Sat.X', 'Sat.Y', 'Sat.Z', 'Sat.bias']
+    before = calculate_satellite_positions(None, satellites, transmit_times - step / 2, ephemeris)[columns].to_numpy()
+    after = calculate_satellite_positions(None, satellites, transmit_times + step / 2, ephemeris)[columns].to_numpy()
+    return (after - before) / step
+
+def parse_constellations(constellations):
+    # 'GEC' or ['G', 'E', 'C'] to a tuple of system letters, only the systems the pipeline can position are accepted
+    constellations = tuple(dict.fromkeys(constellations))
+    unsupported = [system for system in constellations if system not in SUPPORTED_CONSTELLATIONS]
+    if unsupported or not constellations:
+        raise ValueError('unsupported constellations ' + ''.join(unsupported) + ', choose from ' + ''.join(SUPPORTED_CONSTELLATIONS))
+    return constellations
+
+def clause2(input_filepath=None, output_directory='.', output_format='csv', constellations=DEFAULT_CONSTELLATIONS):
     # Get path to sample file in data directory, which is located in the parent directory of this notebook
-    if len(sys.argv) > 1:
-        input_filepath = sys.argv[1]
-    else:
-        exit("should give log file")
+    if input_filepath is None:
+        if len(sys.argv) > 1:
+            input_filepath = sys.argv[1]
+        else:
+            exit("should give log file")
 
-    measurements, android_fixes = log_to_measurment(input_filepath)
+    with profiler.stage('parse log') as stage:
+        measurements, android_fixes = log_to_measurment(input_filepath)
+        stage['rows'] = len(measurements)
 
-    format_satelite_ID(measurements)
-    # Remove all non-GPS measurements
-    measurements = measurements.loc[measurements['Constellation'] == 'G']
+    with profiler.stage('format ids', len(measurements)):
+        format_satelite_ID(measurements)
+        # Remove the measurements of the constellations we don't process
+        measurements = measurements.loc[measurements['Constellation'].isin(parse_constellations(constellations))]
 
     # Convert columns to numeric representation
-    measurements = handle_numeric_cols(measurements)
+    with profiler.stage('numeric columns', len(measurements)):
+        measurements = handle_numeric_cols(measurements)
 
-    measurements = calculate_datetime_cols(measurements)    
+    with profiler.stage('datetime columns', len(measurements)):
+        measurements = calculate_datetime_cols(measurements)
 
-    # calculate Pseudorange in meters
-    measurements['Pseudorange_Measurement'] = LIGHTSPEED * measurements['pseudorange_seconds'] # simple time * speed
+        # calculate Pseudorange in meters
+        measurements['Pseudorange_Measurement'] = LIGHTSPEED * measurements['pseudorange_seconds'] # simple time * speed
 
     
-    # Initialize variables
-    epoch = 0
-    num_sats = 0
-    sv_positions = pd.DataFrame()
-    # Iterate over each epoch
-    while True:
-        # Filter measurements for the current epoch and pseudorange condition
-        one_epoch = measurements.loc[(measurements['Epoch'] == epoch) & (measurements['pseudorange_seconds'] < 0.1)].drop_duplicates(subset='satPRN')
-        # Check if there are 5 or more satellites in the current epoch
-        num_sats = len(one_epoch)
-        if num_sats >= 5:
-            # Perform operations for the current epoch
-            timestamp = one_epoch.iloc[0]['UnixTime'].to_pydatetime(warn=False)
-            one_epoch.set_index('satPRN', inplace=True)
-            sats = one_epoch.index.unique().tolist()
-            ephemeris = manager.get_ephemeris(timestamp, sats)
-            sv_position = calculate_satellite_position(ephemeris, one_epoch['transmit_time_seconds'], one_epoch)
-            
-            # Concatenate satellite positions for the current epoch
-            sv_positions = pd.concat([sv_positions, sv_position])
-
-        # Move to the next epoch
-        epoch += 1
-        
-        # Exit loop if there are no more epochs
-        if epoch >= measurements['Epoch'].max():
-            break
-    sv_positions.drop(columns=['Sat.bias']).to_csv('satellites_positions.csv')
+    with profiler.stage('satellite positions') as stage:
+        sv_positions = calculate_epoch_satellite_positions(measurements, min_satellites=5)
+        stage['rows'] = len(sv_positions)
+    sv_positions = sv_positions.set_index(['Epoch', 'satPRN'])
+    with profiler.stage('write satellites table', len(sv_positions)):
+        write_table(sv_positions.drop(columns=['Sat.bias']).reset_index(),
+                    os.path.join(output_directory, 'satellites_positions' + OUTPUT_FORMATS[output_format]))
     return measurements, sv_positions
 
-def clause3(measurements,sv_position):
-    initial_bias = 0
-    initial_position = np.array([0, 0, 0])
-    # Satellite Initial Position (X, Y, Z)
-    satellite_initial_position = sv_position[['Sat.X', 'Sat.Y', 'Sat.Z']].to_numpy()
-    current_position = initial_position
-    current_bias = initial_bias
-    ecef_list = []
-    ecef_list_with_times = []
-    for epoch in measurements['Epoch'].unique():
-        epoch_measurements = measurements.loc[(measurements['Epoch'] == epoch) & (measurements['pseudorange_seconds'] < 0.1)] 
-        epoch_measurements = epoch_measurements.drop_duplicates(subset='satPRN').set_index('satPRN')
-        if len(epoch_measurements.index) > 4:
-            timestamp = epoch_measurements.iloc[0]['UnixTime'].to_pydatetime(warn=False)
-            satellite_ids = epoch_measurements.index.unique().tolist()
-            ephemeris_data = manager.get_ephemeris(timestamp, satellite_ids)
-            satellite_positions = calculate_satellite_position(ephemeris_data, epoch_measurements['transmit_time_seconds'], measurements)
-            satellite_positions_xyz = satellite_positions[['Sat.X', 'Sat.Y', 'Sat.Z']].to_numpy()
-            pseudoranges = epoch_measurements['Pseudorange_Measurement'] + LIGHTSPEED * satellite_positions['Sat.bias']
-            pseudoranges = pseudoranges.to_numpy()
-
-            current_position, current_bias, delta_position = least_squares(satellite_positions_xyz, pseudoranges, current_position, current_bias)
-            ecef_list.append(current_position)
-            ecef_list_with_times.append((current_position,satellite_positions['GPS time'].min()))
+def parse_corrections(corrections):
+    # 'ionosphere,sagnac', a list of names or 'all' to a tuple of CORRECTION_MODELS names
+    if isinstance(corrections, str):
+        corrections = list(CORRECTION_MODELS) if corrections == 'all' else [name for name in corrections.split(',') if name]
+    corrections = tuple(dict.fromkeys(corrections))
+    unknown = [name for name in corrections if name not in CORRECTION_MODELS]
+    if unknown:
+        raise ValueError('unknown corrections ' + ','.join(unknown) + ', choose from ' + ','.join(CORRECTION_MODELS) + ' or all')
+    return corrections
+
+def correct_pseudoranges(sv_positions, fixes, receive_times, corrections, ionosphere=None):
+    """Pseudoranges of sv_positions with the delays of the named CORRECTION_MODELS removed.
+
+    Every row is evaluated at the fix of its epoch (a solve_epochs frame) at receive_times (GPS seconds of week
+    indexed by Epoch); elevation and azimuth are computed once for all the models. Rows of epochs without a
+    converged fix keep their pseudorange.
+    """
+    fixes = fixes.loc[fixes['Converged']].set_index('Epoch')
+    receivers = fixes[['Pos.X', 'Pos.Y', 'Pos.Z']].reindex(sv_positions['Epoch']).to_numpy(dtype=float)
+    geometry = correction_geometry(receivers, sv_positions[['Sat.X', 'Sat.Y', 'Sat.Z']].to_numpy(dtype=float),
+                                   pd.Series(receive_times).reindex(sv_positions['Epoch']).to_numpy(dtype=float), ionosphere)
+    return sv_positions['pseudorange'].to_numpy(dtype=float) - total_delay(geometry, corrections)
+
+def calculate_fixes(measurements, initial_position=(0, 0, 0), initial_clock_bias=0, cache=epoch_cache, solver='ls', weighting='none',
+                    raim=False, corrections=(), satellites=None):
+    # One row per converged epoch with its ECEF fix, the earliest satellite 'GPS time' and the epoch's UnixTime,
+    # solver 'ls' solves every epoch on its own and 'ekf' runs filter_epochs over the whole log. weighting picks
+    # one of WEIGHTING_MODELS and raim the residual based exclusion of the least squares solver (the filter gates
+    # its innovations instead). With corrections the pseudoranges are corrected at a first least squares fix and
+    # solved again starting from it. satellites, a calculate_epoch_satellite_positions frame already computed for
+    # measurements (with the velocity / uncertainty columns the solver and weighting need), is solved as it is
+    if satellites is None:
+        with profiler.stage('satellite positions') as stage:
+            satellites = calculate_epoch_satellite_positions(measurements, min_satellites=5, cache=cache, velocities=solver == 'ekf',
+                                                             uncertainties=weighting == 'uncertainty')
+            stage['rows'] = len(satellites)
+    weights = pseudorange_weights(satellites, weighting) if weighting != 'none' or raim else None
+    if corrections:
+        with profiler.stage('corrections', len(satellites)):
+            fixes = solve_epochs(satellites, initial_position, initial_clock_bias, weights=weights, raim=raim)
+            receive_times = measurements.groupby('Epoch')['time_since_reference'].first()
+            ionosphere = None
+            if 'ionosphere' in corrections and len(satellites):
+                systems = set(satellites['satPRN'].to_numpy().astype(str).astype('U1'))
+                ionosphere = manager.get_ionosphere(measurements['UnixTime'].iloc[0], systems)
+            satellites = satellites.assign(pseudorange=correct_pseudoranges(satellites, fixes, receive_times, corrections, ionosphere))
+            solved = fixes.loc[fixes['Converged']]
+            if not solved.empty:
+                initial_position = solved[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy()[0]
+                initial_clock_bias = solved['Clock bias'].iloc[0]
+    with profiler.stage('kalman filter' if solver == 'ekf' else 'least squares', len(satellites)):
+        if solver == 'ekf':
+            fixes = filter_epochs(satellites, measurements.groupby('Epoch')['UnixTime'].first(), weights)
+        else:
+            fixes = solve_epochs(satellites, initial_position, initial_clock_bias, weights=weights, raim=raim)
+    fixes['GPS time'] = satellites.groupby('Epoch', sort=False)['GPS time'].min().to_numpy()
+    fixes['UnixTime'] = measurements.groupby('Epoch')['UnixTime'].first().reindex(fixes['Epoch']).to_numpy()
+    return fixes.loc[fixes['Converged']]
+
+def iter_stream_epochs(lines, epoch_timeout=STREAM_EPOCH_TIMEOUT):
+    """Group the Raw lines of a live GnssLogger stream into epochs as they arrive.
+
+    An epoch closes when a Raw line is more than EPOCH_GAP after the previous one (the rule of
+    calculate_datetime_cols) or when no line arrived for epoch_timeout seconds, lines yields None while
+    it waits (see gnssutils.log_stream). Yields (Raw columns, lines of one epoch), only the open epoch is kept.
+    """
+    columns = None
+    epoch_lines = []
+    last_time = None
+    last_arrival = None
+    for line in lines:
+        if line is None:
+            if epoch_lines and time.monotonic() - last_arrival >= epoch_timeout:
+                yield columns, epoch_lines
+                epoch_lines = []
+            continue
+        if line.startswith('#'):
+            fields = line[1:].strip().split(',')
+            if len(fields) > 1 and fields[0] == 'Raw':
+                columns = fields[1:]
+                time_fields = [columns.index(col) + 1 for col in ['TimeNanos', 'FullBiasNanos', 'BiasNanos']]
+            continue
+        if columns is None or not line.startswith('Raw,'):
+            continue
+        fields = line.split(',')
+        try:
+            gps_time = int(fields[time_fields[0]]) - (int(fields[time_fields[1]]) - float(fields[time_fields[2]] or 0))
+        except ValueError:
+            # Without a full bias the row can't be placed in time, and can't be used by the solver either
+            continue
+        if epoch_lines and gps_time - last_time > EPOCH_GAP.total_seconds() * 1e9:
+            yield columns, epoch_lines
+            epoch_lines = []
+        epoch_lines.append(line)
+        last_time = gps_time
+        last_arrival = time.monotonic()
+    if epoch_lines:
+        yield columns, epoch_lines
+
+def stream_fixes(lines, constellations=DEFAULT_CONSTELLATIONS, epoch_timeout=STREAM_EPOCH_TIMEOUT):
+    """Compute the fix of every epoch of a live log as soon as the epoch closes (see iter_stream_epochs).
+
+    Receive times of the whole session are referenced to the bias of its first epoch, as calculate_datetime_cols
+    does for a complete log, and every epoch starts from the previous fix. Yields one calculate_fixes row
+    (a Series with Lat, Lon and Alt added) per solved epoch; nothing of past epochs is kept.
+    """
+    constellations = parse_constellations(constellations)
+    reference_bias = None
+    position, clock_bias = np.zeros(3), 0.0
+    for epoch, (columns, epoch_lines) in enumerate(iter_stream_epochs(lines, epoch_timeout)):
+        with profiler.stage('epoch', len(epoch_lines), epoch=epoch):
+            measurements = format_satelite_ID(parse_log_batch(epoch_lines, columns, RAW_SCHEMA))
+            measurements = measurements.loc[measurements['Constellation'].isin(constellations)]
+            if measurements.empty:
+                continue
+            measurements = handle_numeric_cols(measurements)
+            if reference_bias is None:
+                reference_bias = measurements['FullBiasNanos'].iloc[0] + measurements['BiasNanos'].iloc[0]
+            measurements = calculate_datetime_cols(measurements, reference_bias)
+            measurements['Epoch'] = epoch
+            measurements['Pseudorange_Measurement'] = LIGHTSPEED * measurements['pseudorange_seconds']
+            # Live epochs are never looked up again, so they stay out of the epoch cache
+            try:
+                fixes = calculate_fixes(measurements, position, clock_bias, cache=None)
+            except EphemerisNotFound as err:
+                # The navigation file may not be published yet, the lookup is tried again on the next epoch
+                print(err, file=sys.stderr)
+                continue
+            if fixes.empty:
+                continue
+            fix = fixes.iloc[0].copy()
+            position = fix[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy(dtype=float)
+            clock_bias = fix['Clock bias']
+            fix['Lat'], fix['Lon'], fix['Alt'] = ecef_to_lla(position)[0]
+        yield fix
 
+def follow_log(source, output_directory='.', track_format='kml', track_mode='points', decimate=1, min_distance=0,
+               constellations=DEFAULT_CONSTELLATIONS, idle_timeout=None):
+    """Print every fix of a live log as a csv line on stdout and append it to the coordinates file.
+
+    source is a growing log file, '-' for stdin or tcp://host:port (see open_line_source). The coordinates
+    file is completed when the source ends, or after idle_timeout seconds without data for a file.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(FOLLOW_COLUMNS)
+    with open_track_writer(os.path.join(output_directory, 'coordinates.' + track_format), track_format,
+                           mode=track_mode, decimate=decimate, min_distance=min_distance) as track:
+        for fix in stream_fixes(open_line_source(source, idle_timeout=idle_timeout), constellations):
+            track.write(fix['Lat'], fix['Lon'], fix['Alt'], fix['UnixTime'])
+            writer.writerow([fix[col] for col in FOLLOW_COLUMNS])
+            sys.stdout.flush()
+
+def clause3(measurements,sv_position):
+    # sv_position is the satellite table of clause2 (indexed by Epoch and satPRN), the rows of the epochs of measurements are solved directly
+    satellites = sv_position.reset_index()
+    fixes = calculate_fixes(measurements, satellites=satellites.loc[satellites['Epoch'].isin(measurements['Epoch'].unique())])
+    ecef_list_with_times = [(position, time) for position, time in zip(fixes[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy(), fixes['GPS time'])]
     return ecef_list_with_times
 
-def main():
-    measurements, sv_position = clause2()
-    ecef_list_with_times = clause3(measurements,sv_position)
+def join_satellites_to_fixes(sv_positions, locations_df):
+    """Attach to every satellite row the fix of its epoch, matched on the integer Epoch id.
+
+    Both tables are sorted by Epoch so the match is a searchsorted, satellite rows of epochs without a fix are dropped.
+    """
+    satellites = sv_positions.reset_index()
+    fix_epochs = locations_df['Epoch'].to_numpy()
+    satellite_epochs = satellites['Epoch'].to_numpy()
+    positions = np.searchsorted(fix_epochs, satellite_epochs)
+    matched = positions < len(fix_epochs)
+    matched[matched] = fix_epochs[positions[matched]] == satellite_epochs[matched]
+    fixes = locations_df.drop(columns=['Epoch', 'GPS time']).iloc[positions[matched]].reset_index(drop=True)
+    return pd.concat([satellites.loc[matched].reset_index(drop=True), fixes], axis=1)
+
+def apply_output_dtypes(df):
+    # Integer epoch ids, categorical satellite ids and float64 for every other numeric column
+    df = df.copy()
+    for col in df.columns:
+        if col == 'Epoch':
+            df[col] = df[col].astype('int64')
+        elif col == 'satPRN':
+            df[col] = df[col].astype('category')
+        elif pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col]):
+            df[col] = df[col].astype('float64')
+    return df
+
+def write_table(df, filepath):
+    """Write an output table as csv, or as Parquet / Arrow IPC (needs pyarrow) with apply_output_dtypes applied,
+    the format is picked from the file extension (OUTPUT_FORMATS)."""
+    extension = os.path.splitext(filepath)[1]
+    if extension == OUTPUT_FORMATS['parquet']:
+        apply_output_dtypes(df).to_parquet(filepath, index=False)
+    elif extension == OUTPUT_FORMATS['arrow']:
+        apply_output_dtypes(df).reset_index(drop=True).to_feather(filepath)
+    else:
+        df.to_csv(filepath, index=None)
+
+def load_table(filepath):
+    # Counterpart of write_table, a csv table gets the same dtypes as the binary formats
+    extension = os.path.splitext(filepath)[1]
+    if extension == OUTPUT_FORMATS['parquet']:
+        df = pd.read_parquet(filepath)
+    elif extension == OUTPUT_FORMATS['arrow']:
+        df = pd.read_feather(filepath)
+    else:
+        df = pd.read_csv(filepath)
+    return apply_output_dtypes(df)
+
+def process_log(input_filepath, output_directory='.', track_format='kml', track_mode='points', decimate=1, min_distance=0, output_format='csv',
+                constellations=DEFAULT_CONSTELLATIONS, solver='ls', weighting='none', raim=False, corrections=()):
+    os.makedirs(output_directory, exist_ok=True)
+    measurements, sv_position = clause2(input_filepath, output_directory, output_format, constellations)
+    # The clause2 table lacks the velocities of the filter and the receiver's uncertainties, those solves recompute it
+    satellites = sv_position.reset_index() if solver == 'ls' and weighting != 'uncertainty' else None
+    fixes = calculate_fixes(measurements, solver=solver, weighting=weighting, raim=raim, corrections=corrections, satellites=satellites)
+    ecef_list_with_times = [(position, time) for position, time in zip(fixes[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy(), fixes['GPS time'])]
     ################################
     # Clause 4
     ################################
-    lla = [navpy.ecef2lla(coord) for (coord,time) in ecef_list_with_times]    
+    with profiler.stage('lla', len(fixes)):
+        lla = ecef_to_lla([coord for (coord,time) in ecef_list_with_times])
     ################################
     # Clause 5
     ################################
-    create_kml_file(lla)
-    locations_df = calculate_locations_data_frame(ecef_list_with_times)
-    
-    firstOutputDf = pd.read_csv('satellites_positions.csv')
-    final_df = pd.merge(firstOutputDf, locations_df, on="GPS time")
-    final_df.to_csv('satellites_positions_with_estimated_location.csv',index=None)
+    with profiler.stage('track file', len(fixes)):
+        create_track_file(lla, os.path.join(output_directory, 'coordinates.' + track_format), track_format, track_mode,
+                          fixes['UnixTime'], decimate, min_distance)
+    with profiler.stage('write located table', len(sv_position)):
+        locations_df = calculate_locations_data_frame(ecef_list_with_times, lla)
+        locations_df.insert(0, 'Epoch', fixes['Epoch'].to_numpy())
+
+        final_df = join_satellites_to_fixes(sv_position.drop(columns=['Sat.bias']), locations_df)
+        write_table(final_df, os.path.join(output_directory, 'satellites_positions_with_estimated_location' + OUTPUT_FORMATS[output_format]))
+
+def find_logs(pattern):
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.txt')
+    return sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+
+def log_time_span(input_filepath):
+    # Only the first epoch and the tail of the log are parsed, which is enough to know which days of ephemeris a log needs
+    schema = {}
+    start = end = None
+    for record_type, first_epoch in iter_log_batches(input_filepath, batch_rows=1, schema=schema):
+        times = calculate_datetime_cols(handle_numeric_cols(first_epoch))['UnixTime'].dropna()
+        start = times.iloc[0].to_pydatetime(warn=False) if len(times) else None
+        break
+    if start is None:
+        return None, None
+    with open(input_filepath, 'rb') as logfile:
+        logfile.seek(max(os.path.getsize(input_filepath) - LOG_TAIL_BYTES, 0))
+        # The first line of the tail may be cut, only complete Raw lines are kept
+        tail = [line.decode() for line in logfile.readlines()[1:] if line.startswith(b'Raw,')]
+    if tail:
+        times = calculate_datetime_cols(handle_numeric_cols(parse_log_batch(tail, schema['Raw'], RAW_SCHEMA)))['UnixTime'].dropna()
+        end = times.max().to_pydatetime(warn=False) if len(times) else None
+    return start, max(start, end) if end is not None else start
+
+def process_log_safely(input_filepath, output_directory, options):
+    # With a 'profile' option every log writes its own trace, named after that option, into its output directory
+    options = dict(options)
+    profile = options.pop('profile', None)
+    try:
+        if profile:
+            profiler.reset()
+            profiler.enable()
+        process_log(input_filepath, output_directory, **options)
+        if profile:
+            profiler.save(os.path.join(output_directory, os.path.basename(profile)))
+        return input_filepath, None
+    except Exception as err:
+        return input_filepath, repr(err)
+    finally:
+        profiler.disable()
+
+def process_logs(pattern, output_root='.', workers=None, **options):
+    """Process every log matched by a directory or glob pattern on a pool of worker processes.
+
+    Each log gets its own output directory named after the log. The ephemeris days the logs span are
+    loaded once up front, which writes the parsed sidecar cache the workers then load instead of parsing
+    the RINEX files again. options are passed on to process_log. Returns (log path, error or None) for every log.
+    """
+    input_filepaths = find_logs(pattern)
+    start_times, end_times = set(), set()
+    for input_filepath in input_filepaths:
+        try:
+            start, end = log_time_span(input_filepath)
+        except Exception:
+            # A log that can't be read has no time span, process_log_safely reports its error like any other
+            continue
+        if start is not None:
+            start_times.add(start)
+            end_times.add(end)
+    constellations = set(options.get('constellations', DEFAULT_CONSTELLATIONS))
+    if start_times:
+        # Every navigation file of the batch's date range, up to the day the last log ends on, is downloaded
+        # concurrently before anything is parsed
+        days = pd.date_range(pd.Timestamp(min(start_times)).floor('D'), pd.Timestamp(max(end_times)).floor('D'), freq='D')
+        for filepath, error in manager.prefetch(days, constellations):
+            if error:
+                print(error)
+    for timestamp in start_times | end_times:
+        try:
+            manager.get_shard(timestamp, constellations)
+        except EphemerisNotFound:
+            # Already reported by prefetch, the logs of that day report it again as their error
+            pass
+    # Forked workers must not share the pooled connections of the prefetch, each opens its own when it needs one
+    manager.source.close()
+    output_directories = [os.path.join(output_root, os.path.splitext(os.path.basename(input_filepath))[0])
+                          for input_filepath in input_filepaths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(process_log_safely, input_filepaths, output_directories, [options] * len(input_filepaths)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute satellite positions and receiver locations from GnssLogger logs')
+    parser.add_argument('input', nargs='?', help='GnssLogger log file')
+    parser.add_argument('--batch', metavar='DIR_OR_GLOB', help='process every log of a directory (*.txt) or glob pattern in parallel')
+    parser.add_argument('--output-dir', default='.', help='output directory, in batch mode every log gets a sub directory')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes for batch mode (default: number of cores)')
+    parser.add_argument('--track-format', choices=sorted(TRACK_WRITERS), default='kml', help='format of the coordinates file')
+    parser.add_argument('--track-mode', choices=TRACK_MODES, default='points',
+                        help='one placemark per fix, a single line, or a single line with a timestamp per fix')
+    parser.add_argument('--decimate', type=int, default=1, help='keep every n-th fix in the coordinates file')
+    parser.add_argument('--min-distance', type=float, default=0, help='drop fixes closer than this many meters to the previous one')
+    parser.add_argument('--output-format', choices=sorted(OUTPUT_FORMATS), default='csv',
+                        help='format of the satellite position tables (parquet and arrow need pyarrow)')
+    parser.add_argument('--solver', choices=SOLVERS, default='ls',
+                        help='least squares fix of every epoch on its own, or an extended Kalman filter over the log '
+                             'that also uses the pseudorange rates (follow mode always uses least squares)')
+    parser.add_argument('--weighting', choices=list(WEIGHTING_MODELS), default='none',
+                        help='pseudorange weights of the solvers: equal, from C/N0, or from the uncertainty the receiver reports')
+    parser.add_argument('--raim', action='store_true',
+                        help='test the least squares residuals of every epoch and exclude the worst satellites of the epochs that fail')
+    parser.add_argument('--corrections', type=parse_corrections, default=(),
+                        help='comma separated range corrections to apply, any of ' + ','.join(CORRECTION_MODELS) + ' or all '
+                             '(the ionosphere uses the Klobuchar coefficients of the navigation file)')
+    parser.add_argument('--ephemeris-source', type=open_source, default=None, metavar='SOURCE',
+                        help='where missing navigation files come from, comma separated and tried in order: ftp (the archives, '
+                             'default), ftp://host:port (a local FTP mirror) or a directory holding a mirror of the archives')
+    parser.add_argument('--profile', nargs='?', const='profile.json', default=None, metavar='TRACE_FILE',
+                        help='time every stage (and every epoch in follow mode), print a summary and write a Chrome trace '
+                             '(default profile.json, in batch mode one per log output directory)')
+    parser.add_argument('--follow', action='store_true',
+                        help='treat input as a live log: a file that is still growing, - for stdin or tcp://host:port, '
+                             'and print every fix as soon as its epoch closes')
+    parser.add_argument('--idle-timeout', type=float, default=None,
+                        help='in follow mode stop after this many seconds without new lines in the file (default: never)')
+    parser.add_argument('--constellations', type=parse_constellations, default=DEFAULT_CONSTELLATIONS,
+                        help='systems to use, any of ' + ''.join(SUPPORTED_CONSTELLATIONS) + ' (default: G), '
+                             'anything beyond GPS needs the combined multi-GNSS navigation file')
+    args = parser.parse_args()
+    options = {'track_format': args.track_format, 'track_mode': args.track_mode, 'decimate': args.decimate, 'min_distance': args.min_distance,
+               'output_format': args.output_format, 'constellations': args.constellations, 'solver': args.solver,
+               'weighting': args.weighting, 'raim': args.raim, 'corrections': args.corrections}
+    if args.ephemeris_source is not None:
+        manager.source = args.ephemeris_source
+    if args.profile and not args.batch:
+        profiler.enable()
+    if args.follow and args.input:
+        try:
+            follow_log(args.input, args.output_dir, args.track_format, args.track_mode, args.decimate, args.min_distance,
+                       args.constellations, args.idle_timeout)
+        finally:
+            if args.profile:
+                # stdout carries the fixes in follow mode
+                print(profiler.summary(), file=sys.stderr)
+                profiler.save(args.profile)
+    elif args.batch:
+        options['profile'] = args.profile
+        for input_filepath, error in process_logs(args.batch, args.output_dir, args.workers, **options):
+            print(input_filepath + ': ' + (error if error else 'done'))
+    elif args.input:
+        process_log(args.input, args.output_dir, **options)
+        if args.profile:
+            print(profiler.summary())
+            profiler.save(args.profile)
+    else:
+        exit("should give log file")
        
 
 if __name__ == "__main__":
@@ -1 +1,2 @@
-from .ephemeris_manager import EphemerisManager
\ No newline at end of file
+from .ephemeris_manager import EphemerisManager
+from .epoch_cache import EpochCache
@@ -0,0 +1,102 @@
+import numpy as np
+
+
+LIGHTSPEED = 2.99792458e8
+# WGS-84 ellipsoid and earth rotation rate
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_EARTH_ROTATION = 7.2921151467e-5
+# Standard atmosphere at sea level (hPa, K) and the relative humidity assumed by the troposphere model
+STANDARD_PRESSURE = 1013.25
+STANDARD_TEMPERATURE = 288.15
+STANDARD_HUMIDITY = 0.5
+
+
+def ecef_to_geodetic(positions):
+    # (N, 3) ECEF to geodetic latitude, longitude (radians) and ellipsoidal height (m), Bowring's closed form
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    x, y, z = positions[:, 0], positions[:, 1], positions[:, 2]
+    e2 = WGS84_F * (2 - WGS84_F)
+    b = WGS84_A * (1 - WGS84_F)
+    ep2 = e2 / (1 - e2)
+    p = np.hypot(x, y)
+    theta = np.arctan2(z * WGS84_A, p * b)
+    latitude = np.arctan2(z + ep2 * b * np.sin(theta)**3, p - e2 * WGS84_A * np.cos(theta)**3)
+    longitude = np.arctan2(y, x)
+    n = WGS84_A / np.sqrt(1 - e2 * np.sin(latitude)**2)
+    height = p / np.cos(latitude) - n
+    return latitude, longitude, height
+
+
+def correction_geometry(receivers, satellites, receive_times, ionosphere=None):
+    """Everything the correction models need for N receiver/satellite pairs, computed once.
+
+    receivers and satellites are (N, 3) ECEF positions, receive_times GPS seconds of week and ionosphere the
+    8 Klobuchar coefficients (alpha 0-3, beta 0-3) or None. Returns a dict with the inputs plus the receiver
+    latitude, longitude and height and the elevation and azimuth of every satellite (radians).
+    """
+    receivers = np.asarray(receivers, dtype=float).reshape(-1, 3)
+    satellites = np.asarray(satellites, dtype=float).reshape(-1, 3)
+    latitude, longitude, height = ecef_to_geodetic(receivers)
+    offsets = satellites - receivers
+    sin_lat, cos_lat = np.sin(latitude), np.cos(latitude)
+    sin_lon, cos_lon = np.sin(longitude), np.cos(longitude)
+    east = -sin_lon * offsets[:, 0] + cos_lon * offsets[:, 1]
+    north = -sin_lat * cos_lon * offsets[:, 0] - sin_lat * sin_lon * offsets[:, 1] + cos_lat * offsets[:, 2]
+    up = cos_lat * cos_lon * offsets[:, 0] + cos_lat * sin_lon * offsets[:, 1] + sin_lat * offsets[:, 2]
+    return {'receivers': receivers, 'satellites': satellites, 'receive_times': np.asarray(receive_times, dtype=float),
+            'ionosphere': ionosphere, 'latitude': latitude, 'longitude': longitude, 'height': height,
+            'elevation': np.arctan2(up, np.hypot(east, north)), 'azimuth': np.arctan2(east, north)}
+
+
+def klobuchar_delay(geometry):
+    # GPS broadcast ionosphere model (IS-GPS-200 20.3.3.5.2.5), L1 delay in meters, zero without coefficients
+    if geometry['ionosphere'] is None:
+        return np.zeros(len(geometry['elevation']))
+    alpha, beta = np.asarray(geometry['ionosphere'], dtype=float).reshape(2, 4)
+    # The model works in semicircles
+    elevation = geometry['elevation'] / np.pi
+    azimuth = geometry['azimuth']
+    psi = 0.0137 / (elevation + 0.11) - 0.022
+    phi_i = np.clip(geometry['latitude'] / np.pi + psi * np.cos(azimuth), -0.416, 0.416)
+    lambda_i = geometry['longitude'] / np.pi + psi * np.sin(azimuth) / np.cos(phi_i * np.pi)
+    phi_m = phi_i + 0.064 * np.cos((lambda_i - 1.617) * np.pi)
+    local_time = (43200 * lambda_i + geometry['receive_times']) % 86400
+    obliquity = 1 + 16 * (0.53 - elevation)**3
+    amplitude = np.maximum(np.polyval(alpha[::-1], phi_m), 0)
+    period = np.maximum(np.polyval(beta[::-1], phi_m), 72000)
+    x = 2 * np.pi * (local_time - 50400) / period
+    delay = np.where(np.abs(x) < 1.57, 5e-9 + amplitude * (1 - x**2 / 2 + x**4 / 24), 5e-9)
+    return LIGHTSPEED * obliquity * delay
+
+
+def saastamoinen_delay(geometry):
+    # Saastamoinen zenith delays of a standard atmosphere at the receiver height, mapped with 1 / cos(zenith)
+    height = geometry['height']
+    valid = (height > -100) & (height < 1e4) & (geometry['elevation'] > 0)
+    height = np.where(valid, np.maximum(height, 0), 0)
+    pressure = STANDARD_PRESSURE * (1 - 2.2557e-5 * height)**5.2568
+    temperature = STANDARD_TEMPERATURE - 6.5e-3 * height
+    water_vapour = 6.108 * STANDARD_HUMIDITY * np.exp((17.15 * temperature - 4684) / (temperature - 38.45))
+    hydrostatic = 0.0022768 * pressure / (1 - 0.00266 * np.cos(2 * geometry['latitude']) - 0.00028 * height / 1e3)
+    wet = 0.002277 * (1255 / temperature + 0.05) * water_vapour
+    return np.where(valid, (hydrostatic + wet) / np.sin(np.where(valid, geometry['elevation'], np.pi / 2)), 0)
+
+
+def sagnac_delay(geometry):
+    # Earth rotation during the signal travel: range in the frame at reception minus range in the frame at transmission
+    receivers, satellites = geometry['receivers'], geometry['satellites']
+    return WGS84_EARTH_ROTATION / LIGHTSPEED * (satellites[:, 0] * receivers[:, 1] - satellites[:, 1] * receivers[:, 0])
+
+
+# Range corrections by name, every model takes a correction_geometry dict and returns the delay (m) of every pair
+CORRECTION_MODELS = {'ionosphere': klobuchar_delay, 'troposphere': saastamoinen_delay, 'sagnac': sagnac_delay}
+
+
+def total_delay(geometry, corrections):
+    # Sum of the delays of the named CORRECTION_MODELS, pairs a model can't evaluate (no fix yet) contribute 0
+    delay = np.zeros(len(geometry['elevation']))
+    for name in corrections:
+        model_delay = CORRECTION_MODELS[name](geometry)
+        delay += np.where(np.isfinite(model_delay), model_delay, 0)
+    return delay
@@ -1,109 +1,304 @@
 from ftplib import FTP_TLS, FTP
 import ftplib
 import gzip
+import hashlib
+import io
+import pickle
 import shutil
 import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-import georinex
-import xarray
 import unlzw3
 import pandas as pd
 import numpy as np
 
+from .ephemeris_sources import FtpSource, EphemerisNotFound
+from .rinex_nav import read_navigation, UnsupportedRinex
+
+
+# Bump when the layout of the parsed dataframe changes so stale sidecar caches are ignored
+PARSED_CACHE_VERSION = 1
+PARSED_CACHE_SUFFIX = '.parsed.pkl'
+# Concurrent downloads of prefetch, each worker keeps its own pooled connection
+PREFETCH_WORKERS = 4
+# Extensions of the archives' compressed navigation files
+COMPRESSED_EXTENSIONS = ('.gz', '.Z')
+
+
+class EphemerisShard():
+    """Navigation records of one UTC day, sorted by satellite then time so every satellite owns one
+    contiguous, time sorted slice that is searched with searchsorted.
+    """
+
+    def __init__(self, day, data, constellations=None, ionosphere=None):
+        self.day = day
+        self.constellations = constellations
+        # Klobuchar coefficients (alpha 0-3, beta 0-3) from the navigation file header, None if it has none
+        self.ionosphere = ionosphere
+        if 'sv' in data.columns:
+            data = data.sort_values(['sv', 'time'], kind='stable', ignore_index=True)
+            svs = data['sv'].to_numpy()
+        else:
+            svs = np.array([], dtype=object)
+        self.data = data
+        boundaries = np.flatnonzero(svs[1:] != svs[:-1]) + 1
+        starts = np.concatenate(([0], boundaries))
+        stops = np.concatenate((boundaries, [len(svs)]))
+        self.sv_index = {svs[start]: (start, stop) for start, stop in zip(starts, stops) if stop > start}
+        if 'time' in data.columns:
+            self.sv_times = data['time'].values.astype('datetime64[ns]').view('int64')
+        else:
+            self.sv_times = np.array([], dtype='int64')
+
+    def covers(self, constellations):
+        if self.constellations is None:
+            return True
+        return constellations is not None and constellations <= self.constellations
+
+    def has_satellites(self, satellites):
+        return np.array([sv in self.sv_index for sv in satellites], dtype=bool)
+
+    def find_rows(self, timestamps, satellites):
+        # Position in self.data of the last record of each satellite strictly before each timestamp (ns), -1 if none
+        rows = np.full(len(satellites), -1)
+        order = np.argsort(satellites, kind='stable')
+        sorted_satellites = satellites[order]
+        boundaries = np.flatnonzero(sorted_satellites[1:] != sorted_satellites[:-1]) + 1
+        for group in np.split(order, boundaries):
+            if group.size == 0 or satellites[group[0]] not in self.sv_index:
+                continue
+            start, stop = self.sv_index[satellites[group[0]]]
+            rows[group] = start + np.searchsorted(self.sv_times[start:stop], timestamps[group], side='left') - 1
+            rows[group[rows[group] < start]] = -1
+        return rows
+
+    def lookup(self, timestamps, satellites):
+        data = self.data.reindex(self.find_rows(timestamps, satellites))
+        return data.drop(['index', 'sv'], axis='columns', errors='ignore')
+
 
 class EphemerisManager():
-    def __init__(self, data_directory=os.path.join(os.getcwd(), 'data', 'ephemeris')):
+    def __init__(self, data_directory=os.path.join(os.getcwd(), 'data', 'ephemeris'), use_parsed_cache=True, max_shards=3, source=None,
+                 keep_compressed=True):
         self.data_directory = data_directory
+        self.use_parsed_cache = use_parsed_cache
+        # Downloads stay compressed on disk and are decompressed in memory when parsed, False restores the
+        # old decompress to disk and delete the archive behaviour
+        self.keep_compressed = keep_compressed
+        # Where missing navigation files are fetched from (see gnssutils.ephemeris_sources), the archives' FTP servers by default
+        self.source = source if source is not None else FtpSource()
         nasa_dir = os.path.join(data_directory, 'nasa')
         igs_dir = os.path.join(data_directory, 'igs')
         os.makedirs(nasa_dir, exist_ok=True)
         os.makedirs(igs_dir, exist_ok=True)
-        self.data = None
+        # One shard per UTC day, loaded when a timestamp of that day is requested and evicted least recently used first
+        self.shards = OrderedDict()
+        self.max_shards = max_shards
         self.leapseconds = None
 
     def get_ephemeris(self, timestamp, satellites):
-        systems = EphemerisManager.get_constellations(satellites)
-        if not isinstance(self.data, pd.DataFrame):
-            self.load_data(timestamp, systems)
-        data = self.data
         if satellites:
-            data = data.loc[data['sv'].isin(satellites)]
-        data = data.loc[data['time'] < timestamp]
-        data = data.sort_values('time').groupby(
-            'sv').last().drop('index', 'columns')
+            svs = sorted(set(satellites))
+        else:
+            svs = sorted(self.get_shard(timestamp, None).sv_index)
+        data = self.get_ephemeris_batch([timestamp] * len(svs), svs)
+        return data.loc[data['time'].notna()]
+
+    def get_ephemeris_batch(self, timestamps, satellites):
+        """Resolve the most recent ephemeris before each timestamp for every (timestamp, satellite) pair.
+
+        Timestamps may span several UTC days, each day is looked up in its own shard and a satellite
+        without a record yet on that day falls back to the previous day. Returns one row per input pair
+        in the same order, indexed by sv. Pairs without an ephemeris get a row of NaN.
+        """
+        timestamps = pd.DatetimeIndex(pd.to_datetime(timestamps, utc=True))
+        satellites = np.asarray(satellites, dtype=object)
+        systems = EphemerisManager.get_constellations(list(set(satellites)))
+        days = timestamps.floor('D')
+        parts, positions = [], []
+        for day in days.unique():
+            selected = np.flatnonzero(days == day)
+            shard = self.get_shard(day, systems)
+            data = shard.lookup(timestamps.asi8[selected], satellites[selected])
+            early = data['time'].isna().to_numpy() & shard.has_satellites(satellites[selected]) if 'time' in data.columns \
+                else np.zeros(len(selected), dtype=bool)
+            if early.any():
+                try:
+                    previous = self.get_shard(day - timedelta(days=1), systems)
+                except EphemerisNotFound:
+                    # Without the previous day those satellites have no ephemeris yet
+                    previous = EphemerisShard(day - timedelta(days=1), pd.DataFrame())
+                parts.append(previous.lookup(timestamps.asi8[selected[early]], satellites[selected[early]]))
+                positions.append(selected[early])
+            parts.append(data.loc[~early])
+            positions.append(selected[~early])
+        data = pd.concat(parts, ignore_index=True).iloc[np.argsort(np.concatenate(positions), kind='stable')]
+        data.index = pd.Index(satellites, name='sv')
         data['Leap Seconds'] = self.leapseconds
         return data
 
+    def get_shard(self, timestamp, constellations=None):
+        timestamp = pd.Timestamp(timestamp)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.tz_localize('UTC')
+        day = timestamp.tz_convert('UTC').floor('D')
+        shard = self.shards.get(day)
+        if shard is None or not shard.covers(constellations):
+            if shard is not None and constellations is not None:
+                constellations = constellations | shard.constellations
+            shard = self.load_data(day.to_pydatetime(), constellations)
+        self.shards.move_to_end(day)
+        return shard
+
     def get_leapseconds(self, timestamp):
         return self.leapseconds
 
-    def load_data(self, timestamp, constellations=None):
+    def get_ionosphere(self, timestamp, constellations=None):
+        return self.get_shard(timestamp, constellations).ionosphere
+
+    @staticmethod
+    def required_files(timestamp, constellations=None):
+        # The navigation files of the UTC day of timestamp that hold the constellations (None for every file)
         filepaths = EphemerisManager.get_filepaths(timestamp)
-        data_list = []
-        timestamp_age = datetime.now(timezone.utc) - timestamp
         if constellations == None:
-            for fileinfo in filepaths.values():
-                data = self.get_ephemeris_dataframe(fileinfo)
-                data_list.append(data)
-        else:
-            legacy_systems = set(['G', 'R'])
-            legacy_systems_only = len(constellations - legacy_systems) == 0
-            if timestamp_age.days > 0:
-                if legacy_systems_only:
-                    data_list.append(self.get_ephemeris_dataframe(
-                        filepaths['nasa_daily_gps']))
-                    if 'R' in constellations:
-                        data_list.append(self.get_ephemeris_dataframe(
-                            filepaths['nasa_daily_glonass']))
-                else:
-                    data_list.append(self.get_ephemeris_dataframe(
-                        filepaths['nasa_daily_combined']))
-            else:
-                data_list.append(self.get_ephemeris_dataframe(
-                    filepaths['nasa_daily_gps']))
-                if not legacy_systems_only:
-                    data_list.append(self.get_ephemeris_dataframe(
-                        filepaths['bkg_daily_combined']))
+            return list(filepaths.values())
+        timestamp_age = datetime.now(timezone.utc) - timestamp
+        legacy_systems = set(['G', 'R'])
+        legacy_systems_only = len(constellations - legacy_systems) == 0
+        if timestamp_age.days > 0:
+            if legacy_systems_only:
+                required = [filepaths['nasa_daily_gps']]
+                if 'R' in constellations:
+                    required.append(filepaths['nasa_daily_glonass'])
+                return required
+            return [filepaths['nasa_daily_combined']]
+        required = [filepaths['nasa_daily_gps']]
+        if not legacy_systems_only:
+            required.append(filepaths['bkg_daily_combined'])
+        return required
+
+    def load_data(self, timestamp, constellations=None):
+        # A missing file only matters when none of the day's files could be loaded, that raises EphemerisNotFound
+        data_list, errors = [], []
+        for fileinfo in EphemerisManager.required_files(timestamp, constellations):
+            try:
+                data_list.append(self.get_ephemeris_dataframe(fileinfo))
+            except EphemerisNotFound as err:
+                print(err, file=sys.stderr)
+                errors.append(str(err))
+        if not data_list:
+            raise EphemerisNotFound('no navigation file for ' + pd.Timestamp(timestamp).strftime('%Y-%m-%d') + ': ' + '; '.join(errors))
 
         data = pd.DataFrame()
         data = data.append(data_list, ignore_index=True)
         data.reset_index(inplace=True)
-        data.sort_values('time', inplace=True, ignore_index=True)
-        self.data = data
+        day = pd.Timestamp(timestamp).floor('D')
+        ionosphere = None
+        for source in (data['source'].dropna().unique() if 'source' in data.columns else []):
+            ionosphere = EphemerisManager.load_ionosphere(source)
+            if ionosphere is not None:
+                break
+        return self.add_shard(EphemerisShard(day, data, constellations, ionosphere))
 
-    def get_ephemeris_dataframe(self, fileinfo, constellations=None):
-        filepath = fileinfo['filepath']
-        url = fileinfo['url']
-        directory = os.path.split(filepath)[0]
-        filename = os.path.split(filepath)[1]
-        if url == 'igs.bkg.bund.de':
+    def add_shard(self, shard):
+        self.shards[shard.day] = shard
+        self.shards.move_to_end(shard.day)
+        while len(self.shards) > self.max_shards:
+            self.shards.popitem(last=False)
+        return shard
+
+    def local_filepath(self, fileinfo):
+        # Where the archive file of fileinfo is downloaded to, and where a decompressed copy would be
+        filename = os.path.split(fileinfo['filepath'])[1]
+        if fileinfo['url'] == 'igs.bkg.bund.de':
             dest_filepath = os.path.join(self.data_directory, 'igs', filename)
         else:
             dest_filepath = os.path.join(self.data_directory, 'nasa', filename)
-        decompressed_filename = os.path.splitext(dest_filepath)[0]
-        if not os.path.isfile(decompressed_filename):
-            if url == 'gdc.cddis.eosdis.nasa.gov':
-                secure = True
-            else:
-                secure = False
+        return dest_filepath, os.path.splitext(dest_filepath)[0]
+
+    def navigation_filepath(self, fileinfo):
+        # The file of fileinfo already on disk, a decompressed copy (older data directories) before the archive, else None
+        dest_filepath, decompressed_filename = self.local_filepath(fileinfo)
+        for filepath in (decompressed_filename, dest_filepath):
+            if os.path.isfile(filepath):
+                return filepath
+        return None
+
+    def fetch_file(self, fileinfo):
+        # Download the file of fileinfo unless it is already on disk and return its path, raises EphemerisNotFound
+        filepath = self.navigation_filepath(fileinfo)
+        if filepath is None:
+            dest_filepath, decompressed_filename = self.local_filepath(fileinfo)
+            self.source.fetch(fileinfo['url'], fileinfo['filepath'], dest_filepath)
+            if self.keep_compressed:
+                return dest_filepath
+            self.decompress_file(dest_filepath)
+            return decompressed_filename
+        return filepath
+
+    def prefetch(self, timestamps, constellations=None, workers=PREFETCH_WORKERS):
+        """Fetch the navigation files of every UTC day of timestamps concurrently, ahead of get_shard.
+
+        Returns (archive path, error or None) for every file that was needed; files already on disk cost nothing.
+        """
+        days = sorted({pd.Timestamp(timestamp).tz_convert('UTC').floor('D') if pd.Timestamp(timestamp).tzinfo is not None
+                       else pd.Timestamp(timestamp).tz_localize('UTC').floor('D') for timestamp in timestamps})
+        fileinfos = {}
+        for day in days:
+            for fileinfo in EphemerisManager.required_files(day.to_pydatetime(), constellations):
+                fileinfos[fileinfo['filepath']] = fileinfo
+
+        def fetch(fileinfo):
             try:
-                self.retrieve_file(url, directory, filename,
-                                   dest_filepath, secure)
-                self.decompress_file(dest_filepath)
-            except ftplib.error_perm as err:
-                print('ftp error')
-                return pd.DataFrame()
+                self.fetch_file(fileinfo)
+                return fileinfo['filepath'], None
+            except EphemerisNotFound as err:
+                return fileinfo['filepath'], str(err)
+
+        with ThreadPoolExecutor(max_workers=max(min(workers, len(fileinfos)), 1)) as executor:
+            return list(executor.map(fetch, fileinfos.values()))
+
+    def get_ephemeris_dataframe(self, fileinfo, constellations=None):
+        # Raises EphemerisNotFound when the file is neither on disk nor available from self.source
+        filepath = self.fetch_file(fileinfo)
         if not self.leapseconds:
             self.leapseconds = EphemerisManager.load_leapseconds(
-                decompressed_filename)
-        if constellations:
-            data = georinex.load(decompressed_filename,
-                                 use=constellations).to_dataframe()
-        else:
-            data = georinex.load(decompressed_filename).to_dataframe()
-        data.dropna(how='all', inplace=True)
-        data.reset_index(inplace=True)
-        data['source'] = decompressed_filename
+                filepath)
+        if self.use_parsed_cache:
+            data = EphemerisManager.load_parsed_cache(filepath, constellations)
+            if data is not None:
+                return data
+        data = EphemerisManager.parse_rinex(filepath, constellations)
+        if self.use_parsed_cache:
+            EphemerisManager.save_parsed_cache(filepath, constellations, data)
+        return data
+
+    @staticmethod
+    def open_navigation(filepath):
+        """Text stream of a navigation file, plain or compressed as published (.gz, .Z).
+
+        gzip archives are decompressed while they are read, so header scans stop early without inflating the
+        whole file. LZW has no streaming decoder, a .Z archive is decompressed in memory in one go.
+        """
+        extension = os.path.splitext(filepath)[1]
+        if extension == '.gz':
+            return gzip.open(filepath, 'rt', encoding='ascii', errors='ignore')
+        if extension == '.Z':
+            with open(filepath, 'rb') as f:
+                return io.StringIO(unlzw3.unlzw(f.read()).decode('ascii', errors='ignore'))
+        return open(filepath, encoding='ascii', errors='ignore')
+
+    @staticmethod
+    def parse_rinex(filepath, constellations=None):
+        # The native parser reads the records straight from the (decompressing) stream, georinex only gets what it can't read
+        try:
+            with EphemerisManager.open_navigation(filepath) as f:
+                data = read_navigation(f, constellations)
+        except UnsupportedRinex:
+            data = EphemerisManager.load_georinex(filepath, constellations)
+        data['source'] = filepath
         WEEKSEC = 604800
         data['t_oc'] = pd.to_numeric(data['time'] - datetime(1980, 1, 6, 0, 0, 0))
         data['t_oc']  = 1e-9 * data['t_oc'] - WEEKSEC * np.floor(1e-9 * data['t_oc'] / WEEKSEC)
@@ -112,6 +307,67 @@ class EphemerisManager():
                              'Cic': 'C_ic', 'Crc': 'C_rc', 'Cis': 'C_is', 'Crs': 'C_rs', 'Io': 'i_0', 'Omega0': 'Omega_0'}, inplace=True)
         return data
 
+    @staticmethod
+    def load_georinex(filepath, constellations=None):
+        # georinex (and xarray behind it) is slow to import, it is only loaded for files the native parser rejects
+        import georinex
+        if os.path.splitext(filepath)[1] in COMPRESSED_EXTENSIONS:
+            # georinex opens its input several times, decompress once into memory and hand it the text
+            with EphemerisManager.open_navigation(filepath) as f:
+                rinex = io.StringIO(f.read())
+        else:
+            rinex = filepath
+        if constellations:
+            data = georinex.load(rinex,
+                                 use=constellations).to_dataframe()
+        else:
+            data = georinex.load(rinex).to_dataframe()
+        data.dropna(how='all', inplace=True)
+        data.reset_index(inplace=True)
+        return data
+
+    @staticmethod
+    def file_hash(filepath):
+        sha1 = hashlib.sha1()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    @staticmethod
+    def load_parsed_cache(filepath, constellations=None):
+        # The sidecar is trusted when size and mtime match, a touched but unchanged file is accepted by its hash
+        cache_filepath = filepath + PARSED_CACHE_SUFFIX
+        if not os.path.isfile(cache_filepath):
+            return None
+        try:
+            with open(cache_filepath, 'rb') as f:
+                cached = pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+        stat = os.stat(filepath)
+        if cached.get('version') != PARSED_CACHE_VERSION or cached.get('constellations') != sorted(constellations or []) \
+                or cached.get('size') != stat.st_size:
+            return None
+        if cached.get('mtime') != stat.st_mtime and cached.get('sha1') != EphemerisManager.file_hash(filepath):
+            return None
+        return cached['data']
+
+    @staticmethod
+    def save_parsed_cache(filepath, constellations, data):
+        stat = os.stat(filepath)
+        cached = {'version': PARSED_CACHE_VERSION, 'constellations': sorted(constellations or []), 'size': stat.st_size,
+                  'mtime': stat.st_mtime, 'sha1': EphemerisManager.file_hash(filepath), 'data': data}
+        # Write next to the file and rename so concurrent processes never read a partial cache
+        temp_filepath = filepath + PARSED_CACHE_SUFFIX + '.' + str(os.getpid())
+        try:
+            with open(temp_filepath, 'wb') as f:
+                pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_filepath, filepath + PARSED_CACHE_SUFFIX)
+        except OSError:
+            if os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
+
     @staticmethod
     def get_filetype(timestamp):
         # IGS switched from .Z to .gz compression format on December 1st, 2020
@@ -123,13 +379,34 @@ class EphemerisManager():
 
     @staticmethod
     def load_leapseconds(filename):
-        with open(filename) as f:
+        with EphemerisManager.open_navigation(filename) as f:
             for line in f:
                 if 'LEAP SECONDS' in line:
                     return int(line.split()[0])
                 if 'END OF HEADER' in line:
                     return None
 
+    @staticmethod
+    def load_ionosphere(filename):
+        # GPS Klobuchar alpha and beta from a RINEX 2 (ION ALPHA/BETA) or RINEX 3 (IONOSPHERIC CORR GPSA/GPSB) header
+        coefficients = {}
+        try:
+            with EphemerisManager.open_navigation(filename) as f:
+                for line in f:
+                    label = line[60:].strip()
+                    if label in ('ION ALPHA', 'ION BETA'):
+                        coefficients[label[4]] = line[2:50]
+                    elif label == 'IONOSPHERIC CORR' and line[:4] in ('GPSA', 'GPSB'):
+                        coefficients[line[3]] = line[5:53]
+                    elif label == 'END OF HEADER':
+                        break
+        except (OSError, EOFError):
+            return None
+        if set(coefficients) != {'A', 'B'}:
+            return None
+        fields = coefficients['A'] + coefficients['B']
+        return np.array([float(fields[i:i + 12].replace('D', 'E')) for i in range(0, 96, 12)])
+
     @staticmethod
     def get_constellations(satellites):
         if type(satellites) is list:
@@ -145,18 +422,12 @@ class EphemerisManager():
         pass
 
     def retrieve_file(self, url, directory, filename, dest_filepath, secure=False):
-        print('Retrieving ' + directory + '/' + filename + ' from ' + url)
-        ftp = self.connect(url, secure)
-        src_filepath = directory + '/' + filename
+        # Kept for callers of the old API, the source decides on TLS by itself
         try:
-            with open(dest_filepath, 'wb') as handle:
-                ftp.retrbinary(
-                    'RETR ' + src_filepath, handle.write)
-        except ftplib.error_perm as err:
-            print('Failed to retrieve ' + src_filepath + ' from ' + url)
-            print(err)
-            os.remove(dest_filepath)
-            raise ftplib.error_perm
+            self.source.fetch(url, directory + '/' + filename, dest_filepath)
+        except EphemerisNotFound as err:
+            print(err, file=sys.stderr)
+            raise ftplib.error_perm(str(err))
 
     def decompress_file(self, filepath):
         extension = os.path.splitext(filepath)[1]
@@ -0,0 +1,190 @@
+import ftplib
+import os
+import shutil
+import sys
+import threading
+from contextlib import contextmanager
+from ftplib import FTP_TLS, FTP
+
+
+# Hosts that only accept FTP over TLS
+SECURE_HOSTS = {'gdc.cddis.eosdis.nasa.gov'}
+# Idle connections kept open per host
+MAX_IDLE_CONNECTIONS = 4
+
+
+class EphemerisNotFound(LookupError):
+    """The source has no such file (or is unreachable and has nothing cached)."""
+
+
+class EphemerisSource():
+    """Where navigation files come from. fetch(host, remote_path, dest_filepath) writes the file as published
+    (compressed) to dest_filepath or raises EphemerisNotFound; it must be safe to call from several threads."""
+
+    def fetch(self, host, remote_path, dest_filepath):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def write_atomically(dest_filepath, write):
+    # write(handle) fills a temporary file next to dest_filepath that replaces it once complete
+    temp_filepath = dest_filepath + '.part.' + str(os.getpid()) + '.' + str(threading.get_ident())
+    try:
+        with open(temp_filepath, 'wb') as handle:
+            write(handle)
+        os.replace(temp_filepath, dest_filepath)
+    finally:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+
+
+class FtpSource(EphemerisSource):
+    """The archives' FTP servers, with one pool of logged in connections per host.
+
+    A connection is borrowed for one download and handed back afterwards, so a batch pays the TLS handshake
+    and login once per worker thread instead of once per file. address ('host:port') sends every request
+    to that server instead, in plain FTP, which is how a local FTP mirror of the archive is used.
+    """
+
+    def __init__(self, address=None, secure_hosts=SECURE_HOSTS, max_idle=MAX_IDLE_CONNECTIONS, timeout=60):
+        self.address = address
+        self.secure_hosts = set(secure_hosts)
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def connect(self, host):
+        if self.address is not None:
+            server, port = self.address.rsplit(':', 1) if ':' in self.address else (self.address, 21)
+            ftp = FTP(timeout=self.timeout)
+            ftp.connect(server, int(port))
+            ftp.login()
+        elif host in self.secure_hosts:
+            ftp = FTP_TLS(host, timeout=self.timeout)
+            ftp.login()
+            ftp.prot_p()
+        else:
+            ftp = FTP(host, timeout=self.timeout)
+            ftp.login()
+        return ftp
+
+    @contextmanager
+    def connection(self, host):
+        with self.lock:
+            pool = self.idle.setdefault(host, [])
+            ftp = pool.pop() if pool else None
+        if ftp is None:
+            ftp = self.connect(host)
+        try:
+            yield ftp
+        except ftplib.error_perm:
+            # The server answered, the connection is still good
+            self.release(host, ftp)
+            raise
+        except BaseException:
+            self.discard(ftp)
+            raise
+        else:
+            self.release(host, ftp)
+
+    def release(self, host, ftp):
+        with self.lock:
+            pool = self.idle.setdefault(host, [])
+            if len(pool) < self.max_idle:
+                pool.append(ftp)
+                return
+        self.discard(ftp)
+
+    @staticmethod
+    def discard(ftp):
+        try:
+            ftp.close()
+        except Exception:
+            pass
+
+    def fetch(self, host, remote_path, dest_filepath):
+        print('Retrieving ' + remote_path + ' from ' + (self.address or host), file=sys.stderr)
+        # A pooled connection may have timed out on the server side, a fresh one gets a second try
+        for attempt in range(2):
+            try:
+                with self.connection(host) as ftp:
+                    write_atomically(dest_filepath, lambda handle: ftp.retrbinary('RETR ' + remote_path, handle.write))
+                return
+            except ftplib.error_perm as err:
+                raise EphemerisNotFound('failed to retrieve ' + remote_path + ' from ' + (self.address or host) + ': ' + str(err))
+            except (OSError, EOFError, ftplib.error_temp, ftplib.error_reply) as err:
+                if attempt:
+                    raise EphemerisNotFound('failed to retrieve ' + remote_path + ' from ' + (self.address or host) + ': ' + repr(err))
+
+    def close(self):
+        with self.lock:
+            pools, self.idle = self.idle, {}
+        for pool in pools.values():
+            for ftp in pool:
+                try:
+                    ftp.quit()
+                except Exception:
+                    self.discard(ftp)
+
+
+class MirrorSource(EphemerisSource):
+    """A local copy of the archives, for nodes without network access.
+
+    A file is looked up as root/<host>/<remote path>, the layout of a recursive wget or lftp mirror, then as
+    root/<remote path> and finally as root/<file name> for a flat directory of navigation files.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def candidates(self, host, remote_path):
+        relative = remote_path.lstrip('/')
+        return [os.path.join(self.root, host, relative), os.path.join(self.root, relative),
+                os.path.join(self.root, os.path.basename(relative))]
+
+    def fetch(self, host, remote_path, dest_filepath):
+        for candidate in self.candidates(host, remote_path):
+            if os.path.isfile(candidate):
+                with open(candidate, 'rb') as mirrored:
+                    write_atomically(dest_filepath, lambda handle: shutil.copyfileobj(mirrored, handle))
+                return
+        raise EphemerisNotFound(os.path.basename(remote_path) + ' is not in the mirror ' + self.root)
+
+
+class SourceChain(EphemerisSource):
+    # Try every source in order, a mirror first and the network after it for example
+    def __init__(self, sources):
+        self.sources = list(sources)
+
+    def fetch(self, host, remote_path, dest_filepath):
+        errors = []
+        for source in self.sources:
+            try:
+                return source.fetch(host, remote_path, dest_filepath)
+            except EphemerisNotFound as err:
+                errors.append(str(err))
+        raise EphemerisNotFound('; '.join(errors) or 'no ephemeris source')
+
+    def close(self):
+        for source in self.sources:
+            source.close()
+
+
+def open_source(spec):
+    """Build a source from a comma separated spec: 'ftp' for the archives, 'ftp://host:port' for a local FTP
+    mirror and a directory path (optionally 'dir:path') for a local mirror, tried in the given order."""
+    sources = []
+    for part in spec.split(','):
+        part = part.strip()
+        if part == 'ftp':
+            sources.append(FtpSource())
+        elif part.startswith('ftp://'):
+            sources.append(FtpSource(address=part[len('ftp://'):].rstrip('/')))
+        elif part:
+            sources.append(MirrorSource(part[len('dir:'):] if part.startswith('dir:') else part))
+    if not sources:
+        raise ValueError('empty ephemeris source ' + repr(spec))
+    return sources[0] if len(sources) == 1 else SourceChain(sources)
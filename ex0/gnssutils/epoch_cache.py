@@ -0,0 +1,44 @@
+from collections import OrderedDict
+
+
+class EpochCache():
+    """Bounded LRU cache of epoch key -> (ephemeris rows, satellite states).
+
+    Keys are built by the caller from the epoch timestamp and its satellites only. The cached
+    satellite states also depend on the transmit times of the call that filled the entry, so a
+    hit is only right when the same epoch with the same satellites comes with the same
+    measurements (the same log processed again). Clear the cache before solving measurements
+    that differ under equal keys. maxsize=None keeps every entry.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+# PZ-90.11 constants from the GLONASS ICD
+GLONASS_GM = 398600.4418e9
+GLONASS_EARTH_RADIUS = 6378136.0
+GLONASS_J2 = 1.08262575e-3
+GLONASS_EARTH_ROTATION = 7.292115e-5
+# GLONASS time runs on UTC(SU), three hours ahead of UTC
+GLONASS_UTC_OFFSET = 3 * 3600
+# The ICD recommends integration steps of at most a minute
+GLONASS_MAX_STEP = 60.0
+
+
+def glonass_derivatives(states, accelerations):
+    """Time derivative of (N, 6) ECEF position/velocity states under the PZ-90 J2 force model.
+
+    accelerations is the (N, 3) luni-solar acceleration broadcast with the ephemeris, held constant.
+    """
+    position = states[:, 0:3]
+    velocity = states[:, 3:6]
+    r2 = np.einsum('ij,ij->i', position, position)
+    r = np.sqrt(r2)
+    mu_r3 = GLONASS_GM / (r2 * r)
+    j2_term = 1.5 * GLONASS_J2 * GLONASS_GM * GLONASS_EARTH_RADIUS**2 / (r2 * r2 * r)
+    z2_r2 = position[:, 2]**2 / r2
+    omega2 = GLONASS_EARTH_ROTATION**2
+
+    derivatives = np.empty_like(states)
+    derivatives[:, 0:3] = velocity
+    derivatives[:, 3] = (-mu_r3 - j2_term * (1 - 5 * z2_r2) + omega2) * position[:, 0] \
+        + 2 * GLONASS_EARTH_ROTATION * velocity[:, 1] + accelerations[:, 0]
+    derivatives[:, 4] = (-mu_r3 - j2_term * (1 - 5 * z2_r2) + omega2) * position[:, 1] \
+        - 2 * GLONASS_EARTH_ROTATION * velocity[:, 0] + accelerations[:, 1]
+    derivatives[:, 5] = (-mu_r3 - j2_term * (3 - 5 * z2_r2)) * position[:, 2] + accelerations[:, 2]
+    return derivatives
+
+
+def propagate_glonass(states, accelerations, dt, max_step=GLONASS_MAX_STEP):
+    """Propagate (N, 6) broadcast states by dt seconds (scalar or (N,)) with fourth order Runge-Kutta.
+
+    Every row takes the same number of steps, sized so the longest propagation uses steps of at most
+    max_step seconds; shorter propagations just use smaller steps, which keeps the loop fully vectorized.
+    """
+    states = np.array(states, dtype=float).reshape(-1, 6)
+    accelerations = np.asarray(accelerations, dtype=float).reshape(-1, 3)
+    dt = np.broadcast_to(np.asarray(dt, dtype=float), (len(states),))
+    finite = np.isfinite(dt)
+    if not finite.any():
+        return states
+    steps = max(int(np.ceil(np.abs(dt[finite]).max() / max_step)), 1)
+    h = (dt / steps)[:, None]
+    for _ in range(steps):
+        k1 = glonass_derivatives(states, accelerations)
+        k2 = glonass_derivatives(states + h / 2 * k1, accelerations)
+        k3 = glonass_derivatives(states + h / 2 * k2, accelerations)
+        k4 = glonass_derivatives(states + h * k3, accelerations)
+        states = states + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+    return states
+
+
+def glonass_satellite_states(transmit_times, ephemeris, leap_seconds):
+    """Satellite ECEF positions and clock biases for GLONASS rows.
+
+    transmit_times are GPS seconds of week, ephemeris holds the georinex GLONASS fields (meters) plus
+    t_oc, the seconds of week of the reference time tb (on the UTC scale, like the RINEX epoch), and
+    leap_seconds is GPS - UTC. Returns (time from tb, clock bias, (N, 3) positions).
+    """
+    transmit_times = np.asarray(transmit_times, dtype=float)
+    t_b = np.asarray(ephemeris['t_oc'], dtype=float) + np.asarray(leap_seconds, dtype=float)
+    # Wrap into half a week either side of tb so week crossings don't propagate for days
+    dt = (transmit_times - t_b + 302400) % 604800 - 302400
+    states = np.column_stack([np.asarray(ephemeris[col], dtype=float) for col in ['X', 'Y', 'Z', 'dX', 'dY', 'dZ']])
+    accelerations = np.column_stack([np.asarray(ephemeris[col], dtype=float) for col in ['dX2', 'dY2', 'dZ2']])
+    # RINEX stores -TauN and +GammaN, so the clock correction is -TauN + GammaN * (t - tb)
+    clock_bias = np.asarray(ephemeris['SVclockBias'], dtype=float) + np.asarray(ephemeris['SVrelFreqBias'], dtype=float) * dt
+    return dt, clock_bias, propagate_glonass(states, accelerations, dt)[:, 0:3]
@@ -0,0 +1,78 @@
+import os
+import select
+import socket
+import sys
+import time
+
+
+# Seconds between two looks at a source that had nothing new
+POLL_INTERVAL = 0.2
+
+
+def follow_file(filepath, poll_interval=POLL_INTERVAL, idle_timeout=None):
+    """Yield the lines of a log that is still being written, like tail -f from the first line.
+
+    A line is only yielded once its newline has been written. None is yielded after every poll that found
+    nothing new, so the consumer can act on idle time, and the generator stops once idle_timeout seconds
+    pass without a new line (None follows the file forever).
+    """
+    with open(filepath) as logfile:
+        partial = ''
+        idle_since = time.monotonic()
+        while True:
+            line = logfile.readline()
+            if line:
+                partial += line
+                if partial.endswith('\n'):
+                    yield partial
+                    partial = ''
+                    idle_since = time.monotonic()
+                continue
+            if idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+                break
+            yield None
+            time.sleep(poll_interval)
+        if partial:
+            yield partial
+
+
+def stream_lines(readable, poll_interval=POLL_INTERVAL):
+    """Yield the lines of a pipe or socket as they arrive and None after every poll_interval without data, until EOF."""
+    if isinstance(readable, socket.socket):
+        read = readable.recv
+    else:
+        read = lambda size: os.read(readable.fileno(), size)
+    pending = b''
+    while True:
+        ready, _, _ = select.select([readable], [], [], poll_interval)
+        if not ready:
+            yield None
+            continue
+        chunk = read(1 << 16)
+        if not chunk:
+            break
+        pending += chunk
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            yield line.decode() + '\n'
+    if pending:
+        yield pending.decode()
+
+
+def socket_lines(host, port, poll_interval=POLL_INTERVAL):
+    connection = socket.create_connection((host, port))
+    try:
+        yield from stream_lines(connection, poll_interval)
+    finally:
+        connection.close()
+
+
+def open_line_source(source, poll_interval=POLL_INTERVAL, idle_timeout=None):
+    """Lines of a live log: '-' reads stdin, 'tcp://host:port' connects to a local socket and anything else
+    is followed as a growing file (see follow_file)."""
+    if source == '-':
+        return stream_lines(sys.stdin, poll_interval)
+    if source.startswith('tcp://'):
+        host, port = source[len('tcp://'):].rsplit(':', 1)
+        return socket_lines(host or 'localhost', int(port), poll_interval)
+    return follow_file(source, poll_interval, idle_timeout)
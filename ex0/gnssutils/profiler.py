@@ -0,0 +1,103 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Profiler():
+    """Wall time, call count, rows and traced memory of named pipeline stages.
+
+    Every stage() call is recorded as one complete event of the Chrome trace format, so save() writes a
+    file chrome://tracing or Perfetto opens directly, and the events are aggregated per stage name for
+    summary(). Stages that belong to one epoch pass epoch=, which also keeps them in the per epoch table.
+    A disabled profiler records nothing and its stage() costs one attribute check.
+    """
+
+    def __init__(self, enabled=False, memory=True):
+        self.enabled = False
+        self.memory = memory
+        self.events = []
+        self.stages = OrderedDict()
+        self.epochs = OrderedDict()
+        self.origin = time.perf_counter()
+        self.started_tracemalloc = False
+        if enabled:
+            self.enable()
+
+    def enable(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        self.enabled = True
+
+    def disable(self):
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+        self.enabled = False
+
+    def reset(self):
+        self.events = []
+        self.stages = OrderedDict()
+        self.epochs = OrderedDict()
+        self.origin = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, rows=None, epoch=None, **args):
+        """Time the body as stage name. rows may be given up front or set on the yielded dict (record['rows'] = n)
+        once the body knows them; extra keyword arguments end up in the trace event."""
+        if not self.enabled:
+            yield {}
+            return
+        record = {'rows': rows}
+        memory_before = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            duration = time.perf_counter() - start
+            memory_delta = tracemalloc.get_traced_memory()[0] - memory_before if memory_before is not None else None
+            self.add(name, start, duration, record.get('rows'), memory_delta, epoch, args)
+
+    def add(self, name, start, duration, rows=None, memory_delta=None, epoch=None, args=None):
+        event_args = dict(args or {})
+        if rows is not None:
+            event_args['rows'] = int(rows)
+        if memory_delta is not None:
+            event_args['memory_delta'] = int(memory_delta)
+        if epoch is not None:
+            event_args['epoch'] = int(epoch)
+        self.events.append({'name': name, 'ph': 'X', 'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6,
+                            'pid': os.getpid(), 'tid': threading.get_ident(), 'args': event_args})
+        totals = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0, 'memory_delta': 0})
+        totals['calls'] += 1
+        totals['seconds'] += duration
+        totals['max_seconds'] = max(totals['max_seconds'], duration)
+        totals['rows'] += int(rows or 0)
+        totals['memory_delta'] += int(memory_delta or 0)
+        if epoch is not None:
+            epoch_totals = self.epochs.setdefault(int(epoch), {'seconds': 0.0, 'rows': 0})
+            epoch_totals['seconds'] += duration
+            epoch_totals['rows'] += int(rows or 0)
+
+    def summary(self):
+        # Stage table sorted as the stages first ran, plus a line on the epoch latencies when there are any
+        lines = ['%-28s %7s %10s %10s %10s %12s %12s' % ('stage', 'calls', 'total s', 'mean ms', 'max ms', 'rows', 'memory MiB')]
+        for name, totals in self.stages.items():
+            lines.append('%-28s %7d %10.4f %10.3f %10.3f %12d %12.2f' % (
+                name, totals['calls'], totals['seconds'], 1e3 * totals['seconds'] / totals['calls'], 1e3 * totals['max_seconds'],
+                totals['rows'], totals['memory_delta'] / 2**20))
+        if self.epochs:
+            seconds = [totals['seconds'] for totals in self.epochs.values()]
+            lines.append('%d epochs: mean %.3f ms, max %.3f ms (epoch %d)' % (
+                len(seconds), 1e3 * sum(seconds) / len(seconds), 1e3 * max(seconds), max(self.epochs, key=lambda e: self.epochs[e]['seconds'])))
+        return '\n'.join(lines)
+
+    def save(self, filepath):
+        # Chrome trace JSON, the per stage and per epoch totals ride along in otherData
+        with open(filepath, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms',
+                       'otherData': {'stages': self.stages, 'epochs': {str(epoch): totals for epoch, totals in self.epochs.items()}}}, f)
@@ -0,0 +1,180 @@
+import numpy as np
+import pandas as pd
+
+
+# Width of a broadcast orbit field and the column the fields start at on the continuation lines, by RINEX major version
+FIELD_WIDTH = 19
+FIRST_COLUMN = {2: 3, 3: 4}
+# Broadcast orbit lines that follow the epoch line of a record, by system
+RECORD_LINES = {'G': 7, 'E': 7, 'C': 7, 'J': 7, 'I': 7, 'R': 3, 'S': 3}
+# georinex column names of every record, in file order, so the output matches what georinex.load().to_dataframe() gives
+KEPLER_FIELDS = ['SVclockBias', 'SVclockDrift', 'SVclockDriftRate', 'IODE', 'Crs', 'DeltaN', 'M0', 'Cuc', 'Eccentricity', 'Cus',
+                 'sqrtA', 'Toe', 'Cic', 'Omega0', 'Cis', 'Io', 'Crc', 'omega', 'OmegaDot', 'IDOT']
+GPS_FIELDS = KEPLER_FIELDS + ['CodesL2', 'GPSWeek', 'L2Pflag', 'SVacc', 'health', 'TGD', 'IODC', 'TransTime', 'FitIntvl', 'spare0', 'spare1']
+GLONASS_FIELDS = ['SVclockBias', 'SVrelFreqBias', 'MessageFrameTime', 'X', 'dX', 'dX2', 'health', 'Y', 'dY', 'dY2', 'FreqNum',
+                  'Z', 'dZ', 'dZ2', 'AgeOpInfo']
+NAV_FIELDS = {
+    'G': GPS_FIELDS,
+    'J': GPS_FIELDS,
+    'E': KEPLER_FIELDS[:3] + ['IODnav'] + KEPLER_FIELDS[4:] + ['DataSrc', 'GALWeek', 'spare0', 'SISA', 'health', 'BGDe5a', 'BGDe5b',
+                                                              'TransTime', 'spare1', 'spare2', 'spare3'],
+    'C': KEPLER_FIELDS[:3] + ['AODE'] + KEPLER_FIELDS[4:] + ['spare0', 'BDTWeek', 'spare1', 'SVacc', 'SatH1', 'TGD1', 'TGD2',
+                                                            'TransTime', 'AODC', 'spare2', 'spare3'],
+    'I': KEPLER_FIELDS[:3] + ['IODEC'] + KEPLER_FIELDS[4:] + ['spare0', 'BDTWeek', 'spare1', 'URA', 'health', 'TGD', 'spare2',
+                                                             'TransTime', 'spare3', 'spare4', 'spare5'],
+    'R': GLONASS_FIELDS,
+    'S': GLONASS_FIELDS[:10] + ['URA'] + GLONASS_FIELDS[11:14] + ['IODN'],
+}
+# RINEX 2 files hold one system, named by the file type, and omit the spare fields
+RINEX2_SYSTEMS = {'N': 'G', 'G': 'R', 'E': 'E'}
+RINEX2_FIELDS = {'G': GPS_FIELDS[:29], 'R': GLONASS_FIELDS,
+                 'E': [field for field in NAV_FIELDS['E'] if not field.startswith('spare')]}
+# GLONASS and SBAS broadcast their state vectors in km, km/s and km/s^2
+KILOMETER_FIELDS = {'X', 'dX', 'dX2', 'Y', 'dY', 'dY2', 'Z', 'dZ', 'dZ2'}
+
+
+class UnsupportedRinex(ValueError):
+    """The file is not a RINEX 2 or 3 navigation file this parser knows, georinex may still read it."""
+
+
+def read_header(f):
+    # RINEX major version and the system of a RINEX 2 file from the first line, the stream is left after END OF HEADER
+    first_line = f.readline()
+    try:
+        version = int(float(first_line[:9]))
+    except ValueError:
+        raise UnsupportedRinex('not a RINEX file: ' + repr(first_line[:60]))
+    if version not in FIRST_COLUMN or (first_line[20] != 'N' and 'NAV' not in first_line[20:40]):
+        raise UnsupportedRinex('RINEX ' + first_line[:9].strip() + ' ' + first_line[20:40].strip() + ' is not a supported navigation file')
+    system = None
+    if version == 2:
+        system = RINEX2_SYSTEMS.get(first_line[20])
+        if system is None:
+            raise UnsupportedRinex('RINEX 2 navigation file type ' + first_line[20] + ' is not supported')
+    for line in f:
+        if line[60:].strip() == 'END OF HEADER':
+            break
+    return version, system
+
+
+def epoch_fields(line, version):
+    # Satellite, date fields and seconds of a record's epoch line, RINEX 2 carries a two digit year and fractional seconds
+    if version == 2:
+        year = int(line[3:5])
+        return line[:2], (year + 1900 if year >= 80 else year + 2000, int(line[6:8]), int(line[9:11]), int(line[12:14]),
+                          int(line[15:17])), float(line[17:22])
+    return line[:3], (int(line[4:8]), int(line[9:11]), int(line[12:14]), int(line[15:17]), int(line[18:20])), float(line[21:23])
+
+
+def split_fields(line, first_column, count):
+    # count fixed width fields of a line, blank (or cut off) fields are None
+    fields = []
+    for start in range(first_column, first_column + count * FIELD_WIDTH, FIELD_WIDTH):
+        text = line[start:start + FIELD_WIDTH].strip()
+        fields.append(text.replace('D', 'E').replace('d', 'e') if text else None)
+    return fields
+
+
+def to_floats(texts):
+    # One float per field text, None and malformed fields are NaN
+    try:
+        return np.array(['nan' if text is None else text for text in texts], dtype=float)
+    except ValueError:
+        values = np.full(len(texts), np.nan)
+        for i, text in enumerate(texts):
+            try:
+                values[i] = float(text)
+            except (TypeError, ValueError):
+                pass
+        return values
+
+
+def iter_records(f, version, system=None):
+    # Lines of every record: RINEX 2 records have a fixed number of lines per system, RINEX 3 continuation lines are
+    # indented so a record runs until the next line that starts with a system letter (3.05 added a GLONASS line)
+    if version == 2:
+        for line in f:
+            if line.strip():
+                yield [line] + [next(f, '') for _ in range(RECORD_LINES[system])]
+        return
+    record = None
+    for line in f:
+        if not line.strip():
+            continue
+        if line[0] != ' ':
+            if record is not None:
+                yield record
+            record = [line]
+        elif record is not None:
+            record.append(line)
+    if record is not None:
+        yield record
+
+
+def read_records(f, version, system=None, constellations=None):
+    """Raw records of a navigation stream positioned after its header.
+
+    Returns {system: (satellites, epochs, seconds, texts)}: satellite names ('G05'), (year, month, day, hour,
+    minute) tuples, seconds and the field texts of every record (None when blank) in file order. Records of
+    systems without a field list are skipped.
+    """
+    first_column = FIRST_COLUMN[version]
+    records = {}
+    for lines in iter_records(f, version, system):
+        sv_system = system or lines[0][0]
+        if sv_system not in NAV_FIELDS or (constellations is not None and sv_system not in constellations):
+            continue
+        try:
+            satellite, epoch, seconds = epoch_fields(lines[0], version)
+        except ValueError:
+            continue
+        texts = split_fields(lines[0], first_column + FIELD_WIDTH, 3)
+        for line in lines[1:]:
+            texts += split_fields(line, first_column, 4)
+        satellite = (system + satellite.strip().zfill(2)) if version == 2 else satellite.replace(' ', '0')
+        satellites, epochs, all_seconds, all_texts = records.setdefault(sv_system, ([], [], [], []))
+        satellites.append(satellite)
+        epochs.append(epoch)
+        all_seconds.append(seconds)
+        all_texts.append(texts)
+    return records
+
+
+def record_times(epochs, seconds, version):
+    # datetime64[ns] of the epoch fields, fractional RINEX 2 seconds are kept to the microsecond like georinex does
+    epochs = np.array(epochs, dtype=np.int64).reshape(-1, 5)
+    days = pd.to_datetime(pd.DataFrame({'year': epochs[:, 0], 'month': epochs[:, 1], 'day': epochs[:, 2]})).to_numpy()
+    seconds = np.asarray(seconds, dtype=float)
+    micros = np.floor(seconds).astype(np.int64) * 10**6
+    if version == 2:
+        micros += (seconds % 1 * 10**6).astype(np.int64)
+    return days + ((epochs[:, 3] * 3600 + epochs[:, 4] * 60) * 10**6 + micros).astype('timedelta64[us]')
+
+
+def read_navigation(f, constellations=None):
+    """Parse a RINEX 2 or 3 navigation text stream into one row per record.
+
+    Returns the same DataFrame as georinex.load(...).to_dataframe() after dropna(how='all') and reset_index():
+    'sv' and 'time' columns followed by the georinex field names of every system in the file, sorted by
+    satellite and time, with GLONASS/SBAS states in meters. Only the first of duplicated (sv, time) records is
+    kept. Raises UnsupportedRinex for anything else (RINEX 4, observation files, RINEX 2 SBAS).
+    """
+    version, system = read_header(f)
+    records = read_records(f, version, system, constellations)
+    parts = []
+    for sv_system, (satellites, epochs, seconds, texts) in records.items():
+        fields = RINEX2_FIELDS[sv_system] if version == 2 else NAV_FIELDS[sv_system]
+        values = to_floats([text for record in texts for text in (record + [None] * len(fields))[:len(fields)]])
+        values = values.reshape(-1, len(fields))
+        for column in np.flatnonzero([field in KILOMETER_FIELDS for field in fields]):
+            values[:, column] *= 1e3
+        part = pd.DataFrame(values, columns=fields)
+        part.insert(0, 'time', record_times(epochs, seconds, version).astype('datetime64[ns]'))
+        part.insert(0, 'sv', np.array(satellites, dtype=object))
+        parts.append(part)
+    if not parts:
+        return pd.DataFrame({'sv': pd.Series(dtype=object), 'time': pd.Series(dtype='datetime64[ns]')})
+    data = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+    data = data.loc[data.iloc[:, 2:].notna().any(axis=1)]
+    data = data.drop_duplicates(['sv', 'time'], keep='first')
+    return data.sort_values(['sv', 'time'], kind='stable', ignore_index=True)
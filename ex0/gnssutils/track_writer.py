@@ -0,0 +1,199 @@
+import json
+import math
+import os
+import tempfile
+from xml.sax.saxutils import escape
+
+import pandas as pd
+
+
+TRACK_MODES = ('points', 'linestring', 'track')
+TRACK_FORMATS = {'.kml': 'kml', '.geojson': 'geojson', '.json': 'geojson', '.gpx': 'gpx'}
+EARTH_RADIUS = 6371000.0
+
+
+def format_time(timestamp):
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return timestamp.tz_convert('UTC').strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class TrackWriter():
+    """Write fixes to disk as they arrive instead of building the whole document in memory.
+
+    mode is one of TRACK_MODES: 'points' writes one placemark/feature/waypoint per fix, 'linestring'
+    a single line through all the fixes and 'track' a single line with a timestamp per fix. decimate
+    keeps every n-th fix and min_distance drops fixes closer than that many meters to the last one
+    written. Sections that a format needs after the coordinates (like the coordinate list of a KML
+    gx:Track, which must follow all the timestamps) are spooled to a temporary file, not to memory.
+    """
+
+    def __init__(self, filepath, mode='points', decimate=1, min_distance=0, name='GNSS track'):
+        if mode not in TRACK_MODES:
+            raise ValueError('unknown track mode ' + str(mode))
+        self.filepath = filepath
+        self.mode = mode
+        self.decimate = max(int(decimate), 1)
+        self.min_distance = min_distance
+        self.name = name
+        self.count = 0
+        self.written = 0
+        self.last = None
+        self.file = open(filepath, 'w')
+        self.spool = None
+        self.write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open_spool(self):
+        self.spool = tempfile.TemporaryFile('w+', dir=os.path.dirname(os.path.abspath(self.filepath)))
+
+    def keep(self, lat, lon):
+        index = self.count
+        self.count += 1
+        if index % self.decimate:
+            return False
+        if self.min_distance and self.last is not None:
+            # Equirectangular approximation, plenty for distances of a few meters
+            x = math.radians(lon - self.last[1]) * math.cos(math.radians((lat + self.last[0]) / 2))
+            y = math.radians(lat - self.last[0])
+            if EARTH_RADIUS * math.hypot(x, y) < self.min_distance:
+                return False
+        self.last = (lat, lon)
+        return True
+
+    def write(self, lat, lon, alt, time=None):
+        if self.mode == 'track' and (time is None or pd.isna(time)):
+            raise ValueError("track mode needs a timestamp for every fix, use mode 'linestring' without times")
+        if self.keep(lat, lon):
+            self.write_point(lat, lon, alt, time)
+            self.written += 1
+
+    def write_many(self, lla, times=None):
+        if times is None:
+            if self.mode == 'track':
+                raise ValueError("track mode needs a timestamp for every fix, use mode 'linestring' without times")
+            times = [None] * len(lla)
+        for (lat, lon, alt), time in zip(lla, times):
+            self.write(lat, lon, alt, time)
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.spool is not None:
+            self.spool.seek(0)
+            self.write_spooled(self.spool)
+            self.spool.close()
+        self.write_footer()
+        self.file.close()
+
+    def write_spooled(self, spool):
+        for block in iter(lambda: spool.read(1 << 16), ''):
+            self.file.write(block)
+
+    def write_header(self):
+        raise NotImplementedError
+
+    def write_point(self, lat, lon, alt, time):
+        raise NotImplementedError
+
+    def write_footer(self):
+        raise NotImplementedError
+
+
+class KmlTrackWriter(TrackWriter):
+    def write_header(self):
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">\n'
+                        '<Document>\n<name>' + escape(self.name) + '</name>\n')
+        if self.mode == 'linestring':
+            self.file.write('<Placemark>\n<name>' + escape(self.name) + '</name>\n<LineString>\n<coordinates>\n')
+        elif self.mode == 'track':
+            self.file.write('<Placemark>\n<name>' + escape(self.name) + '</name>\n<gx:Track>\n')
+            self.open_spool()
+
+    def write_point(self, lat, lon, alt, time):
+        if self.mode == 'points':
+            self.file.write('<Placemark><Point><coordinates>%.8f,%.8f,%.3f</coordinates></Point></Placemark>\n' % (lon, lat, alt))
+        elif self.mode == 'linestring':
+            self.file.write('%.8f,%.8f,%.3f\n' % (lon, lat, alt))
+        else:
+            self.file.write('<when>' + format_time(time) + '</when>\n')
+            self.spool.write('<gx:coord>%.8f %.8f %.3f</gx:coord>\n' % (lon, lat, alt))
+
+    def write_footer(self):
+        if self.mode == 'linestring':
+            self.file.write('</coordinates>\n</LineString>\n</Placemark>\n')
+        elif self.mode == 'track':
+            self.file.write('</gx:Track>\n</Placemark>\n')
+        self.file.write('</Document>\n</kml>\n')
+
+
+class GeoJsonTrackWriter(TrackWriter):
+    def write_header(self):
+        self.file.write('{"type": "FeatureCollection", "features": [\n')
+        if self.mode != 'points':
+            self.file.write('{"type": "Feature", "properties": {"name": ' + json.dumps(self.name))
+            self.file.write('}, "geometry": {"type": "LineString", "coordinates": [\n' if self.mode == 'linestring' else
+                            ', "coordTimes": [\n')
+            if self.mode == 'track':
+                self.open_spool()
+
+    def write_point(self, lat, lon, alt, time):
+        separator = ',\n' if self.written else ''
+        coordinates = '[%.8f, %.8f, %.3f]' % (lon, lat, alt)
+        if self.mode == 'points':
+            properties = '{"time": "' + format_time(time) + '"}' if time is not None else '{}'
+            self.file.write(separator + '{"type": "Feature", "properties": ' + properties +
+                            ', "geometry": {"type": "Point", "coordinates": ' + coordinates + '}}')
+        elif self.mode == 'linestring':
+            self.file.write(separator + coordinates)
+        else:
+            self.file.write(separator + '"' + format_time(time) + '"')
+            self.spool.write(separator + coordinates)
+
+    def write_spooled(self, spool):
+        self.file.write(']}, "geometry": {"type": "LineString", "coordinates": [\n')
+        super().write_spooled(spool)
+
+    def write_footer(self):
+        if self.mode != 'points':
+            self.file.write(']}}')
+        self.file.write('\n]}\n')
+
+
+class GpxTrackWriter(TrackWriter):
+    def write_header(self):
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<gpx version="1.1" creator="gnss_parser" xmlns="http://www.topografix.com/GPX/1/1">\n')
+        if self.mode != 'points':
+            self.file.write('<trk>\n<name>' + escape(self.name) + '</name>\n<trkseg>\n')
+
+    def write_point(self, lat, lon, alt, time):
+        tag = 'wpt' if self.mode == 'points' else 'trkpt'
+        point = '<%s lat="%.8f" lon="%.8f"><ele>%.3f</ele>' % (tag, lat, lon, alt)
+        if time is not None:
+            point += '<time>' + format_time(time) + '</time>'
+        self.file.write(point + '</' + tag + '>\n')
+
+    def write_footer(self):
+        if self.mode != 'points':
+            self.file.write('</trkseg>\n</trk>\n')
+        self.file.write('</gpx>\n')
+
+
+TRACK_WRITERS = {'kml': KmlTrackWriter, 'geojson': GeoJsonTrackWriter, 'gpx': GpxTrackWriter}
+
+
+def open_track_writer(filepath, track_format=None, **kwargs):
+    """Open the writer matching track_format, or the file extension when track_format is None."""
+    if track_format is None:
+        track_format = TRACK_FORMATS.get(os.path.splitext(filepath)[1].lower())
+    if track_format not in TRACK_WRITERS:
+        raise ValueError('unknown track format for ' + filepath)
+    return TRACK_WRITERS[track_format](filepath, **kwargs)
@@ -0,0 +1,157 @@
+import argparse
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import navpy
+
+from gnssutils.corrections import correction_geometry, total_delay, CORRECTION_MODELS
+from gnssutils.ephemeris_manager import EphemerisManager, EphemerisShard
+from gnss_parser import calculate_satellite_positions, calculate_satellite_velocities, ephemeris_data_directory, \
+    CN0_VARIANCE_MODEL, LIGHTSPEED, WEEKSEC, GPS_UTC_LEAP_SECONDS
+
+RAW_COLUMNS = ['utcTimeMillis', 'TimeNanos', 'LeapSecond', 'TimeUncertaintyNanos', 'FullBiasNanos', 'BiasNanos', 'BiasUncertaintyNanos',
+               'DriftNanosPerSecond', 'DriftUncertaintyNanosPerSecond', 'HardwareClockDiscontinuityCount', 'Svid', 'TimeOffsetNanos',
+               'State', 'ReceivedSvTimeNanos', 'ReceivedSvTimeUncertaintyNanos', 'Cn0DbHz', 'PseudorangeRateMetersPerSecond',
+               'PseudorangeRateUncertaintyMetersPerSecond', 'AccumulatedDeltaRangeState', 'AccumulatedDeltaRangeMeters',
+               'AccumulatedDeltaRangeUncertaintyMeters', 'CarrierFrequencyHz', 'CarrierCycles', 'CarrierPhase', 'CarrierPhaseUncertainty',
+               'MultipathIndicator', 'SnrInDb', 'ConstellationType', 'AgcDb', 'BasebandCn0DbHz', 'FullInterSignalBiasNanos',
+               'FullInterSignalBiasUncertaintyNanos', 'SatelliteInterSignalBiasNanos', 'SatelliteInterSignalBiasUncertaintyNanos',
+               'CodeType', 'ChipsetElapsedRealtimeNanos']
+NAVIGATION_FILE = os.path.join(ephemeris_data_directory, 'nasa', 'brdc1040.24n')
+# Afternoon of the day covered by NAVIGATION_FILE, at the place the example log was recorded
+DEFAULT_START = datetime(2024, 4, 13, 16, 52, tzinfo=timezone.utc)
+DEFAULT_RECEIVER = (32.1687809, 34.8133020, 43.25)
+ELEVATION_MASK = np.radians(10)
+# Hardware clock of the simulated phone: TimeNanos at the first epoch, the fraction of a ns left in BiasNanos,
+# a receiver clock offset (m) and its drift (m/s)
+START_TIME_NANOS = 332339413000000
+BIAS_NANOS = 0.3211078643798828
+RECEIVER_CLOCK_OFFSET = 3.0e4
+RECEIVER_CLOCK_DRIFT = -9.6
+GPS_EPOCH = datetime(1980, 1, 6, tzinfo=timezone.utc)
+GPS_EPOCH_UNIX_MILLIS = 315964800000
+
+
+def load_navigation(navigation_file=NAVIGATION_FILE):
+    # GPS records of a navigation file as an EphemerisShard, parsed through the sidecar cache like the pipeline does
+    data = EphemerisManager.load_parsed_cache(navigation_file)
+    if data is None:
+        data = EphemerisManager.parse_rinex(navigation_file)
+        EphemerisManager.save_parsed_cache(navigation_file, None, data)
+    data = data.loc[data['sv'].str.startswith('G')].reset_index(drop=True)
+    return EphemerisShard(data['time'].min().floor('D'), data), EphemerisManager.load_ionosphere(navigation_file)
+
+
+def simulate_epochs(receive_times, receiver, shard, ionosphere=None, max_satellites=10, seed=0):
+    """Simulate the GPS measurements of a static receiver at receive_times (UTC DatetimeIndex).
+
+    Every epoch keeps the max_satellites highest satellites above ELEVATION_MASK. Pseudoranges carry the
+    geometric range, the satellite clock, every CORRECTION_MODELS delay, the receiver clock and noise that
+    follows the C/N0 model of the weighted solver. Returns a DataFrame with one row per measurement.
+    """
+    rng = np.random.default_rng(seed)
+    receiver = np.asarray(receiver, dtype=float)
+    satellites = np.array(sorted(shard.sv_index))
+    epoch_index = np.repeat(np.arange(len(receive_times)), len(satellites))
+    prns = np.tile(satellites, len(receive_times))
+    gps_nanos = (receive_times - GPS_EPOCH).asi8 + GPS_UTC_LEAP_SECONDS * 10**9
+    receive_tow = (gps_nanos % (WEEKSEC * 10**9)) * 1e-9
+    ephemeris = shard.lookup(np.repeat(receive_times.asi8, len(satellites)), prns).reset_index(drop=True)
+    found = ephemeris['time'].notna().to_numpy()
+    epoch_index, prns, ephemeris = epoch_index[found], prns[found], ephemeris.loc[found]
+    receive_tow = receive_tow[epoch_index]
+
+    # The signal left the satellite one travel time earlier, three fixed point steps settle it well below a millimeter
+    transmit_tow = receive_tow - 0.075
+    for _ in range(3):
+        states = calculate_satellite_positions(None, prns, transmit_tow, ephemeris)
+        xyz = states[['Sat.X', 'Sat.Y', 'Sat.Z']].to_numpy()
+        geometry = correction_geometry(np.tile(receiver, (len(prns), 1)), xyz, receive_tow, ionosphere)
+        ranges = np.linalg.norm(xyz - receiver, axis=1) + total_delay(geometry, CORRECTION_MODELS)
+        transmit_tow = receive_tow - ranges / LIGHTSPEED
+
+    visible = geometry['elevation'] > ELEVATION_MASK
+    order = np.lexsort((-geometry['elevation'], epoch_index))
+    rank = np.empty(len(order), dtype=int)
+    counts = np.bincount(epoch_index[order], minlength=len(receive_times))
+    rank[order] = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+    keep = visible & (rank < max_satellites)
+    epoch_index, prns, ephemeris = epoch_index[keep], prns[keep], ephemeris.loc[keep]
+    xyz, ranges, transmit_tow, receive_tow = xyz[keep], ranges[keep], transmit_tow[keep], receive_tow[keep]
+    elevation = geometry['elevation'][keep]
+    sat_bias = states['Sat.bias'].to_numpy()[keep]
+
+    cn0 = np.clip(28 + 20 * np.sin(elevation) + rng.normal(0, 2, len(prns)), 15, 50)
+    sigma = np.sqrt(CN0_VARIANCE_MODEL[0] + CN0_VARIANCE_MODEL[1] * 10**(-cn0 / 10))
+    elapsed = (receive_times.asi8[epoch_index] - receive_times.asi8[0]) * 1e-9
+    clock = RECEIVER_CLOCK_OFFSET + RECEIVER_CLOCK_DRIFT * elapsed
+    pseudoranges = ranges + rng.normal(0, 1, len(prns)) * sigma
+    motion = calculate_satellite_velocities(prns, transmit_tow, ephemeris)
+    lines_of_sight = (xyz - receiver) / np.linalg.norm(xyz - receiver, axis=1)[:, None]
+    range_rates = np.einsum('ij,ij->i', motion[:, 0:3], lines_of_sight) + RECEIVER_CLOCK_DRIFT \
+        - LIGHTSPEED * motion[:, 3] + rng.normal(0, 0.05, len(prns))
+    # The satellite stamps the transmit time with its own clock, the receiver clock is left to TimeNanos
+    received_nanos = gps_nanos[epoch_index] - np.round((pseudoranges / LIGHTSPEED - sat_bias) * 1e9).astype(np.int64)
+    return pd.DataFrame({'epoch': epoch_index, 'Svid': [int(prn[1:]) for prn in prns], 'ReceivedSvTimeNanos': received_nanos % (WEEKSEC * 10**9),
+                         'receiver_nanos': gps_nanos[epoch_index] + np.round(clock / LIGHTSPEED * 1e9).astype(np.int64),
+                         'Cn0DbHz': cn0, 'sigma': sigma, 'PseudorangeRateMetersPerSecond': range_rates})
+
+
+def format_raw_lines(measurements, first_receiver_nanos):
+    # Raw records in GnssLogger's column order. TimeNanos is the phone clock, which started at START_TIME_NANOS when the
+    # receiver believed it was first_receiver_nanos (GPS ns), so TimeNanos - (FullBiasNanos + BiasNanos) carries the clock offset
+    time_nanos = START_TIME_NANOS + measurements['receiver_nanos'].to_numpy() - first_receiver_nanos
+    full_bias = START_TIME_NANOS - first_receiver_nanos
+    utc_millis = (measurements['receiver_nanos'].to_numpy() - GPS_UTC_LEAP_SECONDS * 10**9) // 10**6 + GPS_EPOCH_UNIX_MILLIS
+    uncertainty = np.maximum(np.round(measurements['sigma'].to_numpy() / LIGHTSPEED * 1e9), 1).astype(int)
+    lines = []
+    for i in range(len(measurements)):
+        cn0 = measurements['Cn0DbHz'].iat[i]
+        lines.append('Raw,%d,%d,18,0.0,%d,%r,24.1,-31.9,9.5,7,%d,0.0,16399,%d,%d,%.1f,%r,0.05,16,0.0,0.0,1575420030,,,,0,0.0,1,-57.1,%.1f,'
+                     '0.0,0.0,,,C,%d\n' % (utc_millis[i], time_nanos[i], full_bias, BIAS_NANOS, measurements['Svid'].iat[i],
+                                           measurements['ReceivedSvTimeNanos'].iat[i], uncertainty[i], cn0,
+                                           float(measurements['PseudorangeRateMetersPerSecond'].iat[i]), cn0 - 5, time_nanos[i] + 5995705505))
+    return lines
+
+
+def generate_log(output_filepath, duration=60, rate=1, satellites=10, start=DEFAULT_START, receiver=DEFAULT_RECEIVER, seed=0,
+                 navigation_file=NAVIGATION_FILE):
+    """Write a GnssLogger log of duration seconds of GPS Raw records at rate epochs per second for a static receiver.
+
+    receiver is (latitude, longitude, altitude) in degrees and meters, every epoch holds up to satellites
+    satellites and the whole log must stay inside the day of navigation_file. Returns the number of Raw records.
+    """
+    start = pd.Timestamp(start)
+    start = start.tz_localize('UTC') if start.tzinfo is None else start.tz_convert('UTC')
+    receive_times = pd.date_range(start, periods=max(int(round(duration * rate)), 1), freq=pd.Timedelta(seconds=1 / rate))
+    shard, ionosphere = load_navigation(navigation_file)
+    if receive_times[0] <= shard.day or receive_times[-1] >= shard.day + pd.Timedelta(days=1):
+        raise ValueError('the log must stay inside ' + str(shard.day.date()) + ', the day of ' + navigation_file)
+    receiver_ecef = navpy.lla2ecef(*receiver)
+    measurements = simulate_epochs(receive_times, receiver_ecef, shard, ionosphere, satellites, seed)
+    first_receiver_nanos = measurements['receiver_nanos'].iat[0] if len(measurements) else 0
+    with open(output_filepath, 'w') as logfile:
+        logfile.write('# \n# Header Description:\n# \n# Version: synthetic Platform: 14 Manufacturer: gnss_parser Model: synthetic_log\n# \n')
+        logfile.write('# Raw,' + ','.join(RAW_COLUMNS) + '\n# \n')
+        for block in range(0, len(measurements), 1 << 14):
+            logfile.writelines(format_raw_lines(measurements.iloc[block:block + (1 << 14)], first_receiver_nanos))
+    return len(measurements)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic GnssLogger log simulated from the bundled GPS navigation file')
+    parser.add_argument('output', help='log file to write')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of measurements')
+    parser.add_argument('--rate', type=float, default=1, help='epochs per second')
+    parser.add_argument('--satellites', type=int, default=10, help='most satellites in one epoch (the highest ones are kept)')
+    parser.add_argument('--start', default=DEFAULT_START.isoformat(), help='UTC time of the first epoch, inside the navigation file day')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the measurement noise')
+    args = parser.parse_args()
+    count = generate_log(args.output, args.duration, args.rate, args.satellites, args.start, seed=args.seed)
+    print(args.output + ': ' + str(count) + ' Raw records')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,29 @@ import unittest
 from unittest.mock import patch
 import pandas as pd
 import numpy as np
+from datetime import datetime, timezone
+import tempfile
+import json
+import io
+import importlib.util
+import shutil
 import warnings
+import gzip
+import ftplib
+import navpy
 warnings.simplefilter(action='ignore', category=Warning)
 warnings.simplefilter(action='ignore', category=DeprecationWarning)
 warnings.filterwarnings(action='ignore')
 from gnss_parser import *
+from gnssutils.ephemeris_manager import EphemerisShard
+from gnssutils.corrections import correction_geometry
+from gnssutils.rinex_nav import read_navigation, UnsupportedRinex
+from gnssutils.ephemeris_sources import FtpSource, MirrorSource, SourceChain, EphemerisNotFound
+from gnssutils.profiler import Profiler
+from synthetic_log import generate_log, DEFAULT_RECEIVER
+from benchmark import run_benchmarks
+from gnssutils.glonass import propagate_glonass
+from gnssutils.log_stream import follow_file
 
 
 
@@ -74,6 +92,17 @@ class TestCalculateSatellitePosition(unittest.TestCase):
         # Check for correct computation of cn0
         self.assertEqual(result.loc[0, 'cn0'], 40)
 
+    def test_batch_matches_single_epoch(self):
+        # Two epochs sharing the same ephemeris rows, computed in one call
+        ephemeris = pd.concat([self.ephemeris, self.ephemeris])
+        transmit_times = np.array([10, 10, 10, 11, 11, 11])
+        result = calculate_satellite_positions([0, 0, 0, 1, 1, 1], ['G01', 'G02', 'G03'] * 2, transmit_times, ephemeris)
+        single = calculate_satellite_position(self.ephemeris, self.transmit_time, self.one_epoch)
+
+        self.assertListEqual(list(result.columns), ['Epoch', 'satPRN', 'GPS time', 'Sat.bias', 'Sat.X', 'Sat.Y', 'Sat.Z'])
+        self.assertEqual(len(result), 6)
+        np.testing.assert_allclose(result[['Sat.X', 'Sat.Y', 'Sat.Z']].to_numpy()[:3], single[['Sat.X', 'Sat.Y', 'Sat.Z']].to_numpy())
+
     def test_invalid_input(self):
         # Test with invalid input (e.g., empty DataFrame)
         with self.assertRaises(KeyError):
@@ -128,6 +157,410 @@ class TestLeastSquares(unittest.TestCase):
         self.assertAlmostEqual(result_position[1], 3085403.903, delta=0.001)
         self.assertAlmostEqual(result_position[2], 3376938.435, delta=0.001)
 
+    def test_batch_least_squares_matches_single_epoch_and_skips_degenerate(self):
+        satellites = np.array([[25023639.6240527,4783845.80416969,8137692.35013354],
+                               [-1620081.7744787,17327678.89277763 ,20172485.06377191],
+                               [15757452.40831777,1890975.95716349,21856363.72227612],
+                               [23098436.98302593,13303367.38708996,-3014966.4406808 ],
+                               [7810468.74605613,17849813.84424023,18350828.84000951]])
+        pseudoranges = np.array([21196005.87649137,22839528.10111702,21704707.75126088,22215117.68794983,21298089.88169067])
+        # Second epoch puts all the satellites on one line, which can not be solved
+        degenerate = np.outer(np.arange(1, 6), [1e7, 1e7, 1e7])
+        positions, clock_biases, residual_norms, converged = batch_least_squares(
+            np.stack([satellites, degenerate]), np.stack([pseudoranges, pseudoranges]), np.zeros((2, 3)), np.zeros(2))
+
+        self.assertListEqual(converged.tolist(), [True, False])
+        self.assertAlmostEqual(positions[0, 0], 4438536.937, delta=0.001)
+        self.assertAlmostEqual(clock_biases[0], 590.656, delta=0.001)
+        self.assertAlmostEqual(residual_norms[0], 1673.956, delta=0.01)
+
+    def test_solve_epochs_estimates_inter_system_bias(self):
+        receiver = np.array([4436894.3, 3085290.1, 3376331.7])
+        satellites = np.array([[25023639.6, 4783845.8, 8137692.4], [-1620081.8, 17327678.9, 20172485.1],
+                               [15757452.4, 1890976.0, 21856363.7], [23098437.0, 13303367.4, -3014966.4],
+                               [7810468.7, 17849813.8, 18350828.8], [18000000.0, -5000000.0, 19000000.0]])
+        satprns = ['G02', 'G05', 'G08', 'E11', 'E12', 'G15']
+        ranges = np.linalg.norm(satellites - receiver, axis=1) + 150.0 + np.where([prn[0] == 'E' for prn in satprns], 40.0, 0)
+        # Epoch 1 only sees GPS satellites, its Galileo bias is reported as NaN
+        sv_positions = pd.DataFrame({'Epoch': [0] * 6 + [1] * 4, 'satPRN': satprns + ['G02', 'G05', 'G08', 'G15'],
+                                     'Sat.X': np.r_[satellites[:, 0], satellites[[0, 1, 2, 5], 0]],
+                                     'Sat.Y': np.r_[satellites[:, 1], satellites[[0, 1, 2, 5], 1]],
+                                     'Sat.Z': np.r_[satellites[:, 2], satellites[[0, 1, 2, 5], 2]],
+                                     'pseudorange': np.r_[ranges, ranges[[0, 1, 2, 5]]]})
+        fixes = solve_epochs(sv_positions)
+
+        self.assertTrue(fixes['Converged'].all())
+        np.testing.assert_allclose(fixes[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy(), [receiver, receiver], atol=1e-3)
+        np.testing.assert_allclose(fixes['Clock bias'], [150.0, 150.0], atol=1e-3)
+        self.assertAlmostEqual(fixes['ISB.E'].iloc[0], 40.0, delta=1e-3)
+        self.assertTrue(np.isnan(fixes['ISB.E'].iloc[1]))
+
+    def test_raim_excludes_a_blunder_and_weights_follow_cn0(self):
+        receiver = np.array([4436894.3, 3085290.1, 3376331.7])
+        up = receiver / np.linalg.norm(receiver)
+        east = np.cross([0, 0, 1], up)
+        east /= np.linalg.norm(east)
+        north = np.cross(up, east)
+        azimuths = np.radians([10, 55, 100, 150, 200, 245, 290, 335])
+        elevations = np.radians([15, 60, 30, 75, 20, 45, 35, 85])
+        directions = (np.cos(elevations) * np.sin(azimuths))[:, None] * east \
+            + (np.cos(elevations) * np.cos(azimuths))[:, None] * north + np.sin(elevations)[:, None] * up
+        satellites = receiver + 2.2e7 * directions
+        ranges = np.linalg.norm(satellites - receiver, axis=1) + 150.0 + np.random.RandomState(0).normal(0, 1, 8)
+        ranges[3] += 400.0
+        sv_positions = pd.DataFrame({'Epoch': 0, 'satPRN': ['G%02d' % prn for prn in range(1, 9)], 'Sat.X': satellites[:, 0],
+                                     'Sat.Y': satellites[:, 1], 'Sat.Z': satellites[:, 2], 'pseudorange': ranges,
+                                     'cn0': [25, 40, 35, 30, 45, 40, 38, 42]})
+        weights = pseudorange_weights(sv_positions, 'cn0')
+        fixes = solve_epochs(sv_positions, weights=weights, raim=True)
+        unprotected = solve_epochs(sv_positions, weights=weights)
+
+        self.assertTrue(np.all(np.diff(weights[[0, 3, 2, 1]]) > 0))
+        self.assertEqual(fixes['Excluded'].iloc[0], 1)
+        self.assertLess(np.linalg.norm(fixes[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy()[0] - receiver), 10)
+        self.assertGreater(np.linalg.norm(unprotected[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy()[0] - receiver), 50)
+        with self.assertRaises(ValueError):
+            pseudorange_weights(sv_positions, 'elevation')
+
+
+class TestEphemerisManager(unittest.TestCase):
+    def test_get_ephemeris_returns_last_record_before_timestamp(self):
+        timestamp = datetime(2024, 4, 13, 16, 52, tzinfo=timezone.utc)
+        ephemeris = manager.get_ephemeris(timestamp, ['G05', 'G02', 'G99'])
+
+        self.assertListEqual(ephemeris.index.tolist(), ['G02', 'G05'])
+        self.assertTrue((ephemeris['time'] == pd.Timestamp('2024-04-13 16:00', tz='UTC')).all())
+
+    def test_get_ephemeris_batch_aligns_with_input_pairs(self):
+        timestamps = [datetime(2024, 4, 13, 16, 52, tzinfo=timezone.utc), datetime(2024, 4, 13, 0, 30, tzinfo=timezone.utc),
+                      datetime(2024, 4, 13, 16, 52, tzinfo=timezone.utc)]
+        ephemeris = manager.get_ephemeris_batch(timestamps, ['G02', 'G02', 'G99'])
+        single = manager.get_ephemeris(timestamps[0], ['G02'])
+
+        self.assertListEqual(ephemeris.index.tolist(), ['G02', 'G02', 'G99'])
+        self.assertEqual(ephemeris['M_0'].iloc[0], single.loc['G02', 'M_0'])
+        self.assertEqual(ephemeris['time'].iloc[1], pd.Timestamp('2024-04-13 00:00', tz='UTC'))
+        self.assertTrue(ephemeris.iloc[2].drop('Leap Seconds').isna().all())
+
+    def test_parsed_rinex_cache_is_reused_and_invalidated(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'brdc1040.24n')
+            shutil.copy(os.path.join(ephemeris_data_directory, 'nasa', 'brdc1040.24n'), filepath)
+            parsed = EphemerisManager.parse_rinex(filepath)
+            EphemerisManager.save_parsed_cache(filepath, None, parsed)
+
+            cached = EphemerisManager.load_parsed_cache(filepath)
+            pd.testing.assert_frame_equal(cached, parsed)
+            self.assertIsNone(EphemerisManager.load_parsed_cache(filepath, ['G']))
+
+            with open(filepath, 'a') as f:
+                f.write('\n')
+            self.assertIsNone(EphemerisManager.load_parsed_cache(filepath))
+
+    def test_compressed_archives_are_parsed_in_memory(self):
+        plain_filepath = os.path.join(ephemeris_data_directory, 'nasa', 'brdc1040.24n')
+        fileinfo = EphemerisManager.get_filepaths(datetime(2024, 4, 13, tzinfo=timezone.utc))['nasa_daily_gps']
+        with tempfile.TemporaryDirectory() as directory:
+            compressed_manager = EphemerisManager(directory, use_parsed_cache=False)
+            archive_filepath, decompressed_filepath = compressed_manager.local_filepath(fileinfo)
+            with open(plain_filepath, 'rb') as f_in, gzip.open(archive_filepath, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            parsed = compressed_manager.get_ephemeris_dataframe(fileinfo)
+            self.assertListEqual(os.listdir(os.path.dirname(archive_filepath)), ['brdc1040.24n.gz'])
+            self.assertEqual(compressed_manager.leapseconds, EphemerisManager.load_leapseconds(plain_filepath))
+            np.testing.assert_array_equal(EphemerisManager.load_ionosphere(archive_filepath), EphemerisManager.load_ionosphere(plain_filepath))
+
+            # A data directory from before keeps being read from its decompressed copy
+            shutil.copy(plain_filepath, decompressed_filepath)
+            self.assertEqual(compressed_manager.navigation_filepath(fileinfo), decompressed_filepath)
+
+        expected = EphemerisManager.parse_rinex(plain_filepath)
+        pd.testing.assert_frame_equal(parsed.drop(columns='source'), expected.drop(columns='source'))
+        self.assertEqual(parsed['source'].iloc[0], archive_filepath)
+
+    def test_native_rinex_parser_matches_georinex(self):
+        plain_filepath = os.path.join(ephemeris_data_directory, 'nasa', 'brdc1040.24n')
+        with open(plain_filepath) as f:
+            lines = f.read().splitlines()
+        records = lines[[i for i, line in enumerate(lines) if 'END OF HEADER' in line][0] + 1:]
+        # Two GPS records rewritten as RINEX 3 plus GLONASS records, whose states are in km
+        mixed = ['     3.04           N: GNSS NAV DATA    M: MIXED            RINEX VERSION / TYPE',
+                 '                                                            END OF HEADER']
+        for record in [records[0:8], records[8:16]]:
+            mixed.append('G%02d 2024 04 13 %s %s 00' % (int(record[0][:2]), record[0][12:14].replace(' ', '0'), record[0][15:17].replace(' ', '0'))
+                         + record[0][22:79])
+            mixed += [' ' + line[:79] for line in record[1:]]
+        for prn, hour in [(3, 0), (3, 1), (14, 0)]:
+            values = [1.1e-5 * prn, 9.1e-13, 43200.0 + hour, 1.2e4 + prn, -2.1, 1.8e-9, 0.0, -1.5e4, 0.8, -9.3e-10, -prn / 2, 1.7e4, 2.9, -1.86e-9, 0.0]
+            fields = ['%19.12E' % value for value in values]
+            mixed.append('R%02d 2024 04 13 %02d 15 00' % (prn, hour) + ''.join(fields[:3]))
+            mixed += ['    ' + ''.join(fields[i:i + 4]) for i in range(3, 15, 4)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            mixed_filepath = os.path.join(directory, 'mixed.rnx')
+            with open(mixed_filepath, 'w') as f:
+                f.write('\n'.join(mixed) + '\n')
+            for filepath in [plain_filepath, mixed_filepath]:
+                with open(filepath) as f:
+                    native = read_navigation(f)
+                expected = EphemerisManager.load_georinex(filepath)
+                pd.testing.assert_frame_equal(native, expected[native.columns.tolist()])
+                self.assertSetEqual(set(native.columns), set(expected.columns))
+            with open(mixed_filepath) as f:
+                glonass = read_navigation(f, {'R'})
+
+        self.assertListEqual(glonass['sv'].tolist(), ['R03', 'R03', 'R14'])
+        self.assertAlmostEqual(glonass['X'].iloc[0], 1.2003e7)
+        with self.assertRaises(UnsupportedRinex):
+            read_navigation(io.StringIO('     4.00           N: GNSS NAV DATA    M: MIXED            RINEX VERSION / TYPE\n'))
+
+    def test_prefetch_reads_a_local_mirror_without_network(self):
+        timestamp = datetime(2024, 4, 13, 16, 52, tzinfo=timezone.utc)
+        with tempfile.TemporaryDirectory() as directory:
+            mirror = os.path.join(directory, 'mirror')
+            os.makedirs(mirror)
+            with open(os.path.join(ephemeris_data_directory, 'nasa', 'brdc1040.24n'), 'rb') as f_in:
+                with gzip.open(os.path.join(mirror, 'brdc1040.24n.gz'), 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+            offline = FtpSource(address='127.0.0.1:1', timeout=1)
+            mirror_manager = EphemerisManager(os.path.join(directory, 'data'), source=SourceChain([MirrorSource(mirror), offline]))
+            results = mirror_manager.prefetch([timestamp, timestamp + timedelta(days=1)], {'G'})
+            ephemeris = mirror_manager.get_ephemeris(timestamp, ['G02'])
+
+        self.assertEqual(results[0], ('gnss/data/daily/2024/brdc/brdc1040.24n.gz', None))
+        self.assertIn('brdc1050.24n.gz is not in the mirror', results[1][1])
+        self.assertListEqual(ephemeris.index.tolist(), ['G02'])
+
+    def test_ftp_connections_are_reused(self):
+        class FakeFtp():
+            def retrbinary(self, command, callback):
+                if 'missing' in command:
+                    raise ftplib.error_perm('550 not found')
+                callback(b'navigation data')
+
+        source = FtpSource()
+        with tempfile.TemporaryDirectory() as directory, patch.object(FtpSource, 'connect', return_value=FakeFtp()) as connect:
+            for name in ['first.gz', 'second.gz']:
+                source.fetch('gdc.cddis.eosdis.nasa.gov', 'brdc/' + name, os.path.join(directory, name))
+            with self.assertRaises(EphemerisNotFound):
+                source.fetch('gdc.cddis.eosdis.nasa.gov', 'brdc/missing.gz', os.path.join(directory, 'missing.gz'))
+            fetched = sorted(os.listdir(directory))
+
+        self.assertEqual(connect.call_count, 1)
+        self.assertListEqual(fetched, ['first.gz', 'second.gz'])
+
+    def test_lookup_crosses_day_boundary_and_evicts_old_days(self):
+        data = EphemerisManager.parse_rinex(os.path.join(ephemeris_data_directory, 'nasa', 'brdc1040.24n')).reset_index()
+        next_day = data.copy()
+        next_day['time'] = next_day['time'] + pd.Timedelta(days=1)
+        # On the next day G02 only gets its first record at 02:00
+        next_day = next_day.loc[(next_day['sv'] != 'G02') | (next_day['time'].dt.hour >= 2)]
+        first_day, second_day = pd.Timestamp('2024-04-13', tz='UTC'), pd.Timestamp('2024-04-14', tz='UTC')
+        with tempfile.TemporaryDirectory() as directory:
+            shard_manager = EphemerisManager(directory, max_shards=2)
+            shard_manager.add_shard(EphemerisShard(first_day, data))
+            shard_manager.add_shard(EphemerisShard(second_day, next_day))
+
+            timestamps = [datetime(2024, 4, 13, 23, 59, tzinfo=timezone.utc), datetime(2024, 4, 14, 1, 0, tzinfo=timezone.utc),
+                          datetime(2024, 4, 14, 1, 0, tzinfo=timezone.utc)]
+            ephemeris = shard_manager.get_ephemeris_batch(timestamps, ['G05', 'G02', 'G05'])
+            self.assertListEqual(ephemeris['time'].dt.strftime('%m-%d %H').tolist(), ['04-13 22', '04-13 22', '04-14 00'])
+
+            # The day used least recently is evicted first
+            shard_manager.get_shard(first_day)
+            shard_manager.add_shard(EphemerisShard(pd.Timestamp('2024-04-15', tz='UTC'), pd.DataFrame()))
+            self.assertListEqual(list(shard_manager.shards), [first_day, pd.Timestamp('2024-04-15', tz='UTC')])
+
+class TestLocations(unittest.TestCase):
+    def test_locations_data_frame_matches_row_by_row_conversion(self):
+        ecef_list_with_times = [(np.array([4436894.2780066, 3085290.16479374, 3376331.62495113]), 3139.3),
+                                (np.array([4436885.83366258, 3085286.08353279, 3376328.15229751]), 3140.3)]
+        locations_df = calculate_locations_data_frame(ecef_list_with_times)
+
+        self.assertListEqual(list(locations_df.columns), ["GPS time", "Pos.X", "Pos.Y", "Pos.Z", "Lat", "Lon", "Alt"])
+        for row, (coord, time) in zip(locations_df.itertuples(index=False), ecef_list_with_times):
+            np.testing.assert_allclose(row[4:], navpy.ecef2lla(coord))
+        self.assertEqual(ecef_to_lla(np.empty((0, 3))).shape, (0, 3))
+        self.assertEqual(ecef_to_lla(ecef_list_with_times[0][0]).shape, (1, 3))
+
+    def test_join_satellites_to_fixes_matches_on_epoch(self):
+        sv_positions = pd.DataFrame({'Epoch': [0, 0, 1, 2, 2], 'satPRN': ['G01', 'G02', 'G01', 'G01', 'G03'],
+                                     'GPS time': [1.0, 1.1, 2.0, 3.0, 3.1]}).set_index(['Epoch', 'satPRN'])
+        # Epoch 1 has no fix
+        locations_df = pd.DataFrame({'Epoch': [0, 2], 'GPS time': [1.0, 3.0], 'Pos.X': [10.0, 30.0]})
+        final_df = join_satellites_to_fixes(sv_positions, locations_df)
+
+        self.assertListEqual(list(final_df.columns), ['Epoch', 'satPRN', 'GPS time', 'Pos.X'])
+        self.assertListEqual(final_df['satPRN'].tolist(), ['G01', 'G02', 'G01', 'G03'])
+        self.assertListEqual(final_df['Pos.X'].tolist(), [10.0, 10.0, 30.0, 30.0])
+
+    def test_output_tables_round_trip_with_their_dtypes(self):
+        df = pd.DataFrame({'Epoch': [0, 1], 'satPRN': ['G01', 'G02'], 'Sat.X': [1, 2.5], 'cn0': [40, 41]})
+        formats = ['csv'] + [output_format for output_format in ['parquet', 'arrow'] if importlib.util.find_spec('pyarrow')]
+        with tempfile.TemporaryDirectory() as directory:
+            for output_format in formats:
+                filepath = os.path.join(directory, 'table' + OUTPUT_FORMATS[output_format])
+                write_table(df, filepath)
+                loaded = load_table(filepath)
+
+                pd.testing.assert_frame_equal(loaded, apply_output_dtypes(df))
+                self.assertEqual(loaded['satPRN'].dtype, 'category')
+                self.assertEqual(loaded['cn0'].dtype, np.float64)
+
+class TestTrackWriter(unittest.TestCase):
+    def setUp(self):
+        self.lla = [(32.1688 + i * 1e-4, 34.8133, 45.0) for i in range(10)]
+        self.times = pd.date_range('2024-04-13 16:52', periods=10, freq='s', tz='UTC')
+
+    def test_kml_track_lists_every_timestamp_before_the_coordinates(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output_file = os.path.join(directory, 'coordinates.kml')
+            create_kml_file(self.lla, output_file, mode='track', times=self.times, decimate=3)
+            with open(output_file) as f:
+                kml = f.read()
+
+        self.assertEqual(kml.count('<when>'), 4)
+        self.assertEqual(kml.count('<gx:coord>'), 4)
+        self.assertLess(kml.rindex('<when>'), kml.index('<gx:coord>'))
+        self.assertIn('<when>2024-04-13T16:52:03.000000Z</when>', kml)
+
+    def test_track_mode_without_times_is_rejected_before_writing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output_file = os.path.join(directory, 'coordinates.kml')
+            with self.assertRaises(ValueError):
+                create_kml_file(self.lla, output_file, mode='track')
+            self.assertFalse(os.path.exists(output_file))
+            with open_track_writer(os.path.join(directory, 'coordinates.geojson'), mode='track') as writer:
+                with self.assertRaises(ValueError):
+                    writer.write(*self.lla[0], time=pd.NaT)
+
+    def test_geojson_output_is_valid_and_min_distance_drops_close_fixes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output_file = os.path.join(directory, 'coordinates.geojson')
+            # Consecutive fixes are about 11 m apart
+            create_track_file(self.lla, output_file, mode='points', times=self.times, min_distance=20)
+            with open(output_file) as f:
+                features = json.load(f)['features']
+
+        self.assertEqual(len(features), 5)
+        self.assertListEqual(features[1]['geometry']['coordinates'], [34.8133, 32.169, 45.0])
+
+class TestGlonass(unittest.TestCase):
+    def setUp(self):
+        # Broadcast state of the GLONASS ICD example, converted to meters
+        self.state = np.array([7003008.789, -12206626.953, 21280765.625, 783.5417, 2804.2530, 1352.5150])
+        self.acceleration = np.array([0, 1.7e-6, -5.41e-6])
+
+    def test_propagation_converges_and_is_reversible(self):
+        coarse = propagate_glonass(self.state, self.acceleration, 900)
+        fine = propagate_glonass(self.state, self.acceleration, 900, max_step=1)
+        back = propagate_glonass(coarse, self.acceleration, -900)
+
+        np.testing.assert_allclose(coarse[0, :3], fine[0, :3], atol=0.01)
+        np.testing.assert_allclose(back[0], self.state, atol=1e-3)
+        # Rows with different time offsets are propagated in one call
+        batch = propagate_glonass(np.tile(self.state, (2, 1)), np.tile(self.acceleration, (2, 1)), [0, 900])
+        np.testing.assert_allclose(batch, np.vstack([self.state, coarse[0]]), atol=1e-6)
+
+    def test_glonass_rows_use_the_state_vector_model(self):
+        ephemeris = pd.DataFrame({'X': [self.state[0]], 'Y': [self.state[1]], 'Z': [self.state[2]],
+                                  'dX': [self.state[3]], 'dY': [self.state[4]], 'dZ': [self.state[5]],
+                                  'dX2': [0.0], 'dY2': [1.7e-6], 'dZ2': [-5.41e-6],
+                                  'SVclockBias': [1e-5], 'SVrelFreqBias': [1e-12], 't_oc': [600.0], 'Leap Seconds': [18]})
+        result = calculate_satellite_positions(None, ['R05'], [1518.0], ephemeris)
+
+        self.assertAlmostEqual(result.loc[0, 'GPS time'], 900.0)
+        self.assertAlmostEqual(result.loc[0, 'Sat.bias'], 1e-5 + 900e-12)
+        np.testing.assert_allclose(result[['Sat.X', 'Sat.Y', 'Sat.Z']].to_numpy()[0],
+                                   propagate_glonass(self.state, self.acceleration, 900)[0, :3])
+
+class TestCorrections(unittest.TestCase):
+    def setUp(self):
+        self.receiver = np.array([4436894.3, 3085290.1, 3376331.7])
+        up = self.receiver / np.linalg.norm(self.receiver)
+        east = np.cross([0, 0, 1], up)
+        east /= np.linalg.norm(east)
+        # One satellite overhead and one 10 degrees above the eastern horizon
+        low = np.cos(np.radians(10)) * east + np.sin(np.radians(10)) * up
+        self.satellites = self.receiver + 2.2e7 * np.array([up, low])
+        self.ionosphere = EphemerisManager.load_ionosphere(os.path.join(ephemeris_data_directory, 'nasa', 'brdc1040.24n'))
+
+    def test_header_coefficients_and_look_angles(self):
+        geometry = correction_geometry(np.tile(self.receiver, (2, 1)), self.satellites, [50400, 50400], self.ionosphere)
+
+        np.testing.assert_allclose(self.ionosphere[[0, 4]], [0.2794e-07, 0.1290e+06])
+        np.testing.assert_allclose(np.degrees(geometry['elevation']), [90, 10], atol=0.2)
+        self.assertAlmostEqual(np.degrees(geometry['azimuth'][1]), 90, delta=0.2)
+        self.assertTupleEqual(parse_corrections('all'), tuple(CORRECTION_MODELS))
+        with self.assertRaises(ValueError):
+            parse_corrections('ionosphere,multipath')
+
+    def test_delays_have_the_expected_size(self):
+        geometry = correction_geometry(np.tile(self.receiver, (2, 1)), self.satellites, [50400, 50400], self.ionosphere)
+        troposphere = CORRECTION_MODELS['troposphere'](geometry)
+        ionosphere = CORRECTION_MODELS['ionosphere'](geometry)
+        sagnac = CORRECTION_MODELS['sagnac'](geometry)
+
+        # About 2.4 m of zenith delay near sea level, mapped to over 5 times that at 10 degrees
+        self.assertAlmostEqual(troposphere[0], 2.4, delta=0.2)
+        self.assertGreater(troposphere[1], 5 * troposphere[0])
+        self.assertTrue(np.all((ionosphere > 1) & (ionosphere < 60)))
+        self.assertGreater(ionosphere[1], 2 * ionosphere[0])
+        self.assertTrue(np.all(np.abs(sagnac) < 40))
+        np.testing.assert_allclose(CORRECTION_MODELS['ionosphere'](dict(geometry, ionosphere=None)), 0)
+
+class TestSyntheticLog(unittest.TestCase):
+    def test_generated_log_solves_to_the_simulated_receiver(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log_filepath = os.path.join(directory, 'synthetic_log.txt')
+            rows = generate_log(log_filepath, duration=5, satellites=9)
+            measurements, sv_positions = clause2(log_filepath, directory)
+            fixes = calculate_fixes(measurements, cache=None, corrections=parse_corrections('all'), weighting='cn0')
+            results = run_benchmarks(log_filepath, repeat=1, stages=['parse', 'least squares'])
+
+        receiver = navpy.lla2ecef(*DEFAULT_RECEIVER)
+        self.assertEqual(len(measurements), rows)
+        self.assertEqual(len(fixes), 5)
+        self.assertLess(np.linalg.norm(fixes[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy() - receiver, axis=1).max(), 60)
+        self.assertListEqual([result['stage'] for result in results], ['parse', 'least squares'])
+        self.assertTrue(all(result['best'] > 0 and result['peak_mb'] > 0 for result in results))
+
+class TestProfiler(unittest.TestCase):
+    def test_stages_are_aggregated_and_exported_as_a_chrome_trace(self):
+        disabled = Profiler()
+        with disabled.stage('parse', 10) as stage:
+            stage['rows'] = 20
+        profiler = Profiler(enabled=True, memory=False)
+        for epoch in range(3):
+            with profiler.stage('epoch', epoch=epoch):
+                with profiler.stage('least squares') as stage:
+                    stage['rows'] = 8
+        with tempfile.TemporaryDirectory() as directory:
+            trace_file = os.path.join(directory, 'trace.json')
+            profiler.save(trace_file)
+            with open(trace_file) as f:
+                trace = json.load(f)
+
+        self.assertListEqual(disabled.events, [])
+        self.assertEqual(len(trace['traceEvents']), 6)
+        self.assertTrue(all(event['ph'] == 'X' and event['dur'] >= 0 for event in trace['traceEvents']))
+        self.assertEqual(trace['otherData']['stages']['least squares']['rows'], 24)
+        self.assertEqual(trace['otherData']['stages']['epoch']['calls'], 3)
+        self.assertListEqual(list(trace['otherData']['epochs']), ['0', '1', '2'])
+        self.assertIn('3 epochs', profiler.summary())
+
+class TestEpochCache(unittest.TestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = EpochCache(maxsize=2)
+        cache.put(1, 'a')
+        cache.put(2, 'b')
+        cache.get(1)
+        cache.put(3, 'c')
+
+        self.assertIn(1, cache)
+        self.assertNotIn(2, cache)
+        self.assertIsNone(cache.get(2))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
 
 class TestParseInputFilePipeline(unittest.TestCase):
 
@@ -182,6 +615,86 @@ class TestParseInputFilePipeline(unittest.TestCase):
         self.no_diff_between_dataFrames(measurements,expected_measurements)
         self.no_diff_between_dataFrames(android_fixes,expected_android_fixes)
 
+    def test_iter_log_batches_keeps_epochs_whole(self):
+        batches = [batch for record_type, batch in iter_log_batches(self.valid_input_file, batch_rows=100)]
+        measurements, android_fixes = log_to_measurment(self.valid_input_file)
+
+        self.assertGreater(len(batches), 1)
+        self.assertEqual(sum(len(batch) for batch in batches), len(measurements))
+        for previous, current in zip(batches, batches[1:]):
+            self.assertNotEqual(previous['TimeNanos'].iloc[-1], current['TimeNanos'].iloc[0])
+        self.assertEqual(batches[0]['FullBiasNanos'].dtype, np.int64)
+
+    def test_raw_schema_is_applied_at_parse_time(self):
+        measurements, android_fixes = log_to_measurment(self.valid_input_file)
+        self.assertEqual(measurements['TimeNanos'].dtype, np.int64)
+        self.assertEqual(measurements['Cn0DbHz'].dtype, np.float32)
+        self.assertEqual(measurements['Svid'].dtype, np.int16)
+        self.assertEqual(measurements['CodeType'].dtype, 'category')
+        # Blanks in an integer column fall back to the nullable type
+        batch = parse_log_batch(['Raw,1,\n', 'Raw,2,5\n'], ['TimeNanos', 'Svid'], RAW_SCHEMA)
+        self.assertEqual(str(batch['Svid'].dtype), 'Int16')
+
+        measurements = format_satelite_ID(measurements)
+        self.assertEqual(measurements['satPRN'].dtype, 'category')
+        self.assertEqual(list(measurements['satPRN'].cat.categories), sorted(measurements['satPRN'].cat.categories))
+        gps = measurements.loc[measurements['ConstellationType'] == 1]
+        self.assertTrue((gps['satPRN'].astype(str) == 'G' + gps['Svid'].astype(str).str.zfill(2)).all())
+        galileo = measurements.loc[measurements['ConstellationType'] == 6]
+        self.assertTrue((galileo['satPRN'].astype(str) == 'E' + galileo['Svid'].astype(str).str.zfill(2)).all())
+        qzss = format_satelite_ID(pd.DataFrame({'ConstellationType': [4, 2], 'Svid': [193, 131]}))
+        self.assertEqual(list(qzss['satPRN'].astype(str)), ['J01', 'S31'])
+
+    def test_blank_raw_fields_drop_their_rows_only(self):
+        with open(self.valid_input_file) as logfile:
+            lines = logfile.readlines()
+        columns = [line for line in lines if line.startswith('# Raw,')][0][2:].strip().split(',')
+        gps_rows = [i for i, line in enumerate(lines) if line.startswith('Raw,') and line.split(',')[columns.index('ConstellationType')] == '1']
+        for row, column in [(300, 'FullBiasNanos'), (400, 'Svid'), (500, 'ConstellationType'), (600, 'TimeNanos')]:
+            fields = lines[gps_rows[row]].split(',')
+            fields[columns.index(column)] = ''
+            lines[gps_rows[row]] = ','.join(fields)
+
+        with tempfile.TemporaryDirectory() as directory:
+            blank_filepath = os.path.join(directory, 'blank_log.txt')
+            with open(blank_filepath, 'w') as logfile:
+                logfile.writelines(lines)
+            measurements, sv_position = clause2(blank_filepath, directory)
+            fixes = calculate_fixes(measurements)
+        clean_measurements, clean_sv_position = clause2(self.valid_input_file, tempfile.gettempdir())
+        clean_fixes = calculate_fixes(clean_measurements)
+
+        self.assertEqual(measurements['FullBiasNanos'].dtype, np.float64)
+        self.assertEqual(measurements['UnixTime'].isna().sum(), 2)
+        self.assertListEqual(fixes['Epoch'].tolist(), clean_fixes['Epoch'].tolist())
+        # Only the epochs that lost a measurement move
+        moved = np.abs(fixes[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy() - clean_fixes[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy()).max(axis=1) > 1e-6
+        self.assertLessEqual(moved.sum(), 4)
+
+    def test_blank_full_bias_keeps_epoch_boundaries(self):
+        with open(self.valid_input_file) as logfile:
+            lines = logfile.readlines()
+        columns = [line for line in lines if line.startswith('# Raw,')][0][2:].strip().split(',')
+        raw_rows = [i for i, line in enumerate(lines) if line.startswith('Raw,')]
+        time_nanos = [lines[i].split(',')[columns.index('TimeNanos')] for i in raw_rows]
+        epoch_starts = [row for row, time, previous in zip(raw_rows[1:], time_nanos[1:], time_nanos) if time != previous]
+        clean_measurements, clean_sv_position = clause2(self.valid_input_file, tempfile.gettempdir())
+        clean_fixes = calculate_fixes(clean_measurements)
+
+        # The first row of the log and the first row of an epoch in the middle of it
+        for row in [raw_rows[0], epoch_starts[len(epoch_starts) // 2]]:
+            fields = lines[row].split(',')
+            fields[columns.index('FullBiasNanos')] = ''
+            with tempfile.TemporaryDirectory() as directory:
+                blank_filepath = os.path.join(directory, 'blank_log.txt')
+                with open(blank_filepath, 'w') as logfile:
+                    logfile.writelines(lines[:row] + [','.join(fields)] + lines[row + 1:])
+                measurements, sv_position = clause2(blank_filepath, directory)
+                fixes = calculate_fixes(measurements)
+
+            self.assertEqual(measurements['UnixTime'].isna().sum(), 1)
+            self.assertListEqual(fixes['Epoch'].tolist(), clean_fixes['Epoch'].tolist())
+
     @patch('sys.argv', ['test_gnss_parser.py', 'testData/example_log.txt'])
     def test_clause2(self):
         measurements,sv_position = clause2()
@@ -209,6 +722,140 @@ class TestParseInputFilePipeline(unittest.TestCase):
         self.assertEqual(len(ecef_list), 4)  
         self.assertListEqual(excpected_ecef_list, ecef_list) 
     
+    @patch('sys.argv', ['test_gnss_parser.py', 'testData/example_log.txt'])
+    def test_clause3_reuses_clause2_satellite_states(self):
+        measurements, sv_position = clause2()
+        recomputed = clause3(measurements, sv_position)
+        epoch_cache.clear()
+        with patch('gnss_parser.calculate_epoch_satellite_positions') as satellite_positions:
+            reused = clause3(measurements, sv_position)
+
+        satellite_positions.assert_not_called()
+        self.assertGreater(len(reused), 0)
+        for (position, time), (expected_position, expected_time) in zip(reused, recomputed):
+            np.testing.assert_array_equal(position, expected_position)
+            self.assertEqual(time, expected_time)
+
+    def test_stream_fixes_match_the_batch_fixes(self):
+        measurements, sv_position = clause2(self.valid_input_file, tempfile.gettempdir())
+        batch = calculate_fixes(measurements)
+        with open(self.valid_input_file) as logfile:
+            # None stands for the polls of a live source that found nothing new
+            lines = [line for line in logfile for line in (line, None)]
+        streamed = pd.DataFrame(list(stream_fixes(lines, epoch_timeout=60)))
+
+        self.assertListEqual(streamed['Epoch'].tolist(), batch['Epoch'].tolist())
+        np.testing.assert_allclose(streamed[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy(dtype=float),
+                                   batch[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy(), atol=0.01)
+
+    def test_stream_fixes_wait_for_a_missing_navigation_file(self):
+        with open(self.valid_input_file) as logfile:
+            lines = logfile.readlines()
+        with tempfile.TemporaryDirectory() as directory:
+            mirror = os.path.join(directory, 'mirror')
+            os.makedirs(mirror)
+
+            def publish_midway():
+                # The navigation file shows up in the mirror halfway through the session
+                for index, line in enumerate(lines):
+                    if index == len(lines) // 2:
+                        with open(os.path.join(ephemeris_data_directory, 'nasa', 'brdc1040.24n'), 'rb') as f_in:
+                            with gzip.open(os.path.join(mirror, 'brdc1040.24n.gz'), 'wb') as f_out:
+                                shutil.copyfileobj(f_in, f_out)
+                    yield line
+
+            offline_manager = EphemerisManager(os.path.join(directory, 'data'), source=MirrorSource(mirror))
+            stdout, stderr = io.StringIO(), io.StringIO()
+            with patch('gnss_parser.manager', offline_manager), patch('sys.stdout', stdout), patch('sys.stderr', stderr):
+                streamed = list(stream_fixes(publish_midway(), epoch_timeout=60))
+
+        self.assertGreater(len(streamed), 0)
+        self.assertGreater(streamed[0]['Epoch'], 0)
+        self.assertIn('brdc1040.24n.gz is not in the mirror', stderr.getvalue())
+        self.assertEqual(stdout.getvalue(), '')
+
+    def test_ekf_fixes_follow_the_least_squares_track(self):
+        measurements, sv_position = clause2(self.valid_input_file, tempfile.gettempdir())
+        satellites = calculate_epoch_satellite_positions(measurements, velocities=True)
+        least_squares_fixes = calculate_fixes(measurements)
+        filtered = calculate_fixes(measurements, solver='ekf')
+
+        # GPS satellites move at roughly 3 km/s in the earth fixed frame
+        speeds = np.linalg.norm(satellites[['Sat.VX', 'Sat.VY', 'Sat.VZ']].to_numpy(), axis=1)
+        self.assertTrue(((speeds > 1000) & (speeds < 4500)).all())
+        self.assertEqual(len(filtered), len(least_squares_fixes))
+        distances = np.linalg.norm(filtered[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy() - least_squares_fixes[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy(), axis=1)
+        self.assertLess(np.median(distances), 30)
+        # The receiver barely moves in this log, the filter rides out the epochs that throw the snapshot fix off
+        steps = np.linalg.norm(np.diff(filtered[['Pos.X', 'Pos.Y', 'Pos.Z']].to_numpy(), axis=0), axis=1)
+        self.assertLess(steps.max(), 50)
+        self.assertLess(np.abs(filtered[['Vel.X', 'Vel.Y', 'Vel.Z']].to_numpy()).max(), 10)
+
+    def test_follow_file_waits_for_complete_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'live.txt')
+            with open(filepath, 'w') as logfile:
+                logfile.write('first\nsec')
+            lines = follow_file(filepath, poll_interval=0.01)
+            self.assertEqual(next(lines), 'first\n')
+            self.assertIsNone(next(lines))
+            with open(filepath, 'a') as logfile:
+                logfile.write('ond\n')
+            self.assertEqual(next(lines), 'second\n')
+            self.assertIsNone(next(lines))
+            lines.close()
+
+    def test_process_logs_writes_one_output_directory_per_log(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ['first.txt', 'second.txt']:
+                shutil.copy(self.valid_input_file, os.path.join(directory, name))
+            # A malformed log fails on its own instead of aborting the batch
+            with open(os.path.join(directory, 'third.txt'), 'w') as logfile:
+                logfile.write('# Raw,TimeNanos,Svid\nRaw,1,5\n')
+            with patch.object(manager.source, 'close') as close_source:
+                results = process_logs(directory, os.path.join(directory, 'output'), workers=2)
+
+            # The pooled connections of the prefetch are closed before the workers fork
+            close_source.assert_called_once()
+            self.assertListEqual([(os.path.basename(path), error) for path, error in results[:2]], [('first.txt', None), ('second.txt', None)])
+            self.assertEqual(os.path.basename(results[2][0]), 'third.txt')
+            self.assertIsNotNone(results[2][1])
+            for name in ['first', 'second']:
+                self.assertTrue(os.path.isfile(os.path.join(directory, 'output', name, 'coordinates.kml')))
+                self.assertTrue(os.path.isfile(os.path.join(directory, 'output', name, 'satellites_positions_with_estimated_location.csv')))
+
+    def test_log_time_span_reaches_the_day_a_log_ends_on(self):
+        start, end = log_time_span(self.valid_input_file)
+        self.assertEqual(start.date(), end.date())
+        self.assertGreater(end, start)
+        with open(self.valid_input_file) as logfile:
+            lines = logfile.readlines()
+        columns = next(line for line in lines if line.startswith('# Raw,'))[2:].strip().split(',')
+        time_index = columns.index('TimeNanos')
+        # The same epoch a day later, as if the log had run past midnight
+        last_raw = next(line for line in reversed(lines) if line.startswith('Raw,')).split(',')
+        last_raw[time_index] = str(int(last_raw[time_index]) + 86400 * 10**9)
+        with tempfile.TemporaryDirectory() as directory:
+            input_filepath = os.path.join(directory, 'midnight.txt')
+            with open(input_filepath, 'w') as logfile:
+                logfile.writelines(lines + [','.join(last_raw)])
+            midnight_start, midnight_end = log_time_span(input_filepath)
+
+        self.assertEqual(midnight_start, start)
+        self.assertEqual(midnight_end.date(), (end + timedelta(days=1)).date())
+
+    def test_missing_navigation_file_is_reported_per_log(self):
+        epoch_cache.clear()
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, 'mirror'))
+            offline_manager = EphemerisManager(os.path.join(directory, 'data'), source=MirrorSource(os.path.join(directory, 'mirror')))
+            with patch('gnss_parser.manager', offline_manager):
+                with self.assertRaises(EphemerisNotFound):
+                    process_log(self.valid_input_file, directory)
+                input_filepath, error = process_log_safely(self.valid_input_file, directory, {})
+
+        self.assertIn('brdc1040.24n.gz is not in the mirror', error)
+
     @classmethod
     def tearDownClass(cls):
         os.remove('satellites_positions.csv')